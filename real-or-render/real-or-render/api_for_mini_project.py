@@ -1,20 +1,36 @@
 import sys
-import tensorflow as tf
-from tensorflow.keras.preprocessing.image import load_img, img_to_array
-from sklearn.base import BaseEstimator, ClassifierMixin
 import pickle
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.formparsers import MultiPartException, MultiPartParser
 import uvicorn
 import numpy as np
 import tempfile
 import cv2
-from PIL import Image, ImageOps
+from PIL import Image
 import logging
-from typing import Tuple, Optional, Dict, Any
+from typing import Tuple, Optional, Dict, Any, Iterator, Callable, List
 import os
 import io
 import base64
+import hashlib
+import json
+import sqlite3
+import tarfile
+import zipfile
+import secrets
+import uuid
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import threading
+import queue
+import time
+import asyncio
+import functools
+import itertools
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, ProcessPoolExecutor, wait
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,47 +40,240 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Classification Model
 pkl_model_path = os.path.join(script_dir, 'project512.pkl')
+# 0 starts without project512.pkl, leaving loaded_model unset for tools that assign their own (e.g. benchmark_pipeline.py)
+LOAD_CLASSIFIER = os.environ.get("LOAD_CLASSIFIER", "1") == "1"
 
 # Face Detection Model (Using YuNet ONNX)
 YUNET_MODEL_PATH = os.path.join(script_dir, "face_detection_yunet_2023mar.onnx")
 FACE_CONFIDENCE_THRESHOLD = 0.4 # YuNet - Lowered threshold to potentially find smaller faces
+FACE_NMS_THRESHOLD = 0.3 # YuNet - Non-Max Suppression threshold, also used to merge pyramid levels
+
+# --- Detection Resolution ---
+# Frames whose longest side exceeds DETECTION_MAX_SIDE are downscaled for YuNet; boxes are mapped back to the
+# full-resolution frame, which the face crops still come from. 0 keeps detection at the native resolution.
+DETECTION_MAX_SIDE = int(os.environ.get("DETECTION_MAX_SIDE", "0"))
+# Levels > 1 also run detection at 2x, 4x, ... DETECTION_MAX_SIDE (capped at native size) to keep tiny faces
+DETECTION_PYRAMID_LEVELS = int(os.environ.get("DETECTION_PYRAMID_LEVELS", "1"))
+DETECTOR_POOL_SIZE = 16 # Idle YuNet instances kept for reuse, shared by every worker thread of the process
+
+# --- Inference Settings ---
+CLASSIFIER_INPUT_SIZE = (256, 256) # (width, height) each face crop is resized to
+# Max number of face crops (across several sampled video frames) scored by a single classifier call
+VIDEO_INFERENCE_BATCH_SIZE = int(os.environ.get("VIDEO_INFERENCE_BATCH_SIZE", "32"))
+# Cross-request micro-batching: face batches from concurrent requests are merged until either limit is hit
+INFERENCE_BATCHING_ENABLED = os.environ.get("INFERENCE_BATCHING_ENABLED", "1") == "1"
+INFERENCE_MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", "64"))
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "5"))
+INFERENCE_STATS_WINDOW = 1000 # Number of recent batches kept for /inference_stats
+
+# --- Inference Backend ---
+# "keras": model.predict (the reference), "function": graph-compiled tf.function with a fixed input signature,
+# "tflite": TFLite interpreter, "tflite_dynamic": TFLite with dynamic-range quantized weights,
+# "tflite_int8": TFLite with int8 weights and activations, calibrated on BACKEND_CALIBRATION_DIR images
+INFERENCE_BACKENDS = ("keras", "function", "tflite", "tflite_dynamic", "tflite_int8")
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "keras")
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "0")) # TF intra-op / TFLite interpreter threads; 0 keeps the library default
+INFERENCE_INTEROP_THREADS = int(os.environ.get("INFERENCE_INTEROP_THREADS", "0")) # TF inter-op threads; 0 keeps the library default
+OPENCV_THREADS = int(os.environ.get("OPENCV_THREADS", "0")) # cv2.setNumThreads (detection, resizing); 0 keeps the OpenCV default
+BACKEND_CACHE_DIR = os.environ.get("BACKEND_CACHE_DIR", script_dir) # Converted TFLite models are cached here, next to the pickle
+BACKEND_CALIBRATION_DIR = os.environ.get("BACKEND_CALIBRATION_DIR", "") # Face crop images for int8 calibration; random data if unset
+BACKEND_CALIBRATION_SAMPLES = 64
+BACKEND_PARITY_SAMPLES = 16 # Inputs scored by both the reference and the selected backend at startup
+BACKEND_PARITY_MAX_DIFF = float(os.environ.get("BACKEND_PARITY_MAX_DIFF", "0.05")) # Larger score differences fall back to keras
+
+# --- Startup ---
+# The classifier is cached next to the pickle in a fast-loading form (.keras, or the converted .tflite for TFLite
+# backends, which then start without building the Keras model) and warmed up before /readyz reports ready
+MODEL_ARTIFACT_CACHE = os.environ.get("MODEL_ARTIFACT_CACHE", "1") == "1"
+MODEL_WARMUP_BATCH_SIZES = tuple(int(size) for size in os.environ.get("MODEL_WARMUP_BATCH_SIZES", "1,8,32").split(",") if size.strip())
+MODEL_NOT_READY_RETRY_AFTER_SECONDS = 5
+# Worker processes sharing the listening socket (set by serve.py). Their artifacts, in-memory result cache
+# and metrics are per process, so with more than one, images=artifact and the memory cache tier are off.
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+
+# --- Video Sampling ---
+# "skip": every frame_skip-th frame, "fps": sample_fps frames per second of video, "count": sample_count frames spread evenly
+VIDEO_SAMPLE_MODES = ("skip", "fps", "count")
+VIDEO_DEFAULT_SAMPLING = {"mode": "skip", "frame_skip": 5, "fps": None, "count": None, "seek": False}
+VIDEO_SEEK_MIN_GAP_FRAMES = int(os.environ.get("VIDEO_SEEK_MIN_GAP_FRAMES", "30")) # Shorter gaps are cheaper to grab() through
+
+# --- Early Exit ---
+# With early exit on, sampling stops once the confidence interval of the mean per-frame score is clear of the
+# 0.5 label threshold, but never before both minimums below are met
+EARLY_EXIT_DEFAULT = os.environ.get("EARLY_EXIT_DEFAULT", "0") == "1" # Used when a request has no 'early_exit' field
+EARLY_EXIT_MIN_FRAMES = int(os.environ.get("EARLY_EXIT_MIN_FRAMES", "30")) # Scored frames
+EARLY_EXIT_MIN_SECONDS = float(os.environ.get("EARLY_EXIT_MIN_SECONDS", "5")) # Video time the scored frames must span
+EARLY_EXIT_Z = float(os.environ.get("EARLY_EXIT_Z", "2.576")) # Interval half-width in standard errors (2.576 = 99%)
+
+# --- Video Pipeline ---
+# Decoding, detection and classification run as separate stages connected by bounded queues
+VIDEO_DETECTOR_WORKERS = int(os.environ.get("VIDEO_DETECTOR_WORKERS", "2"))
+VIDEO_PIPELINE_QUEUE_SIZE = int(os.environ.get("VIDEO_PIPELINE_QUEUE_SIZE", "8")) # Frames buffered between two stages
+
+# --- Face Tracking ---
+# With a track interval K > 0, YuNet only runs on every K-th sampled frame (and after scene cuts); faces are
+# followed across the frames in between with sparse optical flow. 0 runs detection on every sampled frame.
+TRACK_DETECT_INTERVAL = int(os.environ.get("TRACK_DETECT_INTERVAL", "0"))
+TRACK_IOU_THRESHOLD = float(os.environ.get("TRACK_IOU_THRESHOLD", "0.3")) # Min overlap for a detection to continue a track
+TRACK_SCENE_CUT_THRESHOLD = float(os.environ.get("TRACK_SCENE_CUT_THRESHOLD", "0.3")) # Mean gray-level change (0-1) treated as a cut
+TRACK_FLOW_MAX_SIDE = 320 # Optical flow and scene-cut checks run on a gray copy downscaled to this size
+TRACK_MIN_FLOW_POINTS = 4 # Fewer followed feature points than this counts as a lost track and forces a detection
+
+# --- Near-Duplicate Reuse ---
+# Sampled video frames whose 64-bit dHash is within DEDUP_MAX_DISTANCE bits of a recent frame reuse that
+# frame's detections and scores; face crops across recent frames likewise reuse the score of a near-identical crop
+# of the same face (track or overlapping box). -1 turns it off; 0 only matches identical hashes. Within one image
+# there is no such check, so crops there only share a score when they have the same size and an identical hash
+# (repeated tiles of a collage); a 64-bit dHash cannot tell apart different people who look alike at 8x8.
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", "-1"))
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "16")) # Recent distinct frames (and crops) compared against
+DEDUP_HASH_SIZE = 8 # dHash grid: 8 rows of 8 left/right gradient bits
+
+# --- Request Processing Pools ---
+# Image and video work run in separate pools so long videos cannot starve images.
+PROCESSING_POOL_KIND = os.environ.get("PROCESSING_POOL_KIND", "thread") # "thread" or "process"
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "4"))
+IMAGE_QUEUE_LIMIT = int(os.environ.get("IMAGE_QUEUE_LIMIT", "32")) # Requests allowed to wait beyond the running ones
+IMAGE_RETRY_AFTER_SECONDS = int(os.environ.get("IMAGE_RETRY_AFTER_SECONDS", "1"))
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", "2"))
+VIDEO_QUEUE_LIMIT = int(os.environ.get("VIDEO_QUEUE_LIMIT", "4"))
+VIDEO_RETRY_AFTER_SECONDS = int(os.environ.get("VIDEO_RETRY_AFTER_SECONDS", "10"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "2")) # /predict_images requests processed at once
+BATCH_QUEUE_LIMIT = int(os.environ.get("BATCH_QUEUE_LIMIT", "4"))
+BATCH_RETRY_AFTER_SECONDS = int(os.environ.get("BATCH_RETRY_AFTER_SECONDS", "10"))
+# Images of one batch decoded and detected at once; their face crops meet in the inference scheduler
+BATCH_IMAGE_CONCURRENCY = int(os.environ.get("BATCH_IMAGE_CONCURRENCY", "4"))
+
+# --- Uploads ---
+# Upload size limits are enforced while the request body is still arriving
+MAX_IMAGE_UPLOAD_MB = float(os.environ.get("MAX_IMAGE_UPLOAD_MB", "25"))
+MAX_VIDEO_UPLOAD_MB = float(os.environ.get("MAX_VIDEO_UPLOAD_MB", "500"))
+MAX_BATCH_UPLOAD_MB = float(os.environ.get("MAX_BATCH_UPLOAD_MB", "500")) # Whole /predict_images upload; each image still gets MAX_IMAGE_UPLOAD_MB
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", "1000")) # Files plus archive entries per /predict_images request
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # Bytes copied per step when spooling an upload to disk
+STREAM_EVENT_BUFFER = 64 # Progress events buffered per streaming request before the video pipeline waits for the client
+
+# --- Response Images ---
+# "full": full-resolution base64 JPEGs (default), "thumbnail": downscaled base64 JPEGs, "none": no images,
+# "artifact": short-lived artifact URLs rendered only when fetched from /artifacts
+RESPONSE_IMAGE_MODES = ("full", "thumbnail", "none", "artifact")
+THUMBNAIL_MAX_SIDE = int(os.environ.get("THUMBNAIL_MAX_SIDE", "320"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "70"))
+ARTIFACT_TTL_SECONDS = int(os.environ.get("ARTIFACT_TTL_SECONDS", "300"))
+ARTIFACT_MAX_MB = float(os.environ.get("ARTIFACT_MAX_MB", "512")) # Raw frames kept for artifact rendering
+
+# --- Result Cache ---
+# Results are keyed by upload content + model/detector file identity + processing parameters
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "512"))
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", "256")) # In-memory tier, measured as serialized JSON
+RESULT_CACHE_DB_PATH = os.environ.get("RESULT_CACHE_DB_PATH", "") # SQLite file for the persistent tier; empty disables it
+RESULT_CACHE_DISK_MAX_MB = float(os.environ.get("RESULT_CACHE_DISK_MAX_MB", "1024")) # Persistent tier, oldest entries evicted first
+
+# --- Video Jobs ---
+# Long videos can be submitted as background jobs; job state lives in SQLite so it survives restarts
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(script_dir, "video_jobs.sqlite3"))
+JOB_SPOOL_DIR = os.environ.get("JOB_SPOOL_DIR", os.path.join(script_dir, "job_spool"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "1"))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", "100")) # Queued jobs accepted before POST /jobs/video returns 503
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", str(24 * 3600))) # Finished jobs (and their results) are kept this long
+JOB_CLEANUP_INTERVAL_SECONDS = int(os.environ.get("JOB_CLEANUP_INTERVAL_SECONDS", "300"))
+JOB_PROGRESS_INTERVAL_SECONDS = 1.0 # Minimum time between progress writes for one job
+
+# --- Metrics ---
+# Per-stage latency histograms and counters, exposed in Prometheus text format on /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "0") == "1" # Per-stage Server-Timing header on prediction responses
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS_FACE_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
 
 # --- Load Models ---
+tf = None # Imported on first use by _import_tensorflow; it dominates import time and is only needed to load or run the classifier
+_tf_import_lock = threading.Lock()
+
+def _import_tensorflow():
+    global tf
+    with _tf_import_lock:
+        if tf is None:
+            started = time.perf_counter()
+            import tensorflow
+            # Has to happen before TensorFlow runs its first op
+            if INFERENCE_THREADS > 0:
+                tensorflow.config.threading.set_intra_op_parallelism_threads(INFERENCE_THREADS)
+            if INFERENCE_INTEROP_THREADS > 0:
+                tensorflow.config.threading.set_inter_op_parallelism_threads(INFERENCE_INTEROP_THREADS)
+            tf = tensorflow
+            logger.info(f"Imported TensorFlow in {time.perf_counter() - started:.1f}s.")
+    return tf
+
+@functools.lru_cache(maxsize=None)
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+if OPENCV_THREADS > 0:
+    cv2.setNumThreads(OPENCV_THREADS)
 
 # Load Face Detection Model (YuNet)
-try:
-    if not os.path.exists(YUNET_MODEL_PATH):
-         raise FileNotFoundError(f"YuNet model not found at: {YUNET_MODEL_PATH}")
-    face_net = cv2.FaceDetectorYN.create(
+def create_face_detector(input_size: Tuple[int, int] = (320, 320)) -> cv2.FaceDetectorYN:
+    """Creates a YuNet detector; an instance must not be used by two threads at once (see face_detectors)."""
+    return cv2.FaceDetectorYN.create(
         model=YUNET_MODEL_PATH,
         config="", # Not needed for ONNX usually
-        input_size=(320, 320), # Default input size hint for YuNet, can be adjusted
+        input_size=input_size, # Default input size hint for YuNet, can be adjusted
         score_threshold=FACE_CONFIDENCE_THRESHOLD,
-        nms_threshold=0.3, # Non-Max Suppression threshold
+        nms_threshold=FACE_NMS_THRESHOLD,
         top_k=5000 # Max number of faces to detect
     )
+
+# Detection runs on instances from face_detectors (see FaceDetectorPool); this only checks that the model loads
+face_detector_loaded = False
+try:
+    if not os.path.exists(YUNET_MODEL_PATH):
+         raise FileNotFoundError(f"YuNet model not found at: {YUNET_MODEL_PATH}")
+    create_face_detector()
+    face_detector_loaded = True
     logger.info(f"Loaded YuNet face detection model from: {YUNET_MODEL_PATH}")
 except Exception as e:
     logger.error(f"!!! Error loading YuNet face detection model: {e}")
     logger.error(f"!!! Please ensure '{os.path.basename(YUNET_MODEL_PATH)}' is present in the script directory.")
-    face_net = None
 
 # Load Classification Model
 sys.modules['models'] = sys.modules['__main__']
 
-class DeepFakeClassifier(BaseEstimator, ClassifierMixin):
-    def __init__(self, model_path=None, model=None):
+class DeepFakeClassifier:
+    """The classifier pickled in project512.pkl.
+
+    It was saved as an sklearn estimator, but its pickled state is only the instance __dict__, so it loads into
+    this plain class and startup never imports sklearn. A classifier may also run on a backend alone (model=None).
+    """
+
+    def __init__(self, model_path=None, model=None, backend=None):
+        self.backend_ = backend
         if model is not None:
             self.model = model
         elif model_path is not None:
-            self.model = tf.keras.models.load_model(model_path)
+            self.model = _import_tensorflow().keras.models.load_model(model_path)
+        elif backend is not None:
+            self.model = None
         else:
-            raise ValueError("Either model or model_path must be provided")
+            raise ValueError("Either model, model_path or backend must be provided")
+
+    def set_backend(self, backend) -> None:
+        """Routes predictions through an inference backend (see configure_inference_backend); None restores model.predict."""
+        self.backend_ = backend
 
     def predict_proba(self, X):
-        return self.model.predict(X)
+        return self.predict(X)
 
     def predict(self, X):
+        # Unpickled instances predate backends, hence the getattr
+        backend = getattr(self, "backend_", None)
+        if backend is not None:
+            return backend.predict(X)
         return self.model.predict(X)
 
 class CustomUnpickler(pickle.Unpickler):
@@ -73,22 +282,599 @@ class CustomUnpickler(pickle.Unpickler):
             return DeepFakeClassifier
         return super().find_class(module, name)
 
-logger.info(f"Loading classification model from: {pkl_model_path}")
-try:
+loaded_model = None # Set by load_models(), or assigned directly by tools running with LOAD_CLASSIFIER=0
+
+
+# --- Inference Backends ---
+class _FunctionBackend:
+    """The Keras model called through a tf.function traced once for a fixed (None, H, W, 3) float32 signature."""
+
+    def __init__(self, model):
+        tf = _import_tensorflow()
+        signature = [tf.TensorSpec([None, CLASSIFIER_INPUT_SIZE[1], CLASSIFIER_INPUT_SIZE[0], 3], tf.float32)]
+        self._call = tf.function(lambda batch: model(batch, training=False), input_signature=signature)
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self._call(tf.convert_to_tensor(X, dtype=tf.float32)).numpy()
+
+class _TFLiteBackend:
+    """A TFLite flatbuffer run by a process-wide pool of interpreters, each used by one thread at a time.
+
+    Interpreters are not thread-safe, so a call checks one out and returns it afterwards. Being shared, an
+    interpreter warmed up on the model-loader thread is the one the serving threads then use.
+    """
+
+    def __init__(self, model_content: bytes, threads: int = INFERENCE_THREADS):
+        self.model_content = model_content
+        self.threads = threads
+        self._idle = [] # [interpreter, input_index, output_index, allocated_shape]
+        self._lock = threading.Lock()
+
+    def _new_interpreter(self) -> list:
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            Interpreter = _import_tensorflow().lite.Interpreter
+        interpreter = Interpreter(model_content=self.model_content, num_threads=self.threads or None)
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+        return [interpreter, input_index, output_index, None]
+
+    def _checkout(self, shape: tuple) -> list:
+        with self._lock:
+            # Prefer an interpreter already allocated for this batch shape
+            for i, state in enumerate(self._idle):
+                if state[3] == shape:
+                    return self._idle.pop(i)
+            if self._idle:
+                return self._idle.pop()
+        return self._new_interpreter()
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        state = self._checkout(X.shape)
+        interpreter, input_index, output_index, allocated_shape = state
+        if allocated_shape != X.shape:
+            # Re-allocating is only needed when the batch size changes
+            interpreter.resize_tensor_input(input_index, X.shape)
+            interpreter.allocate_tensors()
+            state[3] = X.shape
+        interpreter.set_tensor(input_index, np.ascontiguousarray(X, dtype=np.float32))
+        interpreter.invoke()
+        predictions = interpreter.get_tensor(output_index).copy()
+        with self._lock:
+            self._idle.append(state)
+        return predictions
+
+def _calibration_batches(count: int) -> Iterator[np.ndarray]:
+    """Single-image batches for int8 calibration: face crops from BACKEND_CALIBRATION_DIR, else uniform noise."""
+    paths = []
+    if BACKEND_CALIBRATION_DIR and os.path.isdir(BACKEND_CALIBRATION_DIR):
+        paths = sorted(os.path.join(BACKEND_CALIBRATION_DIR, name) for name in os.listdir(BACKEND_CALIBRATION_DIR))[:count]
+    images = (cv2.imread(path) for path in paths)
+    images = [image for image in images if image is not None]
+    if not images:
+        logger.warning("No BACKEND_CALIBRATION_DIR images; calibrating int8 on random data, which costs accuracy.")
+        rng = np.random.default_rng(0)
+        for _ in range(count):
+            yield rng.random((1, CLASSIFIER_INPUT_SIZE[1], CLASSIFIER_INPUT_SIZE[0], 3), dtype=np.float32)
+        return
+    for image in images:
+        # Same preprocessing as _prepare_face_batch
+        face = cv2.resize(image, CLASSIFIER_INPUT_SIZE)[:, :, ::-1].astype(np.float32) / 255.0
+        yield face[np.newaxis]
+
+def _convert_to_tflite(model, backend: str) -> bytes:
+    tf = _import_tensorflow()
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if backend in ("tflite_dynamic", "tflite_int8"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if backend == "tflite_int8":
+        # Float input/output are kept, so callers pass the same batches as for the other backends
+        converter.representative_dataset = lambda: ([batch] for batch in _calibration_batches(BACKEND_CALIBRATION_SAMPLES))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+_TFLITE_VARIANTS = {"tflite": "float32", "tflite_dynamic": "dynamic", "tflite_int8": "int8"}
+
+def _artifact_path(suffix: str) -> str:
+    """Path of a derived model file in BACKEND_CACHE_DIR, named after the pickle and its hash so new weights never reuse it."""
+    stem = os.path.splitext(os.path.basename(pkl_model_path))[0]
+    return os.path.join(BACKEND_CACHE_DIR, f"{stem}.{_file_sha256(pkl_model_path)[:16]}.{suffix}")
+
+def _write_artifact(path: str, write: Callable[[str], None]) -> None:
+    """Writes through a temp file and renames it, so concurrently starting workers never read a partial file."""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as cache_error:
+        logger.warning(f"Could not cache model artifact at {path}: {cache_error}")
+
+def _write_bytes(data: bytes) -> Callable[[str], None]:
+    def write(path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(data)
+    return write
+
+def _load_tflite_model(model, backend: str) -> bytes:
+    """The converted model for `backend`, converting once and caching it in BACKEND_CACHE_DIR under the pickle's hash."""
+    cache_path = _artifact_path(f"{_TFLITE_VARIANTS[backend]}.tflite")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            logger.info(f"Loaded cached {backend} model from {cache_path}.")
+            return f.read()
+    started = time.perf_counter()
+    model_content = _convert_to_tflite(model, backend)
+    logger.info(f"Converted classifier to {backend} in {time.perf_counter() - started:.1f}s ({len(model_content)} bytes).")
+    _write_artifact(cache_path, _write_bytes(model_content))
+    return model_content
+
+def configure_inference_backend(classifier: DeepFakeClassifier, backend: str) -> Dict[str, Any]:
+    """Builds `backend` for the classifier's Keras model, checks it against model.predict and installs it.
+
+    The parity check scores the same inputs with both and records the largest absolute score difference; a
+    backend that differs by more than BACKEND_PARITY_MAX_DIFF, or fails to build, is not installed and the
+    classifier stays on Keras. Returns what was installed, for /inference_stats.
+    """
+    classifier.set_backend(None)
+    info = {"backend": "keras", "requested": backend, "threads": INFERENCE_THREADS}
+    if backend not in INFERENCE_BACKENDS:
+        logger.error(f"Unknown INFERENCE_BACKEND '{backend}'; use one of {', '.join(INFERENCE_BACKENDS)}. Using keras.")
+        return info
+    if backend == "keras":
+        return info
+
+    try:
+        if backend == "function":
+            candidate = _FunctionBackend(classifier.model)
+        else:
+            candidate = _TFLiteBackend(_load_tflite_model(classifier.model, backend))
+        parity_batch = np.concatenate(list(_calibration_batches(BACKEND_PARITY_SAMPLES)))
+        reference = np.asarray(classifier.model.predict(parity_batch, verbose=0), dtype=np.float32)
+        max_diff = float(np.max(np.abs(np.asarray(candidate.predict(parity_batch), dtype=np.float32) - reference)))
+    except Exception as backend_error:
+        logger.error(f"Could not set up inference backend '{backend}', staying on keras: {backend_error}", exc_info=True)
+        info["error"] = str(backend_error)
+        return info
+
+    info["parity"] = {"reference": "keras", "samples": len(parity_batch), "max_abs_diff": max_diff}
+    if backend in _TFLITE_VARIANTS:
+        # Lets later starts use the cached TFLite model without loading Keras to re-check it
+        parity_json = json.dumps(info["parity"]).encode("utf-8")
+        _write_artifact(_artifact_path(f"{_TFLITE_VARIANTS[backend]}.parity.json"), _write_bytes(parity_json))
+    if max_diff > BACKEND_PARITY_MAX_DIFF:
+        logger.error(f"Inference backend '{backend}' differs from keras by up to {max_diff:.4f} (> {BACKEND_PARITY_MAX_DIFF}); staying on keras.")
+        return info
+    classifier.set_backend(candidate)
+    info["backend"] = backend
+    logger.info(f"Inference backend '{backend}' installed (max score difference vs keras: {max_diff:.6f}).")
+    return info
+
+inference_backend = {"backend": None, "requested": INFERENCE_BACKEND, "threads": INFERENCE_THREADS}
+
+
+# --- Startup ---
+model_state = {"status": "not_loaded"} # not_loaded -> loading -> loaded -> warming_up -> ready, or failed
+models_ready = threading.Event()
+_model_load_lock = threading.Lock()
+
+def cached_tflite_model(backend: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(model path, parity check) of a converted model for TFLite `backend` that passed its parity check, if cached."""
+    if backend not in _TFLITE_VARIANTS:
+        return None
+    model_path = _artifact_path(f"{_TFLITE_VARIANTS[backend]}.tflite")
+    parity_path = _artifact_path(f"{_TFLITE_VARIANTS[backend]}.parity.json")
+    if not (os.path.exists(model_path) and os.path.exists(parity_path)):
+        return None
+    with open(parity_path) as f:
+        parity = json.load(f)
+    if parity["max_abs_diff"] > BACKEND_PARITY_MAX_DIFF:
+        return None
+    return model_path, parity
+
+def _load_cached_tflite_classifier(backend: str) -> Optional[Tuple[DeepFakeClassifier, Dict[str, Any]]]:
+    """A classifier running straight from a previously converted and parity-checked TFLite model, if there is one."""
+    cached = cached_tflite_model(backend)
+    if cached is None:
+        return None
+    model_path, parity = cached
+    with open(model_path, "rb") as f:
+        classifier = DeepFakeClassifier(backend=_TFLiteBackend(f.read()))
+    logger.info(f"Loaded {backend} classifier from {model_path} without building the Keras model.")
+    return classifier, {"backend": backend, "requested": backend, "threads": INFERENCE_THREADS, "parity": parity}
+
+def _load_keras_classifier() -> Tuple[DeepFakeClassifier, str]:
+    """(classifier, source): from the cached .keras artifact when present, else from the pickle, caching it as .keras."""
+    keras_path = _artifact_path("keras")
+    if MODEL_ARTIFACT_CACHE and os.path.exists(keras_path):
+        try:
+            classifier = DeepFakeClassifier(model_path=keras_path)
+            logger.info(f"Classification model loaded from cached artifact {keras_path}.")
+            return classifier, "keras_artifact"
+        except Exception as artifact_error:
+            logger.warning(f"Could not load cached model {keras_path}, falling back to the pickle: {artifact_error}")
+
+    logger.info(f"Loading classification model from: {pkl_model_path}")
+    _import_tensorflow() # Unpickling rebuilds the Keras model
     with open(pkl_model_path, 'rb') as f:
-        loaded_model = CustomUnpickler(f).load()
+        classifier = CustomUnpickler(f).load()
     logger.info("Classification model loaded.")
-except FileNotFoundError:
-     logger.error(f"!!! Classification model file not found: {pkl_model_path}")
-     # Exit or handle appropriately if classification is essential
-     sys.exit(1)
-except Exception as e:
-     logger.error(f"!!! Error loading classification model: {e}")
-     sys.exit(1)
+    if MODEL_ARTIFACT_CACHE:
+        _write_artifact(keras_path, classifier.model.save)
+    return classifier, "pickle"
+
+def warm_up_models() -> Dict[str, float]:
+    """Runs dummy batches of the expected sizes through the classifier (graph tracing, allocator growth) and one
+    YuNet detection, so the first real request does not pay for them. Returns milliseconds per step.
+
+    Both go through the same path as requests: the classifier through the inference scheduler (when enabled) and
+    the shared TFLite interpreter pool, the detection through the shared detector pool.
+    """
+    timings_ms = {}
+    for size in MODEL_WARMUP_BATCH_SIZES:
+        started = time.perf_counter()
+        _predict_face_batch(np.zeros((size, CLASSIFIER_INPUT_SIZE[1], CLASSIFIER_INPUT_SIZE[0], 3), dtype=np.float32))
+        timings_ms[f"classifier_batch_{size}"] = (time.perf_counter() - started) * 1000.0
+    if face_detector_loaded:
+        started = time.perf_counter()
+        detect_faces(np.zeros((480, 640, 3), dtype=np.uint8))
+        timings_ms["face_detection"] = (time.perf_counter() - started) * 1000.0
+    return timings_ms
+
+def load_models(warm_up: bool = True) -> None:
+    """Loads and warms up the classifier once per process; concurrent callers wait for the first.
+
+    warm_up=False stops after loading (status "loaded"); a later load_models() call only warms up. The
+    multi-worker launcher (serve.py) uses this to load in the parent and warm up in each forked worker.
+    With LOAD_CLASSIFIER=0 nothing is loaded and the process counts as ready; the caller assigns loaded_model.
+    Raises (after recording the error in model_state) when the classifier cannot be loaded.
+    """
+    global loaded_model, inference_backend
+    with _model_load_lock:
+        if models_ready.is_set():
+            return
+        if not LOAD_CLASSIFIER:
+            logger.warning("LOAD_CLASSIFIER=0: no classification model loaded; loaded_model must be assigned before predicting.")
+            model_state.update(status="ready", source="external")
+            models_ready.set()
+            return
+
+        try:
+            if model_state["status"] != "loaded":
+                model_state.update(status="loading", error=None)
+                started = time.perf_counter()
+                loaded = None
+                if MODEL_ARTIFACT_CACHE and INFERENCE_BACKEND in _TFLITE_VARIANTS:
+                    loaded = _load_cached_tflite_classifier(INFERENCE_BACKEND)
+                if loaded is not None:
+                    classifier, backend_info = loaded
+                    source = "tflite_artifact"
+                else:
+                    classifier, source = _load_keras_classifier()
+                    backend_info = configure_inference_backend(classifier, INFERENCE_BACKEND)
+                loaded_model, inference_backend = classifier, backend_info
+                model_state.update(status="loaded", source=source, load_seconds=time.perf_counter() - started)
+            if not warm_up:
+                return
+
+            model_state.update(status="warming_up")
+            started = time.perf_counter()
+            warmup_ms = warm_up_models()
+            model_state.update(status="ready", warmup_ms=warmup_ms, warmup_seconds=time.perf_counter() - started)
+            logger.info(f"Models ready (source: {model_state['source']}, load {model_state['load_seconds']:.1f}s, warmup {model_state['warmup_seconds']:.1f}s).")
+            models_ready.set()
+        except Exception as load_error:
+            logger.error(f"!!! Error loading classification model: {load_error}", exc_info=True)
+            model_state.update(status="failed", error=str(load_error))
+            raise
+
+def require_models_ready() -> None:
+    """Raises HTTP 503 (with Retry-After) while the models are still loading or failed to load."""
+    if not models_ready.is_set():
+        raise HTTPException(status_code=503, detail=f"Model not ready ({model_state['status']}). Please retry later.",
+                            headers={"Retry-After": str(MODEL_NOT_READY_RETRY_AFTER_SECONDS)})
+
+
+# --- Inference Scheduler ---
+class InferenceScheduler:
+    """Merges face batches from concurrent requests into shared classifier calls.
+
+    Submitted batches are queued and flushed together as soon as the merged batch reaches `max_batch_size`
+    rows or `max_wait_ms` has passed since the oldest queued batch arrived. Each caller gets its own rows
+    back through a Future. A single scheduler thread owns every classifier call.
+    """
+
+    def __init__(self, predict_fn, max_batch_size: int, max_wait_ms: float, stats_window: int = INFERENCE_STATS_WINDOW):
+        self._predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._carry = None # Batch that did not fit into the previous flush
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._recent = deque(maxlen=stats_window) # (rows, requests, queue_wait_s, inference_s)
+        self._total_batches = 0
+        self._total_rows = 0
+        self._total_requests = 0
+
+    def submit(self, face_batch: np.ndarray) -> Future:
+        """Queues a prepared face batch; the Future resolves to the classifier output rows for it."""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((face_batch, future, time.perf_counter()))
+        return future
+
+    def predict(self, face_batch: np.ndarray) -> np.ndarray:
+        return self.submit(face_batch).result()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+                self._thread.start()
+
+    def _next_item(self, timeout: Optional[float]):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        if timeout is not None and timeout <= 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+    def _run(self) -> None:
+        while True:
+            first = self._next_item(None)
+            items = [first]
+            rows = len(first[0])
+            deadline = first[2] + self.max_wait
+            while rows < self.max_batch_size:
+                # Past the deadline, only batches that are already queued are merged in
+                try:
+                    item = self._next_item(deadline - time.perf_counter())
+                except queue.Empty:
+                    break
+                if rows + len(item[0]) > self.max_batch_size:
+                    # Keep it for the next flush rather than overshooting the max batch size
+                    self._carry = item
+                    break
+                items.append(item)
+                rows += len(item[0])
+            self._execute(items, rows)
+
+    def _execute(self, items: list, rows: int) -> None:
+        started = time.perf_counter()
+        queue_wait = started - min(item[2] for item in items)
+        try:
+            merged = items[0][0] if len(items) == 1 else np.concatenate([item[0] for item in items])
+            predictions = self._predict_fn(merged)
+        except Exception as batch_err:
+            logger.warning(f"Inference batch of {rows} rows from {len(items)} requests failed: {batch_err}")
+            for _, future, _ in items:
+                future.set_exception(batch_err)
+            return
+        inference_time = time.perf_counter() - started
+
+        offset = 0
+        for face_batch, future, _ in items:
+            future.set_result(predictions[offset:offset + len(face_batch)])
+            offset += len(face_batch)
+
+        with self._stats_lock:
+            self._recent.append((rows, len(items), queue_wait, inference_time))
+            self._total_batches += 1
+            self._total_rows += rows
+            self._total_requests += len(items)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-batch occupancy and latency figures for tuning max batch size against max wait."""
+        with self._stats_lock:
+            recent = list(self._recent)
+            totals = (self._total_batches, self._total_rows, self._total_requests)
+        result = {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "total_batches": totals[0],
+            "total_rows": totals[1],
+            "total_requests": totals[2],
+            "queued": self._queue.qsize(),
+            "recent_batches": len(recent),
+        }
+        if recent:
+            rows = np.array([r[0] for r in recent], dtype=np.float64)
+            occupancy = rows / self.max_batch_size
+            queue_wait_ms = np.array([r[2] for r in recent]) * 1000.0
+            inference_ms = np.array([r[3] for r in recent]) * 1000.0
+            result.update({
+                "mean_batch_rows": float(rows.mean()),
+                "mean_requests_per_batch": float(np.mean([r[1] for r in recent])),
+                "mean_occupancy": float(occupancy.mean()),
+                # Share of recent batches per occupancy decile: "0.0-0.1", ..., "0.9-1.0"
+                "occupancy_histogram": {
+                    f"{i / 10:.1f}-{(i + 1) / 10:.1f}": int(count)
+                    for i, count in enumerate(np.histogram(np.clip(occupancy, 0.0, 1.0), bins=10, range=(0.0, 1.0))[0])
+                },
+                "queue_wait_ms": {f"p{q}": float(np.percentile(queue_wait_ms, q)) for q in (50, 95, 99)},
+                "inference_ms": {f"p{q}": float(np.percentile(inference_ms, q)) for q in (50, 95, 99)},
+            })
+        return result
+
+if INFERENCE_BATCHING_ENABLED:
+    # Resolve loaded_model at call time so the scheduler always uses the current classifier
+    inference_scheduler = InferenceScheduler(lambda batch: loaded_model.predict(batch), INFERENCE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS)
+    logger.info(f"Inference micro-batching enabled (max batch {INFERENCE_MAX_BATCH_SIZE}, max wait {INFERENCE_MAX_WAIT_MS} ms).")
+else:
+    inference_scheduler = None
+# Without the scheduler thread, worker threads take turns on the classifier
+classifier_lock = threading.Lock()
+
+# --- Metrics ---
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in the Prometheus text exposition format."""
+
+    def __init__(self, prefix: str = "realorrender"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict() # name -> {"type", "help", "buckets", "series": {label items: value}}
+
+    def _register(self, name: str, metric_type: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None) -> None:
+        self._metrics[name] = {"type": metric_type, "help": help_text, "buckets": buckets, "series": {}}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._register(name, "counter", help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...]) -> None:
+        self._register(name, "histogram", help_text, tuple(sorted(buckets)))
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        series = self._metrics[name]["series"]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        metric = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = metric["series"].get(key)
+            if state is None:
+                state = metric["series"][key] = [[0] * len(metric["buckets"]), 0.0, 0]
+            for i, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _labels(items) -> str:
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full_name} {metric['help']}")
+                lines.append(f"# TYPE {full_name} {metric['type']}")
+                for key, value in sorted(metric["series"].items()):
+                    if metric["type"] == "counter":
+                        lines.append(f"{full_name}{self._labels(key)} {value:g}")
+                        continue
+                    bucket_counts, total, count = value
+                    for bound, bucket_count in zip(metric["buckets"], bucket_counts):
+                        lines.append(f"{full_name}_bucket{self._labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{full_name}_bucket{self._labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{full_name}_sum{self._labels(key)} {total:g}")
+                    lines.append(f"{full_name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+if METRICS_ENABLED:
+    metrics = MetricsRegistry()
+    metrics.histogram("stage_seconds", "Time spent per processing stage and request (summed over frames for video).", METRICS_LATENCY_BUCKETS)
+    metrics.histogram("faces_per_request", "Face crops scored per request.", METRICS_FACE_COUNT_BUCKETS)
+    metrics.counter("video_frames_decoded_total", "Video frames decoded, including frames only grabbed to skip past them.")
+    metrics.counter("video_frames_sampled_total", "Video frames retrieved for face detection.")
+    metrics.counter("video_frames_scored_total", "Video frames that contributed a score.")
+    metrics.counter("video_frames_reused_total", "Scored video frames that reused the detections and scores of a near-identical frame.")
+    metrics.counter("faces_reused_total", "Face crops that reused the score of a near-identical crop.")
+    metrics.counter("stage_errors_total", "Exceptions raised per processing stage.")
+else:
+    metrics = None
+
+class StageTimings:
+    """Stage durations and counts of one request, reported to the metrics registry once it is done.
+
+    Repeated stages (per frame or per batch) are summed. Picklable, so process-pool workers can hand
+    their timings back along with the result.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind # "image" or "video"
+        self.durations = {} # stage -> seconds, in the order stages first ran
+        self.counts = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def server_timing(self) -> str:
+        """Value for the Server-Timing header, e.g. "detect;dur=12.3, classify;dur=40.1"."""
+        return ", ".join(f"{stage};dur={seconds * 1000.0:.1f}" for stage, seconds in self.durations.items())
+
+    def report(self) -> None:
+        if metrics is None:
+            return
+        for stage, seconds in self.durations.items():
+            metrics.observe("stage_seconds", seconds, kind=self.kind, stage=stage)
+        for stage, errors in self.errors.items():
+            metrics.inc("stage_errors_total", errors, kind=self.kind, stage=stage)
+        if "faces" in self.counts:
+            metrics.observe("faces_per_request", self.counts["faces"], kind=self.kind)
+        for state in ("decoded", "sampled", "scored", "reused"):
+            if f"frames_{state}" in self.counts:
+                metrics.inc(f"video_frames_{state}_total", self.counts[f"frames_{state}"])
+        if "faces_reused" in self.counts:
+            metrics.inc("faces_reused_total", self.counts["faces_reused"], kind=self.kind)
+
+def _stage(timings: Optional[StageTimings], stage: str):
+    """timings.stage(stage), or a no-op when the caller does not collect timings."""
+    return nullcontext() if timings is None else timings.stage(stage)
 
 
 # --- FastAPI App Setup ---
-app = FastAPI()
+def _load_models_in_background() -> None:
+    try:
+        load_models()
+    except Exception:
+        pass # Already logged and recorded in model_state; /readyz keeps reporting it
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load and warm up the models off the event loop so /healthz answers (and /readyz reports progress) meanwhile
+    threading.Thread(target=_load_models_in_background, name="model-loader", daemon=True).start()
+    # Resume jobs left queued or running by a previous process and start periodic job cleanup
+    video_jobs.start()
+    yield
+    video_jobs.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -102,80 +888,799 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Face Detection ---
+class FaceDetectorPool:
+    """Process-wide YuNet instances keyed by input size, checked out for one detection and then returned.
+
+    Request threads (including the per-request video and batch threads) reuse idle detectors of the size they
+    need instead of creating their own. An instance keeps the size it was created for and is never reconfigured;
+    beyond `max_idle` idle instances, those of the least recently used sizes are dropped.
+    """
+
+    def __init__(self, max_idle: int):
+        self.max_idle = max_idle
+        self._idle = OrderedDict() # input size -> idle detectors, least recently used size first
+        self._idle_count = 0
+        self._lock = threading.Lock()
+
+    def _take(self, input_size: Tuple[int, int]) -> Optional[cv2.FaceDetectorYN]:
+        with self._lock:
+            detectors = self._idle.get(input_size)
+            if not detectors:
+                return None
+            detector = detectors.pop()
+            if not detectors:
+                del self._idle[input_size]
+            self._idle_count -= 1
+            return detector
+
+    @contextmanager
+    def checkout(self, input_size: Tuple[int, int]):
+        detector = self._take(input_size)
+        if detector is None:
+            detector = create_face_detector(input_size)
+        yield detector
+        # Not returned when detection raised, in case the instance was left in a bad state
+        with self._lock:
+            self._idle.setdefault(input_size, []).append(detector)
+            self._idle.move_to_end(input_size)
+            self._idle_count += 1
+            while self._idle_count > self.max_idle:
+                size, detectors = next(iter(self._idle.items()))
+                detectors.pop()
+                if not detectors:
+                    del self._idle[size]
+                self._idle_count -= 1
+
+face_detectors = FaceDetectorPool(DETECTOR_POOL_SIZE)
+
+def parse_detection_options(form_data) -> Dict[str, Any]:
+    """Builds per-request detection options from form fields, raising HTTP 400 on invalid values."""
+    detection = {"max_side": DETECTION_MAX_SIDE, "pyramid_levels": DETECTION_PYRAMID_LEVELS}
+    try:
+        if form_data.get("detect_max_side"):
+            detection["max_side"] = int(form_data["detect_max_side"])
+        if form_data.get("detect_pyramid_levels"):
+            detection["pyramid_levels"] = int(form_data["detect_pyramid_levels"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'detect_max_side' and 'detect_pyramid_levels' must be integers.")
+    if detection["max_side"] < 0 or detection["pyramid_levels"] < 1:
+        raise HTTPException(status_code=400, detail="'detect_max_side' must be >= 0 and 'detect_pyramid_levels' >= 1.")
+    detection.update(parse_dedup_options(form_data))
+    return detection
+
+def detect_faces(frame: np.ndarray, detection: Optional[Dict[str, Any]] = None) -> list:
+    """Runs YuNet on a BGR frame and returns (box, confidence, face_roi) for every usable face.
+
+    With a max_side set, detection runs on a downscaled copy (plus larger pyramid levels if requested) and
+    the boxes are rescaled, so boxes and crops always refer to the full-resolution frame.
+    """
+    max_side = DETECTION_MAX_SIDE if detection is None else detection["max_side"]
+    pyramid_levels = DETECTION_PYRAMID_LEVELS if detection is None else detection["pyramid_levels"]
+    (h, w) = frame.shape[:2]
+    longest_side = max(h, w)
+    if not max_side or longest_side <= max_side:
+        with face_detectors.checkout((w, h)) as detector:
+            faces = detector.detect(frame)[1]
+        return _extract_faces(frame, faces)
+
+    level_detections = []
+    level_side = max_side
+    for _ in range(pyramid_levels):
+        scale = min(1.0, level_side / longest_side)
+        if scale < 1.0:
+            input_size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            level_frame = cv2.resize(frame, input_size, interpolation=cv2.INTER_AREA)
+        else:
+            input_size, level_frame = (w, h), frame
+        with face_detectors.checkout(input_size) as detector:
+            faces = detector.detect(level_frame)[1]
+        if faces is not None:
+            faces = faces.copy()
+            # Box (x, y, w, h) and the 5 landmarks back to full-resolution coordinates
+            faces[:, :14] *= np.array([w / input_size[0], h / input_size[1]] * 7, dtype=np.float32)
+            level_detections.append(faces)
+        if scale >= 1.0:
+            break
+        level_side *= 2
+
+    if not level_detections:
+        return []
+    faces = np.concatenate(level_detections)
+    if len(level_detections) > 1:
+        # The same face is usually found on several levels; keep the most confident box
+        keep = cv2.dnn.NMSBoxes(faces[:, :4].tolist(), faces[:, 14].tolist(), FACE_CONFIDENCE_THRESHOLD, FACE_NMS_THRESHOLD)
+        faces = faces[np.array(keep, dtype=np.int64).flatten()]
+    return _extract_faces(frame, faces)
+
+# --- Near-Duplicate Reuse ---
+def parse_dedup_options(form_data) -> Dict[str, Any]:
+    """Reads the `dedup_distance` form field, raising HTTP 400 on invalid values.
+
+    The distance applies to video frames and tracked crops; any value >= 0 turns on the exact-repeat check for
+    the faces of one image (see _group_repeated_crops), which ignores the distance.
+    """
+    dedup_distance = DEDUP_MAX_DISTANCE
+    try:
+        if form_data.get("dedup_distance"):
+            dedup_distance = int(form_data["dedup_distance"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'dedup_distance' must be an integer.")
+    if not -1 <= dedup_distance <= DEDUP_HASH_SIZE * DEDUP_HASH_SIZE:
+        raise HTTPException(status_code=400, detail=f"'dedup_distance' must be between -1 (off) and {DEDUP_HASH_SIZE * DEDUP_HASH_SIZE}.")
+    return {"dedup_distance": dedup_distance}
+
+def _dedup_distance(detection: Optional[Dict[str, Any]]) -> int:
+    return DEDUP_MAX_DISTANCE if detection is None else detection.get("dedup_distance", DEDUP_MAX_DISTANCE)
+
+def _dhash(image: np.ndarray) -> int:
+    """Difference hash of a BGR image: whether each cell of a 9x8 gray thumbnail is brighter than its right neighbour."""
+    small = cv2.resize(image, (DEDUP_HASH_SIZE + 1, DEDUP_HASH_SIZE), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits(gray[:, 1:] > gray[:, :-1]).tobytes(), "big")
+
+class _NearDuplicateIndex:
+    """The last `size` distinct hashes with a value each; looks up the newest one within max_distance bits.
+
+    Only distinct hashes are added, so a long run of near-identical frames keeps matching its first frame
+    instead of drifting away from it one small step at a time.
+    """
+
+    def __init__(self, max_distance: int, size: int = DEDUP_CACHE_SIZE):
+        self.max_distance = max_distance
+        self._entries = deque(maxlen=max(1, size)) # (hash, value), oldest first
+
+    def find(self, image_hash: int, accept: Optional[Callable[[Any], bool]] = None):
+        """The newest value within max_distance bits (and, with `accept`, for which accept(value) holds)."""
+        for other_hash, value in reversed(self._entries):
+            if bin(image_hash ^ other_hash).count("1") <= self.max_distance and (accept is None or accept(value)):
+                return value
+        return None
+
+    def add(self, image_hash: int, value) -> None:
+        self._entries.append((image_hash, value))
+
+def _group_repeated_crops(images: list) -> Tuple[list, List[int]]:
+    """(distinct images, index into them for every input image); an image repeats an earlier distinct one only
+    when both have the same size and an identical dHash, as nothing else tells apart look-alike faces."""
+    index = _NearDuplicateIndex(0, size=len(images))
+    distinct, sources = [], []
+    for image in images:
+        image_hash = _dhash(image)
+        match = index.find(image_hash, lambda other: other[1] == image.shape)
+        if match is None:
+            match = (len(distinct), image.shape)
+            index.add(image_hash, match)
+            distinct.append(image)
+        sources.append(match[0])
+    return distinct, sources
+
+# --- Face Batch Helpers ---
+def _extract_faces(frame: np.ndarray, faces) -> list:
+    """Clamps YuNet detections to the frame and returns (box, confidence, face_roi) for every usable face."""
+    (h, w) = frame.shape[:2]
+    extracted = []
+    if faces is None:
+        return extracted
+    for face in faces:
+        box = face[0:4].astype(np.int32)
+        confidence = float(face[14])
+
+        # Clamp box coordinates
+        x, y, w_box, h_box = box
+        startX = max(0, x)
+        startY = max(0, y)
+        endX = min(w - 1, x + w_box)
+        endY = min(h - 1, y + h_box)
+        w_box = endX - startX
+        h_box = endY - startY
+
+        if w_box > 0 and h_box > 0:
+            face_roi = frame[startY:endY, startX:endX]
+            if face_roi.shape[0] > 0 and face_roi.shape[1] > 0:
+                extracted.append(((startX, startY, endX, endY), confidence, face_roi))
+    return extracted
+
+def _allocate_face_batch(size: int) -> np.ndarray:
+    return np.empty((size, CLASSIFIER_INPUT_SIZE[1], CLASSIFIER_INPUT_SIZE[0], 3), dtype=np.float32)
+
+def _prepare_face_batch(face_rois: list, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Resizes BGR face crops into rows of a (N, 256, 256, 3) float32 RGB batch scaled to [0, 1].
+
+    Rows are written into `out` when given (it must have room for every crop), otherwise into a freshly
+    preallocated batch. Crops that fail to convert are skipped, so the returned view may be shorter than `face_rois`.
+    """
+    if out is None:
+        out = _allocate_face_batch(len(face_rois))
+    count = 0
+    for face_roi in face_rois:
+        try:
+            # Resizing works per channel, so resizing first and swapping BGR->RGB afterwards matches the old cvtColor+resize
+            face_resized = cv2.resize(face_roi, CLASSIFIER_INPUT_SIZE)
+            out[count] = face_resized[:, :, ::-1]
+            count += 1
+        except Exception as prep_err:
+            logger.warning(f"Could not prepare face ROI of shape {face_roi.shape}: {prep_err}")
+    batch = out[:count]
+    batch /= 255.0
+    return batch
+
+def _predict_face_batch(face_batch: np.ndarray) -> list:
+    """Scores every row of a prepared face batch with a single classifier call."""
+    if len(face_batch) == 0:
+        return []
+    if inference_scheduler is not None:
+        # Shares the classifier call with face batches from other in-flight requests
+        predictions = inference_scheduler.predict(face_batch)
+    else:
+        with classifier_lock:
+            predictions = loaded_model.predict(face_batch)
+    return list(predictions[:, 0])
+
+class _EarlyExitMonitor:
+    """Running mean and confidence interval (Welford) of per-frame scores, deciding when the label is settled."""
+
+    def __init__(self, video_fps: float, min_frames: int = EARLY_EXIT_MIN_FRAMES,
+                 min_seconds: float = EARLY_EXIT_MIN_SECONDS, z: float = EARLY_EXIT_Z):
+        self.video_fps = video_fps
+        self.min_frames = max(2, min_frames)
+        self.min_seconds = min_seconds
+        self.z = z
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._first_frame_id = None
+
+    def interval(self) -> Tuple[float, float]:
+        if self.count < 2:
+            return (0.0, 1.0)
+        half_width = self.z * float(np.sqrt(self._m2 / (self.count - 1) / self.count))
+        return (self.mean - half_width, self.mean + half_width)
+
+    def update(self, frame_id: int, score: float) -> bool:
+        """Adds a frame's average score; True once the verdict can no longer be expected to flip."""
+        if self._first_frame_id is None:
+            self._first_frame_id = frame_id
+        self.count += 1
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (score - self.mean)
+        if self.count < self.min_frames:
+            return False
+        if (frame_id - self._first_frame_id) / self.video_fps < self.min_seconds:
+            return False
+        low, high = self.interval()
+        return low > 0.5 or high < 0.5
+
+class _VideoScoreAccumulator:
+    """Collects face crops from consecutive sampled frames and scores them in shared classifier batches.
+
+    Scores are mapped back to their frames in order, so the per-frame averages are the same as scoring each face alone.
+    With an early-exit monitor, frames after the one that settled the verdict are ignored and `settled` is set,
+    so the result does not depend on how frames were batched. With a dedup distance >= 0, crops close to a
+    recent crop of the same face (same track, or a box overlapping its box) share its score, and frames marked
+    as duplicates (see add_duplicate) repeat an earlier frame.
+    """
+
+    def __init__(self, batch_size: int = VIDEO_INFERENCE_BATCH_SIZE, on_frame: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 early_exit: Optional[_EarlyExitMonitor] = None, timings: Optional[StageTimings] = None,
+                 dedup_distance: int = -1):
+        self.batch_size = max(1, batch_size)
+        self.on_frame = on_frame # Called with a progress dict for every frame as soon as it is scored
+        self.early_exit = early_exit
+        self.timings = timings
+        self.settled = False
+        self._prediction_sum = 0.0
+        self.frame_avg_predictions = []
+        self.frame_avg_face_confidences = []
+        self.processed_frame_count = 0
+        self.reused_frame_count = 0
+        self.reused_face_count = 0
+        self.first_raw_frame = None
+        self.first_frame_all_boxes = None # Store list of boxes for the first frame
+        self.track_history = {} # track_id -> {"scores", "confidences", "first_frame_id", "last_frame_id"}
+        self._buffer = _allocate_face_batch(self.batch_size)
+        # Each face gets a [buffer row, score] slot: the row until its batch is scored, then the score. Near-identical
+        # crops of the same face share one slot; the crop index maps dHashes of recent crops to (slot, box, track_id).
+        self._crop_index = _NearDuplicateIndex(dedup_distance) if dedup_distance >= 0 else None
+        self._frame_records = OrderedDict() # frame_id -> (boxes, confidences, track_ids, scores) of recent scored frames
+        self._pending = [] # (frame_id, frame, boxes, confidences, track_ids, slots, reused_faces, duplicate_of)
+        self._pending_rows = 0
+
+    def add_frame(self, frame_id: int, frame: np.ndarray, boxes: list, confidences: list, face_batch: Optional[np.ndarray],
+                  track_ids: Optional[list] = None, crop_hashes: Optional[list] = None) -> None:
+        """Queues a frame's prepared face batch (see _prepare_face_batch); frames must be added in frame order.
+
+        `track_ids`, when given, names the track of every row so its score is also kept in that track's history.
+        `crop_hashes` (the dHash of every row) lets rows reuse the score of a near-identical recent crop, as long
+        as that crop is in the same track or its box overlaps the row's box by at least TRACK_IOU_THRESHOLD.
+        """
+        if face_batch is None or len(face_batch) == 0:
+            return
+        if self._pending and self._pending_rows + len(face_batch) > len(self._buffer):
+            self.flush()
+        if len(face_batch) > len(self._buffer):
+            # A single frame with more faces than the batch size gets a buffer of its own size
+            self._buffer = _allocate_face_batch(len(face_batch))
+        reused_faces = 0
+        if self._crop_index is None or crop_hashes is None:
+            self._buffer[self._pending_rows:self._pending_rows + len(face_batch)] = face_batch
+            slots = [[self._pending_rows + row, None] for row in range(len(face_batch))]
+            self._pending_rows += len(face_batch)
+        else:
+            slots = []
+            for row, (face_row, crop_hash) in enumerate(zip(face_batch, crop_hashes)):
+                box, track_id = boxes[row], track_ids[row] if track_ids is not None else None
+                # Different faces can look alike at dHash resolution, so only the same face may share a score
+                match = self._crop_index.find(crop_hash, lambda other: (track_id is not None and other[2] == track_id)
+                                              or _box_iou(box, other[1]) >= TRACK_IOU_THRESHOLD)
+                slot = match[0] if match is not None else None
+                if slot is not None and slot[0] is None and slot[1] is None:
+                    slot = None # Its batch failed to score
+                if slot is None:
+                    self._buffer[self._pending_rows] = face_row
+                    slot = [self._pending_rows, None]
+                    self._pending_rows += 1
+                    self._crop_index.add(crop_hash, (slot, box, track_id))
+                else:
+                    reused_faces += 1
+                slots.append(slot)
+        self._queue(frame_id, frame, boxes, confidences, track_ids, slots, reused_faces, None)
+
+    def add_duplicate(self, frame_id: int, frame: np.ndarray, duplicate_of: int) -> None:
+        """Queues a frame that repeats the boxes and scores of the earlier frame `duplicate_of`.
+
+        Nothing is recorded for it if that frame had no scored faces (or is no longer among the recent ones).
+        """
+        self._queue(frame_id, frame, None, None, None, [], 0, duplicate_of)
+
+    def _queue(self, frame_id, frame, boxes, confidences, track_ids, slots, reused_faces, duplicate_of) -> None:
+        # Only frames that may still become the stored first frame need to be kept alive until scored
+        kept_frame = frame if self.first_raw_frame is None else None
+        self._pending.append((frame_id, kept_frame, boxes, confidences, track_ids, slots, reused_faces, duplicate_of))
+        if self._pending_rows >= self.batch_size or not self._pending_rows:
+            # Frames that need no new classifier rows are resolved right away
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, rows = self._pending, self._pending_rows
+        self._pending, self._pending_rows = [], 0
+        if rows:
+            try:
+                with _stage(self.timings, "classify"):
+                    scores = _predict_face_batch(self._buffer[:rows])
+            except Exception as pred_err:
+                frame_ids = [entry[0] for entry in pending]
+                logger.warning(f"Frames {frame_ids}: Could not predict batch of {rows} face ROIs: {pred_err}")
+                for entry in pending:
+                    for slot in entry[5]:
+                        slot[0] = None
+                return
+            for entry in pending:
+                for slot in entry[5]:
+                    if slot[0] is not None:
+                        slot[0], slot[1] = None, scores[slot[0]]
+
+        for frame_id, frame, boxes, confidences, track_ids, slots, reused_faces, duplicate_of in pending:
+            if self.settled:
+                break
+            if duplicate_of is not None:
+                record = self._frame_records.get(duplicate_of)
+                if record is None:
+                    continue
+                boxes, confidences, track_ids, predictions_this_frame = record
+                reused_faces = len(predictions_this_frame)
+                self.reused_frame_count += 1
+                if self.timings is not None:
+                    self.timings.count("frames_reused")
+            else:
+                predictions_this_frame = [slot[1] for slot in slots]
+                if self._crop_index is not None:
+                    self._frame_records[frame_id] = (boxes, confidences, track_ids, predictions_this_frame)
+                    if len(self._frame_records) > DEDUP_CACHE_SIZE:
+                        self._frame_records.popitem(last=False)
+            self.reused_face_count += reused_faces
+            if self.timings is not None and reused_faces:
+                self.timings.count("faces_reused", reused_faces)
+            self._score_frame(frame_id, frame, boxes, confidences, track_ids, predictions_this_frame)
+
+    def _score_frame(self, frame_id: int, frame: Optional[np.ndarray], boxes: list, confidences: list,
+                     track_ids: Optional[list], predictions_this_frame: list) -> None:
+        if track_ids is not None:
+            for track_id, score, confidence in zip(track_ids, predictions_this_frame, confidences):
+                history = self.track_history.setdefault(track_id, {"scores": [], "confidences": [], "first_frame_id": frame_id})
+                history["scores"].append(float(score))
+                history["confidences"].append(confidence)
+                history["last_frame_id"] = frame_id
+
+        row_count = len(predictions_this_frame)
+        avg_pred_for_frame = float(np.mean(predictions_this_frame))
+        avg_conf_for_frame = float(np.mean(confidences))
+        self.frame_avg_predictions.append(avg_pred_for_frame)
+        self.frame_avg_face_confidences.append(avg_conf_for_frame)
+        self.processed_frame_count += 1
+        self._prediction_sum += avg_pred_for_frame
+        if self.timings is not None:
+            self.timings.count("frames_scored")
+            self.timings.count("faces", row_count)
+        if self.early_exit is not None and self.early_exit.update(frame_id, avg_pred_for_frame):
+            self.settled = True
+            logger.info(f"Verdict settled at frame {frame_id} after {self.processed_frame_count} frames; stopping early.")
+
+        # Store the first raw frame and *all* its boxes if not already stored
+        if self.first_raw_frame is None:
+            self.first_raw_frame = frame.copy()
+            self.first_frame_all_boxes = boxes # Store the list of boxes
+            logger.info(f"Stored first frame (ID: {frame_id}) with {len(boxes)} detected faces.")
+
+        if self.on_frame is not None:
+            self.on_frame({
+                "frame_id": frame_id,
+                "prediction": avg_pred_for_frame,
+                "face_confidence": avg_conf_for_frame,
+                "face_count": row_count,
+                "processed_frame_count": self.processed_frame_count,
+                "running_average": self._prediction_sum / self.processed_frame_count,
+            })
+
+    def track_summaries(self) -> list:
+        """Per-track averages over every scored frame the track appeared in, ordered by track id."""
+        return [{
+            "track_id": track_id,
+            "average_prediction": float(np.mean(history["scores"])),
+            "average_face_confidence": float(np.mean(history["confidences"])),
+            "frame_count": len(history["scores"]),
+            "first_frame_id": history["first_frame_id"],
+            "last_frame_id": history["last_frame_id"],
+        } for track_id, history in sorted(self.track_history.items())]
+
+# --- Response Image Rendering ---
+def parse_image_options(form_data) -> Dict[str, Any]:
+    """Builds per-request response image options from form fields, raising HTTP 400 on invalid values."""
+    mode = str(form_data.get("images") or "full").lower()
+    if mode not in RESPONSE_IMAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"'images' must be one of {', '.join(RESPONSE_IMAGE_MODES)}.")
+    if mode == "artifact" and SERVER_WORKERS > 1:
+        raise HTTPException(status_code=400, detail="images=artifact is not available with several server workers: "
+                                                    "the artifact could be fetched from a worker that does not hold it.")
+    options = {"mode": mode}
+    if mode == "thumbnail":
+        try:
+            options["max_side"] = int(form_data.get("thumbnail_max_side") or THUMBNAIL_MAX_SIDE)
+            options["quality"] = int(form_data.get("thumbnail_quality") or THUMBNAIL_QUALITY)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="'thumbnail_max_side' and 'thumbnail_quality' must be integers.")
+        if options["max_side"] < 1 or not 1 <= options["quality"] <= 95:
+            raise HTTPException(status_code=400, detail="'thumbnail_max_side' must be >= 1 and 'thumbnail_quality' between 1 and 95.")
+    return options
+
+def _encode_jpeg(frame: np.ndarray, quality: Optional[int] = None) -> bytes:
+    """Encodes a BGR frame as JPEG with PIL (PIL's default quality unless given)."""
+    (h, w) = frame.shape[:2]
+    buffer = io.BytesIO()
+    save_kwargs = {} if quality is None else {"quality": quality}
+    # PIL swaps BGR->RGB while unpacking the buffer, so no converted copy of the frame is made
+    Image.frombuffer("RGB", (w, h), np.ascontiguousarray(frame), "raw", "BGR", 0, 1).save(buffer, format="JPEG", **save_kwargs)
+    return buffer.getvalue()
+
+def _jpeg_data_url(jpeg_bytes: bytes) -> str:
+    return f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('utf-8')}"
+
+def _downscale(frame: np.ndarray, max_side: Optional[int]) -> Tuple[np.ndarray, float]:
+    (h, w) = frame.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return frame, 1.0
+    scale = max_side / max(h, w)
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA), scale
+
+def _draw_boxes(frame: np.ndarray, boxes: list, scale: float = 1.0) -> np.ndarray:
+    boxed_frame = frame.copy()
+    # Draw all detected boxes
+    for (startX, startY, endX, endY) in boxes:
+        cv2.rectangle(boxed_frame, (int(startX * scale), int(startY * scale)), (int(endX * scale), int(endY * scale)), (0, 255, 0), 2)
+    return boxed_frame
+
+def render_image_variant(frame: np.ndarray, boxes: list, variant: str, max_side: Optional[int] = None,
+                         quality: Optional[int] = None) -> bytes:
+    """JPEG bytes of the "original" or "boxed" variant of a frame, optionally downscaled to max_side."""
+    frame, scale = _downscale(frame, max_side)
+    if variant == "boxed":
+        frame = _draw_boxes(frame, boxes, scale)
+    return _encode_jpeg(frame, quality)
+
+class ArtifactStore:
+    """Keeps raw result frames (and their boxes) for a short time so images are only encoded when fetched."""
+
+    def __init__(self, ttl_seconds: int, max_bytes: int):
+        self.ttl = ttl_seconds
+        self.max_bytes = max_bytes
+        self._items = OrderedDict() # artifact_id -> (frame, boxes, expires_at, downscaled)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _purge(self) -> None:
+        # Caller holds self._lock; entries are in insertion (= expiry) order
+        now = time.monotonic()
+        while self._items:
+            artifact_id, (frame, _, expires_at, _) = next(iter(self._items.items()))
+            if expires_at > now and self._bytes <= self.max_bytes:
+                break
+            self._items.pop(artifact_id)
+            self._bytes -= frame.nbytes
+
+    def put(self, frame: np.ndarray, boxes: list) -> str:
+        """Stores a frame; one larger than the whole store is downscaled to fit instead of being evicted at once."""
+        artifact_id = secrets.token_urlsafe(16)
+        downscaled = frame.nbytes > self.max_bytes
+        if downscaled:
+            # Pixel count scales with the square of the side; the margin covers rounding of the other side
+            max_side = int(max(frame.shape[:2]) * (self.max_bytes / frame.nbytes) ** 0.5 * 0.99)
+            frame, scale = _downscale(frame, max(1, max_side))
+            boxes = [tuple(int(round(v * scale)) for v in box) for box in boxes]
+        with self._lock:
+            self._items[artifact_id] = (frame, list(boxes), time.monotonic() + self.ttl, downscaled)
+            self._bytes += frame.nbytes
+            self._purge()
+        return artifact_id
+
+    def get(self, artifact_id: str) -> Optional[Tuple[np.ndarray, list]]:
+        with self._lock:
+            self._purge()
+            item = self._items.get(artifact_id)
+        return None if item is None else (item[0], item[1])
+
+    def downscaled(self, artifact_id: str) -> bool:
+        """Whether put() had to shrink the frame to fit under ARTIFACT_MAX_MB."""
+        with self._lock:
+            item = self._items.get(artifact_id)
+        return item is not None and item[3]
+
+artifact_store = ArtifactStore(ARTIFACT_TTL_SECONDS, int(ARTIFACT_MAX_MB * 1024 * 1024))
+
+def render_result_images(frame: np.ndarray, boxes: list, image_options: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Optional[str]]:
+    """Returns the (original, boxed) image references for a response, according to the requested image mode.
+
+    "full"/"thumbnail" give base64 JPEG data URLs, "none" gives (None, None) and "artifact" stores the frame
+    and gives its artifact id in both slots.
+    """
+    mode = "full" if image_options is None else image_options["mode"]
+    if mode == "none":
+        return None, None
+    if mode == "artifact":
+        artifact_id = artifact_store.put(frame, boxes)
+        return artifact_id, artifact_id
+    max_side = image_options.get("max_side") if mode == "thumbnail" else None
+    quality = image_options.get("quality") if mode == "thumbnail" else None
+    frame, scale = _downscale(frame, max_side)
+    original_data_url = _jpeg_data_url(_encode_jpeg(frame, quality))
+    boxed_data_url = _jpeg_data_url(_encode_jpeg(_draw_boxes(frame, boxes, scale), quality))
+    return original_data_url, boxed_data_url
+
+def image_result_fields(processing_result: Tuple[float, float, Tuple[int, int, int, int], str, str, Optional[int]]) -> Dict[str, Any]:
+    """The /predict_image response fields for a process_image result."""
+    # Unpack the result tuple (order matches updated process_image return)
+    # Note: face_box is still the box of the highest confidence face for API consistency
+    avg_prediction_score, avg_face_confidence, highest_conf_face_box, corrected_original_base64, boxed_image_base64, reused_face_count = processing_result
+
+    # Label based on the *average* prediction score
+    label = "real" if avg_prediction_score > 0.5 else "fake"
+
+    response = {
+        "prediction": avg_prediction_score, # Return the average score
+        "label": label,
+        "face_confidence": float(avg_face_confidence), # Return average face confidence
+        "face_box": [int(x) for x in highest_conf_face_box], # Return box of highest conf face
+        "corrected_original_base64": corrected_original_base64,
+        "boxed_image_base64": boxed_image_base64 # Image has all boxes drawn
+    }
+    if reused_face_count is not None:
+        response["reused_face_count"] = reused_face_count
+    return response
+
+def add_image_artifact_fields(request: Request, response: Dict[str, Any]) -> None:
+    """Swaps the artifact id that images=artifact leaves in the image fields of a response for artifact URLs."""
+    artifact_id = response["corrected_original_base64"]
+    response.update(corrected_original_base64=None, boxed_image_base64=None)
+    response.update(artifact_fields(request, artifact_id, "corrected_original_url", "boxed_image_url"))
+
+def artifact_fields(request: Request, artifact_id: str, original_field: str, boxed_field: str) -> Dict[str, Any]:
+    """Response fields pointing at the two renderings of an artifact."""
+    fields = {
+        "artifact_id": artifact_id,
+        original_field: str(request.url_for("get_artifact", artifact_id=artifact_id, variant="original")),
+        boxed_field: str(request.url_for("get_artifact", artifact_id=artifact_id, variant="boxed")),
+        "artifact_expires_in": ARTIFACT_TTL_SECONDS,
+    }
+    if artifact_store.downscaled(artifact_id):
+        fields["artifact_downscaled"] = True # Stored below full resolution to fit under ARTIFACT_MAX_MB
+    return fields
+
+# --- Image Decoding ---
+# EXIF orientation -> the flip/rotation that makes the image upright (same mapping as ImageOps.exif_transpose)
+_EXIF_ORIENTATION_FIXES = {
+    2: lambda frame: cv2.flip(frame, 1),
+    3: lambda frame: cv2.rotate(frame, cv2.ROTATE_180),
+    4: lambda frame: cv2.flip(frame, 0),
+    5: cv2.transpose,
+    6: lambda frame: cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE),
+    7: lambda frame: cv2.flip(cv2.transpose(frame), -1),
+    8: lambda frame: cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE),
+}
+_JPEG_REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                              4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def _open_image(file_obj) -> Tuple[Image.Image, int, Tuple[int, int]]:
+    """Reads only the image header: (image, EXIF orientation, upright (w, h))."""
+    pil_image = Image.open(file_obj)
+    orientation = pil_image.getexif().get(0x0112, 1)
+    (w, h) = pil_image.size
+    return pil_image, orientation, ((h, w) if orientation in (5, 6, 7, 8) else (w, h))
+
+def _jpeg_reduction(longest_side: int, needed_side: int) -> int:
+    """The largest JPEG DCT scale-down (1, 2, 4 or 8) that still leaves needed_side pixels."""
+    return next((reduction for reduction in (8, 4, 2) if longest_side // reduction >= needed_side), 1)
+
+def _decode_bgr(file_obj, pil_image: Image.Image, orientation: int, reduction: int = 1) -> np.ndarray:
+    """Decodes an opened image into a single upright BGR array, at 1/reduction of the size for JPEGs.
+
+    Colour JPEGs are decoded by OpenCV straight into BGR (and at a reduced DCT scale when asked); other
+    formats go through PIL with one RGB->BGR conversion. The orientation is applied afterwards, so images
+    without one are never copied again.
+    """
+    frame = None
+    if pil_image.format == "JPEG" and pil_image.mode in ("RGB", "L"):
+        file_obj.seek(0)
+        data = file_obj.getbuffer() if isinstance(file_obj, io.BytesIO) else file_obj.read()
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                             _JPEG_REDUCED_DECODE_FLAGS[reduction] | cv2.IMREAD_IGNORE_ORIENTATION)
+        del data # Releases the BytesIO buffer export
+    if frame is None:
+        rgb_image = pil_image.convert("RGB") if pil_image.mode != "RGB" else pil_image
+        frame = cv2.cvtColor(np.asarray(rgb_image), cv2.COLOR_RGB2BGR)
+    fix_orientation = _EXIF_ORIENTATION_FIXES.get(orientation)
+    return frame if fix_orientation is None else fix_orientation(frame)
+
+def _detection_reduction(pil_image: Image.Image, detection: Optional[Dict[str, Any]],
+                         image_options: Optional[Dict[str, Any]]) -> int:
+    """How far a JPEG can be scaled down while decoding when only detection needs the whole image.
+
+    That is the case with a detection max_side and no full-resolution image in the response; the reduced
+    decode still covers the finest pyramid level and, in thumbnail mode, the thumbnail drawn from it.
+    """
+    mode = "full" if image_options is None else image_options["mode"]
+    max_side = DETECTION_MAX_SIDE if detection is None else detection["max_side"]
+    pyramid_levels = DETECTION_PYRAMID_LEVELS if detection is None else detection["pyramid_levels"]
+    if pil_image.format != "JPEG" or mode in ("full", "artifact") or not max_side:
+        return 1
+    needed_side = max_side * 2 ** (pyramid_levels - 1)
+    if mode == "thumbnail":
+        needed_side = max(needed_side, image_options["max_side"])
+    return _jpeg_reduction(max(pil_image.size), needed_side)
+
+def _scale_box(box: Tuple[int, int, int, int], from_size: Tuple[int, int], to_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    (startX, startY, endX, endY) = box
+    sx, sy = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    return (int(startX * sx), int(startY * sy), min(to_size[0] - 1, int(round(endX * sx))), min(to_size[1] - 1, int(round(endY * sy))))
+
+def _decode_face_crops(file_obj, pil_image: Image.Image, orientation: int, boxes: list, full_size: Tuple[int, int],
+                       draft_frame: np.ndarray, draft_reduction: int) -> list:
+    """BGR crops of `boxes` (full-resolution coordinates), decoded at the coarsest JPEG scale that still
+    leaves the smallest face at least the classifier's input size.
+
+    When the draft decode is already that fine, the crops come from `draft_frame` without decoding again.
+    Otherwise the image is decoded a second time, at full size when a face is smaller than the classifier
+    input; such images (e.g. group photos of many small faces) gain nothing from a detection max_side, as
+    the draft decode is then paid on top of a full-resolution one.
+    """
+    smallest_side = min(min(endX - startX, endY - startY) for (startX, startY, endX, endY) in boxes)
+    reduction = _jpeg_reduction(smallest_side, max(CLASSIFIER_INPUT_SIZE))
+    if reduction >= draft_reduction:
+        frame = draft_frame
+    else:
+        frame = _decode_bgr(file_obj, pil_image, orientation, reduction)
+    crops = []
+    for box in boxes:
+        (startX, startY, endX, endY) = _scale_box(box, full_size, (frame.shape[1], frame.shape[0]))
+        # Copied out so a second decoded frame is freed as soon as the crops are taken
+        crops.append(frame[startY:max(endY, startY + 1), startX:max(endX, startX + 1)].copy())
+    return crops
+
 # --- Image Processing Function ---
-def process_image(file_obj) -> Optional[Tuple[float, float, Tuple[int, int, int, int], str, str]]:
-    """Processes an image file, detects all faces using YuNet, predicts for each, averages results, and returns."""
-    if face_net is None:
+def process_image(file_obj, detection: Optional[Dict[str, Any]] = None,
+                  image_options: Optional[Dict[str, Any]] = None,
+                  timings: Optional[StageTimings] = None) -> Optional[Tuple[float, float, Tuple[int, int, int, int], str, str, Optional[int]]]:
+    """Processes an image file, detects all faces using YuNet, predicts for each, averages results, and returns.
+
+    `detection` controls the detection resolution (see parse_detection_options) and whether repeated faces
+    are scored once (see parse_dedup_options); `image_options` which images come back (see parse_image_options
+    and render_result_images). When neither needs the full resolution, large JPEGs are decoded at a reduced
+    scale and only the faces again at a finer one (see _detection_reduction). Stage durations are added to
+    `timings`, which the caller then reports; without it they are reported to /metrics directly.
+    """
+    if not face_detector_loaded:
         raise RuntimeError("Face detection model failed to load. Cannot process image.")
 
+    owns_timings = timings is None
+    if owns_timings:
+        timings = StageTimings("image")
     try:
-        pil_image = Image.open(file_obj).convert("RGB")
-        logger.info("Applying EXIF transpose...")
-        pil_image_corrected = ImageOps.exif_transpose(pil_image)
-        logger.info("EXIF transpose applied.")
-
-        original_frame = np.array(pil_image_corrected)
-        original_frame = original_frame[:, :, ::-1].copy()
-        frame_for_detection = original_frame.copy()
+        with timings.stage("total"):
+            return _process_image(file_obj, detection, image_options, timings)
+    finally:
+        if owns_timings:
+            timings.report()
 
-        (h, w) = frame_for_detection.shape[:2]
+def _process_image(file_obj, detection: Optional[Dict[str, Any]], image_options: Optional[Dict[str, Any]],
+                   timings: StageTimings) -> Optional[Tuple[float, float, Tuple[int, int, int, int], str, str, Optional[int]]]:
+    try:
+        with timings.stage("decode"):
+            pil_image, orientation, full_size = _open_image(file_obj)
+            # Large JPEGs that are only needed for detection are decoded at a reduced scale
+            reduction = _detection_reduction(pil_image, detection, image_options)
+            # The one upright BGR frame that detection, the crops and the result images all read from
+            original_frame = _decode_bgr(file_obj, pil_image, orientation, reduction)
+
+        (h, w) = original_frame.shape[:2]
         if h == 0 or w == 0:
             logger.warning("Warning: Invalid image dimensions received.")
             return None
 
         # --- YuNet Face Detection ---
-        face_net.setInputSize((w, h))
         logger.info("Running YuNet face detection...")
-        results = face_net.detect(frame_for_detection)
-        faces = results[1]
-        logger.info(f"YuNet detected {len(faces) if faces is not None else 0} faces initially.")
+        with timings.stage("detect"):
+            detected_faces = detect_faces(original_frame, detection)
+        logger.info(f"YuNet detected {len(detected_faces)} usable faces.")
+        frame_boxes = [box for box, _, _ in detected_faces] # Boxes in original_frame coordinates, for the result images
+        if detected_faces and (w, h) != full_size:
+            # Detected on a draft decode: report full-resolution boxes and crop the faces from a finer decode
+            with timings.stage("crop_decode"):
+                full_boxes = [_scale_box(box, (w, h), full_size) for box in frame_boxes]
+                full_rois = _decode_face_crops(file_obj, pil_image, orientation, full_boxes, full_size, original_frame, reduction)
+            detected_faces = [(box, confidence, roi) for box, (_, confidence, _), roi in zip(full_boxes, detected_faces, full_rois)]
 
         all_prediction_scores = []
         all_face_confidences = []
         all_boxes = [] # Store all boxes (startX, startY, endX, endY)
+        face_rois = []
         highest_confidence = 0.0
         box_of_highest_confidence_face = None
 
-        if faces is not None:
-            for face in faces:
-                box = face[0:4].astype(np.int32)
-                confidence = float(face[14])
-
-                # Clamp box coordinates
-                x, y, w_box, h_box = box
-                startX = max(0, x)
-                startY = max(0, y)
-                endX = min(w - 1, x + w_box)
-                endY = min(h - 1, y + h_box)
-                w_box = endX - startX
-                h_box = endY - startY
-
-                if w_box > 0 and h_box > 0:
-                    face_roi = frame_for_detection[startY:endY, startX:endX]
-                    if face_roi.shape[0] > 0 and face_roi.shape[1] > 0:
-                        current_box = (startX, startY, endX, endY)
-                        all_boxes.append(current_box)
-                        all_face_confidences.append(confidence)
-
-                        # Keep track of the box for the highest confidence face for API return consistency
-                        if confidence > highest_confidence:
-                            highest_confidence = confidence
-                            box_of_highest_confidence_face = current_box
-
-                        # --- Prepare and Predict for *this* face ---
-                        try:
-                            face_rgb = cv2.cvtColor(face_roi, cv2.COLOR_BGR2RGB)
-                            face_rgb_resized = cv2.resize(face_rgb, (256, 256))
-                            image_array = img_to_array(face_rgb_resized)
-                            image_array = np.expand_dims(image_array, axis=0)
-                            image_array /= 255.0
-                            prediction_score = loaded_model.predict(image_array)[0][0]
-                            all_prediction_scores.append(prediction_score)
-                            logger.debug(f"Processed face at {current_box} - Confidence: {confidence:.4f}, Pred Score: {prediction_score:.4f}")
-                        except Exception as pred_err:
-                            logger.warning(f"Could not process/predict face ROI at {current_box}: {pred_err}")
+        for current_box, confidence, face_roi in detected_faces:
+            all_boxes.append(current_box)
+            all_face_confidences.append(confidence)
+            face_rois.append(face_roi)
+
+            # Keep track of the box for the highest confidence face for API return consistency
+            if confidence > highest_confidence:
+                highest_confidence = confidence
+                box_of_highest_confidence_face = current_box
+
+        # --- Prepare and Predict all faces with a single classifier call ---
+        reused_face_count = None
+        if face_rois:
+            try:
+                crop_sources = None
+                if _dedup_distance(detection) >= 0:
+                    # Repeated faces (collages, tiled images) are scored once
+                    with timings.stage("dedup"):
+                        face_rois, crop_sources = _group_repeated_crops(face_rois)
+                    reused_face_count = len(crop_sources) - len(face_rois)
+                    timings.count("faces_reused", reused_face_count)
+                with timings.stage("preprocess"):
+                    face_batch = _prepare_face_batch(face_rois)
+                with timings.stage("classify"):
+                    all_prediction_scores = _predict_face_batch(face_batch)
+                if crop_sources is not None and len(all_prediction_scores) == len(face_rois):
+                    all_prediction_scores = [all_prediction_scores[source] for source in crop_sources]
+                logger.debug(f"Predicted {len(all_prediction_scores)} faces in one batch - Scores: {all_prediction_scores}")
+            except Exception as pred_err:
+                logger.warning(f"Could not process/predict {len(face_rois)} face ROIs: {pred_err}")
 
         # Check if any faces were successfully processed
+        timings.count("faces", len(all_prediction_scores))
         if not all_prediction_scores:
             logger.warning("Warning: No faces were successfully processed for prediction.")
             return None
@@ -185,147 +1690,463 @@ def process_image(file_obj) -> Optional[Tuple[float, float, Tuple[int, int, int,
         avg_face_confidence = float(np.mean(all_face_confidences))
         logger.info(f"Processed {len(all_prediction_scores)} faces. Avg Pred Score: {avg_prediction_score:.4f}, Avg Face Conf: {avg_face_confidence:.4f}")
 
-        # --- Encode Corrected Original Image (RGB) using PIL ---
-        corrected_original_data_url = None
+        # --- Encode Corrected Original Image and Boxed Image (with ALL detected boxes) ---
         try:
-            original_frame_rgb = cv2.cvtColor(original_frame, cv2.COLOR_BGR2RGB)
-            pil_original_corrected = Image.fromarray(original_frame_rgb)
-            buffer_orig = io.BytesIO()
-            pil_original_corrected.save(buffer_orig, format="JPEG")
-            buffer_orig.seek(0)
-            orig_bytes = buffer_orig.read()
-            orig_base64 = base64.b64encode(orig_bytes).decode('utf-8')
-            corrected_original_data_url = f"data:image/jpeg;base64,{orig_base64}"
-            logger.info(f"Encoded corrected original image to base64 JPEG.")
-        except Exception as pil_orig_error:
-            logger.error(f"Failed to encode corrected original image: {pil_orig_error}", exc_info=True)
+            with timings.stage("encode"):
+                corrected_original_data_url, boxed_image_data_url = render_result_images(original_frame, frame_boxes, image_options)
+            logger.info(f"Rendered result images ({'full' if image_options is None else image_options['mode']}) with {len(all_boxes)} boxes.")
+        except Exception as render_error:
+            logger.error(f"Failed to encode result images: {render_error}", exc_info=True)
             return None
 
-        # --- Create and Encode Boxed Image (with ALL detected boxes) --- 
-        boxed_image_data_url = None
-        try:
-            boxed_frame = original_frame.copy()
-            # Draw all detected boxes
-            for box_coords in all_boxes:
-                (startX, startY, endX, endY) = box_coords
-                cv2.rectangle(boxed_frame, (startX, startY), (endX, endY), (0, 255, 0), 2)
-
-            boxed_frame_rgb = cv2.cvtColor(boxed_frame, cv2.COLOR_BGR2RGB)
-            pil_boxed_image = Image.fromarray(boxed_frame_rgb)
-            buffer_boxed = io.BytesIO()
-            pil_boxed_image.save(buffer_boxed, format="JPEG")
-            buffer_boxed.seek(0)
-            boxed_bytes = buffer_boxed.read()
-            boxed_image_base64 = base64.b64encode(boxed_bytes).decode('utf-8')
-            boxed_image_data_url = f"data:image/jpeg;base64,{boxed_image_base64}"
-            logger.info(f"Encoded boxed image with {len(all_boxes)} boxes to base64 JPEG.")
-        except Exception as pil_boxed_error:
-             logger.error(f"Failed to encode boxed image: {pil_boxed_error}", exc_info=True)
-             return None
-
-        # Return avg prediction, avg face confidence, box of highest confidence face, corrected original base64, boxed (all faces) base64
+        # Return avg prediction, avg face confidence, box of highest confidence face, corrected original base64, boxed (all faces) base64,
+        # and how many faces reused another face's score (None without dedup)
         if box_of_highest_confidence_face is None:
              # Fallback if somehow no boxes were recorded but predictions were made
              box_of_highest_confidence_face = (0, 0, 0, 0)
-        return avg_prediction_score, avg_face_confidence, box_of_highest_confidence_face, corrected_original_data_url, boxed_image_data_url
+        return avg_prediction_score, avg_face_confidence, box_of_highest_confidence_face, corrected_original_data_url, boxed_image_data_url, reused_face_count
 
     except Exception as e:
         logger.error(f"Error in process_image: {e}", exc_info=True)
         return None
 
-# --- Video Processing Function ---
-def process_video(video_path: str) -> Optional[Dict[str, Any]]:
-    """Processes a video file, detects all faces/frame, predicts for each, averages results."""
-    if face_net is None:
-        raise RuntimeError("Face detection model failed to load. Cannot process video.")
-
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        logger.error(f"Error opening video file: {video_path}")
-        return None
-
-    # Store per-frame averages
-    frame_avg_predictions = []
-    frame_avg_face_confidences = []
-    processed_frame_count = 0
-    frame_skip = 5
-
-    first_raw_frame = None
-    first_frame_all_boxes = None # Store list of boxes for the first frame
-
+# --- Video Frame Sampling ---
+def _sample_frame_ids(cap: cv2.VideoCapture, sampling: Dict[str, Any]) -> Iterator[int]:
+    """Yields the increasing frame indices to sample; open-ended iterators stop when the video runs out."""
+    mode = sampling["mode"]
+    if mode == "fps":
+        video_fps = cap.get(cv2.CAP_PROP_FPS)
+        if video_fps > 0:
+            step = max(1.0, video_fps / sampling["fps"])
+            return (int(k * step) for k in itertools.count())
+        logger.warning("Video reports no FPS; falling back to frame_skip sampling.")
+    elif mode == "count":
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count > 0:
+            ids = np.linspace(0, frame_count - 1, num=min(sampling["count"], frame_count))
+            return iter(sorted(set(int(round(i)) for i in ids)))
+        logger.warning("Video reports no frame count; falling back to frame_skip sampling.")
+    return itertools.count(0, sampling["frame_skip"])
+
+def _iter_sampled_frames(cap: cv2.VideoCapture, sampling: Dict[str, Any],
+                         timings: Optional[StageTimings] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yields (frame_id, frame) for sampled frames only.
+
+    Frames in between are passed with grab(), which skips retrieve()'s BGR conversion and copy, or, when
+    seeking is enabled and the gap is long, jumped over by seeking to the target timestamp. A seek can land
+    past its target; the frame it lands on is then yielded under its own index, and sampled indices it
+    already passed are skipped.
+    """
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    seek = sampling.get("seek", False) and video_fps > 0
+    position = 0 # Index of the frame the next grab()/read() returns
+    for frame_id in _sample_frame_ids(cap, sampling):
+        if frame_id < position:
+            continue
+        with _stage(timings, "decode"):
+            if seek and frame_id - position > VIDEO_SEEK_MIN_GAP_FRAMES:
+                if cap.set(cv2.CAP_PROP_POS_MSEC, frame_id * 1000.0 / video_fps):
+                    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+            grabbed = 0
+            while position < frame_id and cap.grab():
+                position += 1
+                grabbed += 1
+            ret, frame = cap.read() if position >= frame_id else (False, None)
+        if timings is not None:
+            timings.count("frames_decoded", grabbed + int(ret))
+            timings.count("frames_sampled", int(ret))
+        if not ret:
+            return
+        frame_id = position # Past the requested frame only when a seek overshot
+        position += 1
+        yield frame_id, frame
+
+def parse_video_sampling(form_data) -> Dict[str, Any]:
+    """Builds per-request sampling options from form fields, raising HTTP 400 on invalid values."""
+    sampling = dict(VIDEO_DEFAULT_SAMPLING)
+    mode = str(form_data.get("sample_mode") or sampling["mode"]).lower()
+    if mode not in VIDEO_SAMPLE_MODES:
+        raise HTTPException(status_code=400, detail=f"'sample_mode' must be one of {', '.join(VIDEO_SAMPLE_MODES)}.")
+    sampling["mode"] = mode
+    try:
+        if form_data.get("frame_skip"):
+            sampling["frame_skip"] = int(form_data["frame_skip"])
+        if form_data.get("sample_fps"):
+            sampling["fps"] = float(form_data["sample_fps"])
+        if form_data.get("sample_count"):
+            sampling["count"] = int(form_data["sample_count"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'frame_skip', 'sample_fps' and 'sample_count' must be numbers.")
+    if sampling["frame_skip"] < 1:
+        raise HTTPException(status_code=400, detail="'frame_skip' must be at least 1.")
+    if mode == "fps" and not (sampling["fps"] and sampling["fps"] > 0):
+        raise HTTPException(status_code=400, detail="'sample_fps' must be a positive number when sample_mode is 'fps'.")
+    if mode == "count" and not (sampling["count"] and sampling["count"] > 0):
+        raise HTTPException(status_code=400, detail="'sample_count' must be a positive integer when sample_mode is 'count'.")
+    sampling["seek"] = str(form_data.get("seek", "")).lower() in ("1", "true", "yes", "on")
+    early_exit = form_data.get("early_exit")
+    sampling["early_exit"] = EARLY_EXIT_DEFAULT if early_exit is None else str(early_exit).lower() in ("1", "true", "yes", "on")
+    return sampling
+
+# --- Face Tracking ---
+def parse_tracking_options(form_data) -> Dict[str, Any]:
+    """Reads the video-only `track_interval` form field, raising HTTP 400 on invalid values."""
+    track_interval = TRACK_DETECT_INTERVAL
+    try:
+        if form_data.get("track_interval"):
+            track_interval = int(form_data["track_interval"])
+    except ValueError:
+        raise HTTPException(status_code=400, detail="'track_interval' must be an integer.")
+    if track_interval < 0:
+        raise HTTPException(status_code=400, detail="'track_interval' must be >= 0.")
+    return {"track_interval": track_interval}
+
+def _box_iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    inter_w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    inter_h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+class _FaceTracker:
+    """Follows faces across consecutive sampled frames so YuNet only runs every `detect_interval` frames.
+
+    Between detections each track's box is shifted by the median optical-flow motion of corner features inside
+    it and keeps the confidence of its last detection. A scene cut, a lost track or the interval running out
+    triggers a fresh detection, whose faces continue existing tracks by IoU. Frames must be passed in order.
+    """
+
+    def __init__(self, detect_interval: int, detection: Optional[Dict[str, Any]] = None):
+        self.detect_interval = max(1, detect_interval)
+        self.detection = detection
+        self.detector_runs = 0
+        self.tracked_frames = 0
+        self.scene_cuts = 0
+        self._tracks = [] # [track_id, box, confidence]
+        self._next_track_id = 0
+        self._since_detection = 0
+        self._prev_gray = None
+        self._prev_scale = 1.0
+
+    def _small_gray(self, frame: np.ndarray) -> Tuple[np.ndarray, float]:
+        (h, w) = frame.shape[:2]
+        scale = min(1.0, TRACK_FLOW_MAX_SIDE / max(h, w))
+        if scale < 1.0:
+            frame = cv2.resize(frame, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), scale
+
+    def _follow(self, gray: np.ndarray, frame_shape: Tuple[int, ...]) -> Optional[list]:
+        """Moves every track's box along the optical flow; None if any track could not be followed."""
+        scale = self._prev_scale
+        (h, w) = frame_shape[:2]
+        track_points = []
+        for _, (startX, startY, endX, endY), _ in self._tracks:
+            x0, y0 = int(startX * scale), int(startY * scale)
+            x1, y1 = max(x0 + 1, int(endX * scale)), max(y0 + 1, int(endY * scale))
+            corners = cv2.goodFeaturesToTrack(self._prev_gray[y0:y1, x0:x1], maxCorners=30, qualityLevel=0.01, minDistance=3)
+            if corners is None or len(corners) < TRACK_MIN_FLOW_POINTS:
+                return None
+            track_points.append(corners.reshape(-1, 2) + np.array([x0, y0], dtype=np.float32))
+
+        points = np.concatenate(track_points).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        status = status.reshape(-1).astype(bool)
+        moved = moved.reshape(-1, 2)
+        points = points.reshape(-1, 2)
+
+        boxes = []
+        offset = 0
+        for (_, (startX, startY, endX, endY), _), track_pts in zip(self._tracks, track_points):
+            ok = status[offset:offset + len(track_pts)]
+            motion = (moved[offset:offset + len(track_pts)] - points[offset:offset + len(track_pts)])[ok]
+            offset += len(track_pts)
+            if len(motion) < TRACK_MIN_FLOW_POINTS:
+                return None
+            dx, dy = (np.median(motion, axis=0) / scale).tolist()
+            box = (max(0, int(round(startX + dx))), max(0, int(round(startY + dy))),
+                   min(w - 1, int(round(endX + dx))), min(h - 1, int(round(endY + dy))))
+            if box[2] <= box[0] or box[3] <= box[1]:
+                return None
+            boxes.append(box)
+        return boxes
+
+    def _associate(self, faces: list) -> None:
+        """Replaces the tracks with fresh detections, keeping the track id of the best-overlapping old box."""
+        pairs = sorted(((_box_iou(track[1], face[0]), t, f) for t, track in enumerate(self._tracks) for f, face in enumerate(faces)), reverse=True)
+        track_ids = [None] * len(faces)
+        used_tracks = set()
+        for iou, t, f in pairs:
+            if iou < TRACK_IOU_THRESHOLD:
+                break
+            if t not in used_tracks and track_ids[f] is None:
+                track_ids[f] = self._tracks[t][0]
+                used_tracks.add(t)
+        for f in range(len(faces)):
+            if track_ids[f] is None:
+                track_ids[f] = self._next_track_id
+                self._next_track_id += 1
+        self._tracks = [[track_id, box, confidence] for track_id, (box, confidence, _) in zip(track_ids, faces)]
+
+    def update(self, frame: np.ndarray) -> list:
+        """Returns (track_id, box, confidence, face_roi) for every face in the next sampled frame."""
+        gray, scale = self._small_gray(frame)
+        if self._prev_gray is not None and self._prev_gray.shape == gray.shape:
+            if float(np.mean(cv2.absdiff(gray, self._prev_gray))) / 255.0 > TRACK_SCENE_CUT_THRESHOLD:
+                self.scene_cuts += 1
+                self._tracks = []
+
+        boxes = None
+        if self._tracks and self._since_detection < self.detect_interval:
+            boxes = self._follow(gray, frame.shape)
+        self._prev_gray, self._prev_scale = gray, scale
+
+        if boxes is None:
+            faces = detect_faces(frame, self.detection)
+            self.detector_runs += 1
+            self._since_detection = 1
+            self._associate(faces)
+            return [(track[0], box, confidence, face_roi) for track, (box, confidence, face_roi) in zip(self._tracks, faces)]
+
+        self.tracked_frames += 1
+        self._since_detection += 1
+        results = []
+        for track, box in zip(self._tracks, boxes):
+            track[1] = box
+            startX, startY, endX, endY = box
+            results.append((track[0], box, track[2], frame[startY:endY, startX:endX]))
+        return results
+
+# --- Video Pipeline Stages ---
+_PIPELINE_DONE = object() # End-of-stream marker passed between pipeline stages
+
+def _put_until_stopped(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Blocking put that gives up once the pipeline is stopped, so no stage waits on a dead consumer."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get_until_stopped(q: queue.Queue, stop_event: threading.Event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_DONE
+
+def _decode_stage(cap: cv2.VideoCapture, sampling: Dict[str, Any], frame_queue: queue.Queue, detector_count: int,
+                  stop_event: threading.Event, errors: list, timings: Optional[StageTimings] = None,
+                  dedup_distance: int = -1) -> None:
+    """Decoder thread: pushes (seq, frame_id, frame, duplicate_of) for every sampled frame, then one end marker per detector.
+
+    With a dedup distance >= 0, `duplicate_of` is the id of a recent frame this one nearly repeats, else None.
+    Frames are marked here, in decoding order, so the marks do not depend on the number of detector workers.
+    """
+    frame_index = _NearDuplicateIndex(dedup_distance) if dedup_distance >= 0 else None
+    try:
+        for seq, (frame_id, frame) in enumerate(_iter_sampled_frames(cap, sampling, timings)):
+            duplicate_of = None
+            if frame_index is not None and frame.size:
+                with _stage(timings, "dedup"):
+                    frame_hash = _dhash(frame)
+                    duplicate_of = frame_index.find(frame_hash)
+                    if duplicate_of is None:
+                        frame_index.add(frame_hash, frame_id)
+            if not _put_until_stopped(frame_queue, (seq, frame_id, frame, duplicate_of), stop_event):
+                return
+    except Exception as decode_err:
+        logger.error(f"Video decode stage failed: {decode_err}", exc_info=True)
+        errors.append(decode_err)
+    finally:
+        for _ in range(detector_count):
+            _put_until_stopped(frame_queue, _PIPELINE_DONE, stop_event)
+
+def _detect_stage(frame_queue: queue.Queue, crop_queue: queue.Queue, detection: Optional[Dict[str, Any]],
+                  stop_event: threading.Event, errors: list, tracker: Optional[_FaceTracker] = None,
+                  timings: Optional[StageTimings] = None) -> None:
+    """Detector worker: runs YuNet (or the tracker) on decoded frames and pushes each frame's boxes and prepared face batch.
+
+    Every frame produces an item, even without faces, so the classifier stage can restore frame order. Frames
+    marked as duplicates skip detection (and the tracker) and are passed on for the classifier stage to resolve.
+    """
+    hash_crops = _dedup_distance(detection) >= 0
     try:
         while True:
-            frame_id = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
-            ret, frame = cap.read()
-            if not ret:
+            item = _get_until_stopped(frame_queue, stop_event)
+            if item is _PIPELINE_DONE:
                 break
-            if frame_id % frame_skip != 0:
-                continue
+            seq, frame_id, frame, duplicate_of = item
 
+            # Store results for *this frame*
+            boxes_this_frame = [] # (startX, startY, endX, endY)
+            confidences_this_frame = []
+            track_ids = None
+            face_batch = None
+            crop_hashes = None
             (h, w) = frame.shape[:2]
             if h == 0 or w == 0:
                 logger.warning(f"Frame {frame_id}: Invalid dimensions, skipping.")
+            elif duplicate_of is None:
+                # --- YuNet Face Detection for the frame ---
+                rois_this_frame = []
+                with _stage(timings, "detect"):
+                    if tracker is not None:
+                        faces = tracker.update(frame)
+                        track_ids = [face[0] for face in faces]
+                    else:
+                        faces = [(None,) + face for face in detect_faces(frame, detection)]
+                for _, current_box, confidence, face_roi in faces:
+                    boxes_this_frame.append(current_box)
+                    confidences_this_frame.append(confidence)
+                    rois_this_frame.append(face_roi)
+                if rois_this_frame:
+                    with _stage(timings, "preprocess"):
+                        face_batch = _prepare_face_batch(rois_this_frame)
+                    if track_ids is not None and len(face_batch) != len(track_ids):
+                        logger.warning(f"Frame {frame_id}: Some face ROIs could not be prepared; its scores are left out of the tracks.")
+                        track_ids = None
+                    if hash_crops and len(face_batch) == len(rois_this_frame):
+                        with _stage(timings, "dedup"):
+                            crop_hashes = [_dhash(face_roi) for face_roi in rois_this_frame]
+
+            item = (seq, frame_id, frame, boxes_this_frame, confidences_this_frame, face_batch, track_ids, crop_hashes, duplicate_of)
+            if not _put_until_stopped(crop_queue, item, stop_event):
+                return
+    except Exception as detect_err:
+        logger.error(f"Video detection stage failed: {detect_err}", exc_info=True)
+        errors.append(detect_err)
+        stop_event.set()
+    finally:
+        _put_until_stopped(crop_queue, _PIPELINE_DONE, stop_event)
+
+def _run_video_pipeline(cap: cv2.VideoCapture, sampling: Dict[str, Any], detection: Optional[Dict[str, Any]],
+                        accumulator: _VideoScoreAccumulator, tracker: Optional[_FaceTracker] = None,
+                        timings: Optional[StageTimings] = None) -> None:
+    """Runs decode -> detect -> classify as concurrent stages; classification happens on the calling thread.
+
+    Frames reach the accumulator in their original order, so results match a sequential pass. A tracker
+    needs to see frames in order, so tracking uses a single detector worker.
+    """
+    detector_count = 1 if tracker is not None else max(1, VIDEO_DETECTOR_WORKERS)
+    frame_queue = queue.Queue(maxsize=max(1, VIDEO_PIPELINE_QUEUE_SIZE))
+    crop_queue = queue.Queue(maxsize=max(1, VIDEO_PIPELINE_QUEUE_SIZE))
+    stop_event = threading.Event()
+    errors = []
+
+    threads = [threading.Thread(target=_decode_stage, args=(cap, sampling, frame_queue, detector_count, stop_event, errors, timings,
+                                                            _dedup_distance(detection)),
+                                name="video-decode", daemon=True)]
+    threads += [threading.Thread(target=_detect_stage, args=(frame_queue, crop_queue, detection, stop_event, errors, tracker, timings),
+                                 name=f"video-detect-{i}", daemon=True) for i in range(detector_count)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished_detectors = 0
+        next_seq = 0
+        reorder_buffer = {} # seq -> detector output that arrived ahead of an earlier frame
+        while finished_detectors < detector_count:
+            item = _get_until_stopped(crop_queue, stop_event)
+            if stop_event.is_set():
+                # A stage failed; its error is raised below
+                break
+            if item is _PIPELINE_DONE:
+                finished_detectors += 1
                 continue
+            reorder_buffer[item[0]] = item
+            while next_seq in reorder_buffer:
+                _, frame_id, frame, boxes, confidences, face_batch, track_ids, crop_hashes, duplicate_of = reorder_buffer.pop(next_seq)
+                next_seq += 1
+                if duplicate_of is not None:
+                    accumulator.add_duplicate(frame_id, frame, duplicate_of)
+                else:
+                    accumulator.add_frame(frame_id, frame, boxes, confidences, face_batch, track_ids, crop_hashes)
+                if accumulator.settled:
+                    break
+            if accumulator.settled:
+                # Early exit: the finally block stops decoding and detection
+                break
 
-            # --- YuNet Face Detection for the frame ---
-            face_net.setInputSize((w, h))
-            results = face_net.detect(frame)
-            faces = results[1]
+        if not errors:
+            # Score the crops still waiting for a full batch
+            accumulator.flush()
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
 
-            # Store results for *this frame*
-            predictions_this_frame = []
-            confidences_this_frame = []
-            boxes_this_frame = [] # (startX, startY, endX, endY)
+    if errors:
+        raise errors[0]
+
+# --- Video Processing Function ---
+def process_video(video_path: str, sampling: Optional[Dict[str, Any]] = None,
+                  detection: Optional[Dict[str, Any]] = None,
+                  image_options: Optional[Dict[str, Any]] = None,
+                  progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                  timings: Optional[StageTimings] = None) -> Optional[Dict[str, Any]]:
+    """Processes a video file, detects all faces/frame, predicts for each, averages results.
+
+    `sampling` selects which frames are looked at (see parse_video_sampling); defaults to every 5th frame.
+    `detection` controls the detection resolution (see parse_detection_options), whether near-duplicate
+    frames and crops reuse earlier scores (see parse_dedup_options) and, through its `track_interval`,
+    whether faces are tracked between detections (see parse_tracking_options); `image_options`
+    sets how the first frame comes back (see parse_image_options). `progress_callback` receives a dict per
+    scored frame; an exception raised from it aborts processing. Stage durations and frame counts are added
+    to `timings`, which the caller then reports; without it they are reported to /metrics directly.
+    """
+    if sampling is None:
+        sampling = VIDEO_DEFAULT_SAMPLING
+    if not face_detector_loaded:
+        raise RuntimeError("Face detection model failed to load. Cannot process video.")
+
+    owns_timings = timings is None
+    if owns_timings:
+        timings = StageTimings("video")
+    try:
+        with timings.stage("total"):
+            return _process_video(video_path, sampling, detection, image_options, progress_callback, timings)
+    finally:
+        if owns_timings:
+            timings.report()
+
+def _process_video(video_path: str, sampling: Dict[str, Any], detection: Optional[Dict[str, Any]],
+                   image_options: Optional[Dict[str, Any]], progress_callback: Optional[Callable[[Dict[str, Any]], None]],
+                   timings: StageTimings) -> Optional[Dict[str, Any]]:
+    with timings.stage("open"):
+        cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logger.error(f"Error opening video file: {video_path}")
+        return None
 
-            if faces is not None:
-                for face in faces:
-                    box = face[0:4].astype(np.int32)
-                    confidence = float(face[14])
-
-                    x, y, w_box, h_box = box
-                    startX = max(0, x)
-                    startY = max(0, y)
-                    endX = min(w - 1, x + w_box)
-                    endY = min(h - 1, y + h_box)
-                    w_box = endX - startX
-                    h_box = endY - startY
-
-                    if w_box > 0 and h_box > 0:
-                        face_roi = frame[startY:endY, startX:endX]
-                        if face_roi.shape[0] > 0 and face_roi.shape[1] > 0:
-                            current_box = (startX, startY, endX, endY)
-                            boxes_this_frame.append(current_box)
-                            confidences_this_frame.append(confidence)
-
-                            # --- Prepare and Predict for *this* face ---
-                            try:
-                                face_rgb = cv2.cvtColor(face_roi, cv2.COLOR_BGR2RGB)
-                                face_rgb_resized = cv2.resize(face_rgb, (256, 256))
-                                image_array = img_to_array(face_rgb_resized)
-                                image_array = np.expand_dims(image_array, axis=0)
-                                image_array /= 255.0
-                                prediction = loaded_model.predict(image_array)[0][0]
-                                predictions_this_frame.append(prediction)
-                            except Exception as pred_err:
-                                logger.warning(f"Frame {frame_id}: Could not process/predict face ROI at {current_box}: {pred_err}")
-
-            # If any faces were processed in this frame, calculate averages for the frame
-            if predictions_this_frame:
-                avg_pred_for_frame = float(np.mean(predictions_this_frame))
-                avg_conf_for_frame = float(np.mean(confidences_this_frame))
-                frame_avg_predictions.append(avg_pred_for_frame)
-                frame_avg_face_confidences.append(avg_conf_for_frame)
-                processed_frame_count += 1
-
-                # Store the first raw frame and *all* its boxes if not already stored
-                if first_raw_frame is None:
-                    first_raw_frame = frame.copy()
-                    first_frame_all_boxes = boxes_this_frame # Store the list of boxes
-                    logger.info(f"Stored first frame (ID: {frame_id}) with {len(boxes_this_frame)} detected faces.")
+    # Face crops are scored in batches spanning several frames; per-frame averages are kept in frame order
+    early_exit = None
+    if sampling.get("early_exit", EARLY_EXIT_DEFAULT):
+        video_fps = cap.get(cv2.CAP_PROP_FPS)
+        if video_fps > 0:
+            early_exit = _EarlyExitMonitor(video_fps)
+        else:
+            logger.warning("Video reports no FPS; early exit needs it for time coverage and is disabled.")
+    dedup_distance = _dedup_distance(detection)
+    accumulator = _VideoScoreAccumulator(on_frame=progress_callback, early_exit=early_exit, timings=timings,
+                                         dedup_distance=dedup_distance)
+    track_interval = detection.get("track_interval", 0) if detection is not None else TRACK_DETECT_INTERVAL
+    tracker = _FaceTracker(track_interval, detection) if track_interval > 0 else None
 
+    try:
+        # Skipped frames are never decoded; decoding, detection and classification overlap across threads
+        _run_video_pipeline(cap, sampling, detection, accumulator, tracker, timings)
     finally:
         cap.release()
 
+    frame_avg_predictions = accumulator.frame_avg_predictions
+    frame_avg_face_confidences = accumulator.frame_avg_face_confidences
+    processed_frame_count = accumulator.processed_frame_count
+    first_raw_frame = accumulator.first_raw_frame
+    first_frame_all_boxes = accumulator.first_frame_all_boxes
+
     # Check if any frames were processed at all
     if processed_frame_count == 0:
         logger.warning("Warning: No faces were successfully processed in any video frame.")
@@ -341,93 +2162,1006 @@ def process_video(video_path: str) -> Optional[Dict[str, Any]]:
     first_boxed_frame_data_url = None
 
     if first_raw_frame is not None and first_frame_all_boxes is not None:
-        # 1. Encode Raw First Frame
-        try:
-            first_frame_rgb = cv2.cvtColor(first_raw_frame, cv2.COLOR_BGR2RGB)
-            pil_first_frame_raw = Image.fromarray(first_frame_rgb)
-            buffer_raw = io.BytesIO()
-            pil_first_frame_raw.save(buffer_raw, format="JPEG")
-            buffer_raw.seek(0)
-            raw_bytes = buffer_raw.read()
-            raw_base64 = base64.b64encode(raw_bytes).decode('utf-8')
-            first_raw_frame_data_url = f"data:image/jpeg;base64,{raw_base64}"
-            logger.info("Encoded first raw frame.")
-        except Exception as raw_encode_error:
-            logger.error(f"Failed to encode first raw frame: {raw_encode_error}", exc_info=True)
-
-        # 2. Encode Boxed First Frame (drawing all detected boxes for that frame)
         try:
-            first_frame_copy = first_raw_frame.copy()
-            # Draw all boxes detected in that first frame
-            for box_coords in first_frame_all_boxes:
-                (startX, startY, endX, endY) = box_coords
-                cv2.rectangle(first_frame_copy, (startX, startY), (endX, endY), (0, 255, 0), 2)
-
-            first_frame_boxed_rgb = cv2.cvtColor(first_frame_copy, cv2.COLOR_BGR2RGB)
-            pil_first_frame_boxed = Image.fromarray(first_frame_boxed_rgb)
-            buffer_boxed = io.BytesIO()
-            pil_first_frame_boxed.save(buffer_boxed, format="JPEG")
-            buffer_boxed.seek(0)
-            boxed_bytes = buffer_boxed.read()
-            boxed_base64 = base64.b64encode(boxed_bytes).decode('utf-8')
-            first_boxed_frame_data_url = f"data:image/jpeg;base64,{boxed_base64}"
-            logger.info(f"Encoded first boxed frame with {len(first_frame_all_boxes)} boxes.")
+            with timings.stage("encode"):
+                first_raw_frame_data_url, first_boxed_frame_data_url = render_result_images(first_raw_frame, first_frame_all_boxes, image_options)
+            logger.info(f"Rendered first frame images with {len(first_frame_all_boxes)} boxes.")
         except Exception as frame_encode_error:
-            logger.error(f"Failed to encode first boxed frame: {frame_encode_error}", exc_info=True)
+            logger.error(f"Failed to encode first frame images: {frame_encode_error}", exc_info=True)
 
-    return {
+    video_results = {
         "average_prediction": overall_avg_pred,
         "average_face_confidence": overall_avg_face_confidence,
         "processed_frame_count": processed_frame_count,
         "first_raw_frame_base64": first_raw_frame_data_url,
         "first_boxed_frame_base64": first_boxed_frame_data_url
     }
+    if early_exit is not None:
+        video_results.update({
+            "early_exit": accumulator.settled,
+            "early_exit_after_frames": processed_frame_count if accumulator.settled else None,
+            "prediction_interval": list(early_exit.interval()),
+        })
+    if dedup_distance >= 0:
+        logger.info(f"Near-duplicate reuse: {accumulator.reused_frame_count} frames, {accumulator.reused_face_count} faces.")
+        video_results.update({
+            "reused_frame_count": accumulator.reused_frame_count,
+            "reused_face_count": accumulator.reused_face_count,
+        })
+    if tracker is not None:
+        logger.info(f"Tracking: {tracker.detector_runs} detector runs, {tracker.tracked_frames} tracked frames, {tracker.scene_cuts} scene cuts.")
+        video_results.update({
+            "tracks": accumulator.track_summaries(),
+            "detector_runs": tracker.detector_runs,
+            "tracked_frame_count": tracker.tracked_frames,
+            "scene_cut_count": tracker.scene_cuts,
+        })
+    return video_results
+
+
+def process_image_bytes(data: bytes, detection: Optional[Dict[str, Any]] = None,
+                        image_options: Optional[Dict[str, Any]] = None,
+                        timings: Optional[StageTimings] = None) -> Tuple[Optional[Tuple[float, float, Tuple[int, int, int, int], str, str, Optional[int]]], StageTimings]:
+    """process_image for raw upload bytes; picklable entry point for process pools.
+
+    Returns the timings along with the result, since a process-pool worker only fills in its own copy.
+    """
+    timings = timings if timings is not None else StageTimings("image")
+    return process_image(io.BytesIO(data), detection, image_options, timings), timings
+
+def process_video_timed(video_path: str, sampling: Optional[Dict[str, Any]] = None,
+                        detection: Optional[Dict[str, Any]] = None,
+                        image_options: Optional[Dict[str, Any]] = None,
+                        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                        timings: Optional[StageTimings] = None) -> Tuple[Optional[Dict[str, Any]], StageTimings]:
+    """process_video returning its timings as well; picklable entry point for process pools."""
+    timings = timings if timings is not None else StageTimings("video")
+    return process_video(video_path, sampling, detection, image_options, progress_callback, timings), timings
+
+
+# --- Processing Lanes ---
+class ProcessingLane:
+    """Runs blocking processing work in its own worker pool, off the event loop, with admission control.
+
+    At most `workers` jobs run at once and up to `queue_limit` more may wait. Anything beyond that is
+    rejected immediately with a 503 and a Retry-After header instead of piling up.
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: int, retry_after: int, pool_kind: str = PROCESSING_POOL_KIND):
+        if pool_kind not in ("thread", "process"):
+            raise ValueError(f"Unknown processing pool kind: {pool_kind}")
+        self.name = name
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, queue_limit)
+        self.retry_after = retry_after
+        self.is_process_pool = pool_kind == "process"
+        if self.is_process_pool:
+            # spawn: TensorFlow and OpenCV thread pools are not fork-safe; each worker loads its own models
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=load_models)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{name}-worker")
+        self._admitted = 0
+        self._lock = threading.Lock()
+
+    def _release(self, _future) -> None:
+        with self._lock:
+            self._admitted -= 1
+
+    def _busy(self) -> HTTPException:
+        # Caller holds self._lock
+        logger.warning(f"{self.name} lane full ({self._admitted}/{self.capacity}); rejecting request.")
+        return HTTPException(
+            status_code=503,
+            detail=f"Server busy: too many {self.name} requests in progress. Please retry later.",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    def check_capacity(self) -> None:
+        """Raises the 503 that submit() would raise right now, before a request spends memory on its inputs."""
+        with self._lock:
+            if self._admitted >= self.capacity:
+                raise self._busy()
+
+    def submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        """Admits and schedules work right away (raising the 503 here); the returned future is awaitable."""
+        with self._lock:
+            if self._admitted >= self.capacity:
+                raise self._busy()
+            self._admitted += 1
+        try:
+            future = self._executor.submit(functools.partial(fn, *args, **kwargs))
+        except Exception:
+            self._release(None)
+            raise
+        # Released when the work itself finishes, even if the client disconnects first
+        future.add_done_callback(self._release)
+        return asyncio.wrap_future(future)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            admitted = self._admitted
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "in_progress": min(admitted, self.workers),
+            "queued": max(0, admitted - self.workers),
+        }
+
+image_lane = ProcessingLane("image", IMAGE_WORKERS, IMAGE_QUEUE_LIMIT, IMAGE_RETRY_AFTER_SECONDS)
+video_lane = ProcessingLane("video", VIDEO_WORKERS, VIDEO_QUEUE_LIMIT, VIDEO_RETRY_AFTER_SECONDS)
+
+
+# --- Result Cache ---
+def model_version() -> str:
+    """Identity of the classifier and detector files and the inference backend; part of every cache key so new
+    weights (or a quantized backend) never hit old results."""
+    return f"clf-{_file_sha256(pkl_model_path)[:16]}.{inference_backend['backend']}.det-{_file_sha256(YUNET_MODEL_PATH)[:16]}"
+
+def result_cache_key(kind: str, content_digest: str, params: Dict[str, Any]) -> str:
+    """Content-addressed key: upload hash + model/detector identity + the processing parameters that shape the result."""
+    material = json.dumps({"kind": kind, "content": content_digest, "model": model_version(), "params": params}, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """Two-tier cache of endpoint responses: a bounded in-memory LRU in front of an optional SQLite store.
+
+    Disk hits are promoted into memory; max_entries=0 leaves out the memory tier. Each tier is bounded on its
+    own: the memory tier by entries and bytes (LRU), the SQLite tier by bytes (oldest entries evicted on put).
+    The SQLite tier survives restarts; entries of other model versions are dropped on the first put. Methods
+    block on SQLite I/O, so async endpoints call them through asyncio.to_thread.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, db_path: str = "", max_disk_bytes: int = 0):
+        self.max_entries = max(0, max_entries)
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._pruned_version = None # Model version whose stale disk entries are already dropped
+        self._memory = OrderedDict() # key -> (kind, created, size, value)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._db_path = db_path
+        self._db = None
+        if db_path:
+            self._connect()
+            logger.info(f"Result cache persistent tier at: {db_path}")
+
+    def _connect(self) -> None:
+        self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, model_version TEXT NOT NULL, "
+            "created REAL NOT NULL, size INTEGER NOT NULL, payload TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+        self._db.commit()
+
+    def reopen(self) -> None:
+        """Opens a new SQLite connection; a forked worker must not use the one it inherited from its parent."""
+        if self._db_path:
+            self._connect()
+
+    def _remember(self, key: str, kind: str, created: float, size: int, value: Dict[str, Any]) -> None:
+        # Caller holds self._lock
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[2]
+        if size > self.max_bytes or not self.max_entries:
+            return
+        self._memory[key] = (kind, created, size, value)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted[2]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return dict(entry[3])
+            if self._db is not None:
+                row = self._db.execute("SELECT kind, created, size, payload FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[3])
+                    self._remember(key, row[0], row[1], row[2], value)
+                    self._hits += 1
+                    return dict(value)
+            self._misses += 1
+            return None
+
+    def _prune_disk(self, version: str) -> None:
+        # Caller holds self._lock
+        if self._pruned_version != version:
+            # Their keys can never be looked up again
+            dropped = self._db.execute("DELETE FROM results WHERE model_version != ?", (version,)).rowcount
+            if dropped:
+                logger.info(f"Result cache: dropped {dropped} disk entries of other model versions.")
+            self._pruned_version = version
+        excess = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] - self.max_disk_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM results ORDER BY created"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def put(self, key: str, kind: str, value: Dict[str, Any]) -> None:
+        payload = json.dumps(value)
+        created = time.time()
+        version = model_version()
+        with self._lock:
+            self._remember(key, kind, created, len(payload), value)
+            if self._db is not None and len(payload) <= self.max_disk_bytes:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, kind, model_version, created, size, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, kind, version, created, len(payload), payload),
+                )
+                self._prune_disk(version)
+                self._db.commit()
+
+    def inspect(self, key: str) -> Optional[Dict[str, Any]]:
+        """Entry metadata and its result fields, without the (large) base64 images."""
+        with self._lock:
+            entry = self._memory.get(key)
+            tiers = ["memory"] if entry is not None else []
+            row = None
+            if self._db is not None:
+                row = self._db.execute("SELECT kind, model_version, created, size, payload FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    tiers.append("disk")
+        if entry is not None:
+            kind, created, size, value = entry
+        elif row is not None:
+            kind, created, size, value = row[0], row[2], row[3], json.loads(row[4])
+        else:
+            return None
+        return {
+            "key": key,
+            "kind": kind,
+            "tiers": tiers,
+            "created": created,
+            "size_bytes": size,
+            "result": {k: v for k, v in value.items() if not k.endswith("base64")},
+        }
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            removed = False
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[2]
+                removed = True
+            if self._db is not None:
+                removed = self._db.execute("DELETE FROM results WHERE key = ?", (key,)).rowcount > 0 or removed
+                self._db.commit()
+            return removed
+
+    def clear(self, include_disk: bool = True) -> int:
+        with self._lock:
+            removed = len(self._memory)
+            self._memory.clear()
+            self._memory_bytes = 0
+            if include_disk and self._db is not None:
+                removed += self._db.execute("DELETE FROM results").rowcount
+                self._db.commit()
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "persistent": self._db is not None,
+            }
+            if self._db is not None:
+                result["disk_entries"], result["disk_bytes"] = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+                result["max_disk_bytes"] = self.max_disk_bytes
+        return result
+
+def _create_result_cache() -> Optional[ResultCache]:
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if not LOAD_CLASSIFIER:
+        # model_version() identifies the classifier by project512.pkl, which an assigned classifier need not match
+        logger.warning("Result cache disabled: LOAD_CLASSIFIER=0 leaves no classifier identity to key cached results by.")
+        return None
+    max_disk_bytes = int(RESULT_CACHE_DISK_MAX_MB * 1024 * 1024)
+    if SERVER_WORKERS > 1:
+        # A per-process memory tier would keep serving entries that DELETE /cache removed in another worker
+        if not RESULT_CACHE_DB_PATH:
+            logger.warning("Result cache disabled: with several server workers it needs the shared RESULT_CACHE_DB_PATH tier.")
+            return None
+        logger.info("Several server workers: the result cache only uses its shared SQLite tier.")
+        return ResultCache(0, 0, RESULT_CACHE_DB_PATH, max_disk_bytes)
+    return ResultCache(RESULT_CACHE_MAX_ENTRIES, int(RESULT_CACHE_MAX_MB * 1024 * 1024), RESULT_CACHE_DB_PATH, max_disk_bytes)
+
+result_cache = _create_result_cache()
+
+def _cached_response(content: Dict[str, Any], cache_status: str, cache_key: Optional[str]) -> JSONResponse:
+    headers = {"X-Cache": cache_status}
+    if cache_key is not None:
+        headers["X-Cache-Key"] = cache_key
+    return JSONResponse(content=content, headers=headers)
+
+def _timed_response(content, timings: StageTimings):
+    """Adds the per-stage Server-Timing header to a prediction response when SERVER_TIMING_ENABLED is set."""
+    if not SERVER_TIMING_ENABLED:
+        return content
+    response = content if isinstance(content, Response) else JSONResponse(content=content)
+    response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+
+# --- Upload Handling ---
+async def _limited_body(request: Request, max_bytes: int):
+    """Request body stream that fails with 413 as soon as more than max_bytes have arrived."""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds the {max_bytes / (1024 * 1024):g} MB limit.")
+        yield chunk
+
+async def read_upload_form(request: Request, max_bytes: int, max_files: int = 1000):
+    """Parses a multipart upload with the size limit applied while it streams in.
+
+    File parts are spooled by Starlette (kept in memory only up to 1 MB). The caller must close() the form.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the {max_bytes / (1024 * 1024):g} MB limit.")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload.")
+    try:
+        return await MultiPartParser(request.headers, _limited_body(request, max_bytes), max_files=max_files).parse()
+    except MultiPartException as form_error:
+        raise HTTPException(status_code=400, detail=form_error.message)
+
+def get_upload_field(form_data):
+    """Returns the 'file' upload of a form, raising HTTP 400 when it is missing or not a file."""
+    if 'file' not in form_data:
+        raise HTTPException(status_code=400, detail="'file' field missing in form data.")
+    file_field = form_data['file']
+    # Basic check if it looks like an UploadFile
+    is_likely_uploadfile = (
+        hasattr(file_field, 'filename') and
+        hasattr(file_field, 'content_type') and
+        hasattr(file_field, 'file') and
+        callable(getattr(file_field, 'read', None))
+    )
+    if not is_likely_uploadfile:
+        actual_value = str(file_field)[:200]
+        logger.error(f"!!! ERROR: 'file' field doesn't act like UploadFile. Type: {type(file_field)}, Value: {actual_value}")
+        raise HTTPException(status_code=400, detail=f"Expected 'file' field to be a file upload, received {type(file_field)}.")
+    return file_field
+
+def _copy_to_named_file(source, suffix: str, directory: Optional[str]) -> Tuple[str, str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    source.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=directory) as tmp:
+        try:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            _remove_temp_file(tmp.name)
+            raise
+    return tmp.name, digest.hexdigest(), size
+
+async def spool_upload(file_field, suffix: str, directory: Optional[str] = None) -> Tuple[str, str, int]:
+    """Copies an upload to a named temp file chunk by chunk; returns (path, sha256 hex digest, size in bytes).
+
+    OpenCV needs a path, and the file Starlette spooled the part into has none, so large uploads are written
+    twice; the copy (and hashing) runs in a worker thread to keep that disk I/O off the event loop.
+    """
+    return await asyncio.to_thread(_copy_to_named_file, file_field.file, suffix, directory)
+
+def _remove_temp_file(path: Optional[str]) -> None:
+    if path and os.path.exists(path):
+        try:
+            os.unlink(path)
+            logger.info(f"Removed temporary file: {path}")
+        except OSError as unlink_error:
+            logger.warning(f"Could not remove temporary file {path}: {unlink_error}")
+
+def parse_video_request_options(form_data) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """(sampling, detection, image_options) for a video request."""
+    sampling = parse_video_sampling(form_data)
+    detection = parse_detection_options(form_data)
+    detection.update(parse_tracking_options(form_data))
+    image_options = parse_image_options(form_data)
+    if image_options["mode"] == "artifact" and video_lane.is_process_pool:
+        raise HTTPException(status_code=400, detail="images=artifact is not available with process-based video workers.")
+    return sampling, detection, image_options
+
+def finalize_video_results(request: Request, video_results: Dict[str, Any], image_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds the label and, in artifact mode, the artifact URLs to a process_video result."""
+    # Determine label based on the overall average prediction score
+    label = "real" if video_results["average_prediction"] > 0.5 else "fake"
+    video_results["label"] = label
+    if image_options["mode"] == "artifact" and video_results["first_raw_frame_base64"] is not None:
+        artifact_id = video_results["first_raw_frame_base64"]
+        video_results.update(first_raw_frame_base64=None, first_boxed_frame_base64=None)
+        video_results.update(artifact_fields(request, artifact_id, "first_raw_frame_url", "first_boxed_frame_url"))
+    return video_results
+
+class VideoProcessingCancelled(Exception):
+    """Raised inside the video pipeline when the streaming client has gone away."""
+
+class _ProgressChannel:
+    """Carries progress events from a processing thread to the event loop with bounded buffering.
+
+    send() blocks the producing thread while the buffer is full, so a slow client slows processing
+    instead of growing memory; once closed, send() raises VideoProcessingCancelled.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, capacity: int = STREAM_EVENT_BUFFER):
+        self._loop = loop
+        self._events = asyncio.Queue()
+        self._slots = threading.Semaphore(capacity)
+        self._closed = threading.Event()
+
+    def send(self, event: Dict[str, Any]) -> None:
+        while not self._slots.acquire(timeout=0.5):
+            if self._closed.is_set():
+                raise VideoProcessingCancelled()
+        if self._closed.is_set():
+            raise VideoProcessingCancelled()
+        self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    async def receive(self) -> Dict[str, Any]:
+        event = await self._events.get()
+        self._slots.release()
+        return event
+
+    def drain(self) -> list:
+        events = []
+        while not self._events.empty():
+            events.append(self._events.get_nowait())
+            self._slots.release()
+        return events
+
+    def close(self) -> None:
+        self._closed.set()
+
+def _format_stream_event(stream_format: str, event_type: str, payload: Dict[str, Any]) -> str:
+    if stream_format == "ndjson":
+        return json.dumps({"type": event_type, **payload}) + "\n"
+    return f"event: {event_type}\ndata: {json.dumps(payload)}\n\n"
+
+# --- Batch Images ---
+def _open_archive(upload):
+    """A ZipFile or TarFile (plain, gz, bz2 or xz) reading from the `upload` file, or None when it is not an archive."""
+    upload.seek(0)
+    head = upload.read(262)
+    upload.seek(0)
+    if head[:4] == b"PK\x03\x04":
+        return zipfile.ZipFile(upload)
+    if head.startswith((b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")) or head[257:262] == b"ustar":
+        try:
+            return tarfile.open(fileobj=upload, mode="r:*")
+        except tarfile.TarError:
+            upload.seek(0)
+            return None # e.g. a lone gzipped file; it is then decoded (and rejected) like any other image
+    return None
+
+def _archive_members(archive) -> Iterator[Tuple[str, int, Callable[[], bytes]]]:
+    """(name, size, read) for each regular file of an archive, skipping directories and OS metadata files."""
+    if isinstance(archive, zipfile.ZipFile):
+        members = ((info.filename, info.file_size, functools.partial(archive.read, info))
+                   for info in archive.infolist() if not info.is_dir())
+    else:
+        members = ((member.name, member.size, lambda member=member: archive.extractfile(member).read())
+                   for member in archive if member.isfile())
+    for name, size, read in members:
+        if name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+            continue
+        yield name, size, read
+
+def _iter_batch_entries(uploads: list) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    """(name, image bytes, None) for every uploaded image and archive entry, or (name, None, error) for unreadable ones.
+
+    Uploads are (filename, bytes or binary file) pairs; files are only read as their entries are reached.
+    """
+    max_image_bytes = int(MAX_IMAGE_UPLOAD_MB * 1024 * 1024)
+    for upload_name, upload in uploads:
+        if isinstance(upload, bytes):
+            upload = io.BytesIO(upload)
+        try:
+            archive = _open_archive(upload)
+        except Exception as archive_error:
+            # Truncated or corrupt archives only fail their own upload
+            yield upload_name, None, f"Could not open archive: {archive_error}"
+            continue
+        if archive is None:
+            upload.seek(0, os.SEEK_END)
+            if upload.tell() > max_image_bytes:
+                yield upload_name, None, f"Image exceeds the {MAX_IMAGE_UPLOAD_MB:g} MB limit."
+            else:
+                upload.seek(0)
+                yield upload_name, upload.read(), None
+            continue
+        with archive:
+            members = _archive_members(archive)
+            while True:
+                try:
+                    # Tar members are read from the stream while iterating, so a damaged one fails here
+                    name, size, read = next(members)
+                except StopIteration:
+                    break
+                except Exception as archive_error:
+                    yield upload_name, None, f"Could not read archive: {archive_error}"
+                    break
+                entry_name = f"{upload_name}/{name}"
+                if size > max_image_bytes:
+                    yield entry_name, None, f"Image exceeds the {MAX_IMAGE_UPLOAD_MB:g} MB limit."
+                    continue
+                try:
+                    entry_data = read()
+                except Exception as read_error:
+                    yield entry_name, None, f"Could not read archive entry: {read_error}"
+                    continue
+                yield entry_name, entry_data, None
+
+def _score_batch_image(index: int, name: str, data: bytes, detection: Dict[str, Any],
+                       image_options: Dict[str, Any]) -> Tuple[str, Dict[str, Any], StageTimings]:
+    """("result" or "error", NDJSON payload, timings) for one image of a batch; never raises."""
+    timings = StageTimings("image")
+    entry = {"index": index, "filename": name}
+    use_cache = result_cache is not None and image_options["mode"] != "artifact"
+    try:
+        if use_cache:
+            cache_key = result_cache_key("image", hashlib.sha256(data).hexdigest(), {"detection": detection, "images": image_options})
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return "result", {**entry, **cached}, timings
+        processing_result = process_image(io.BytesIO(data), detection, image_options, timings)
+        if processing_result is None:
+            return "error", {**entry, "status_code": 400, "detail": "Image processing failed or no faces processed."}, timings
+        response = image_result_fields(processing_result)
+        if use_cache:
+            result_cache.put(cache_key, "image", response)
+        return "result", {**entry, **response}, timings
+    except Exception as image_error:
+        logger.error(f"Error processing batch image {name}: {image_error}", exc_info=True)
+        return "error", {**entry, "status_code": 500, "detail": f"Internal server error: {image_error}"}, timings
+
+def process_image_batch(uploads: list, detection: Dict[str, Any], image_options: Dict[str, Any],
+                        on_event: Optional[Callable[[tuple], None]] = None) -> list:
+    """Scores every image of a /predict_images upload (files and the entries of zip/tar archives).
+
+    Up to BATCH_IMAGE_CONCURRENCY images are decoded and detected at once, so with the inference scheduler
+    their face crops are classified together. Produces (event type, payload, timings) events as images
+    finish: a "result" or "error" per image, then a "summary". They go to `on_event` as soon as they are
+    ready or, without it, are returned at the end (process-pool workers cannot call back).
+    """
+    events = []
+    counts = {"result": 0, "error": 0}
+
+    def emit(event_type: str, payload: Dict[str, Any], timings: Optional[StageTimings] = None) -> None:
+        counts[event_type] = counts.get(event_type, 0) + 1
+        if on_event is None:
+            events.append((event_type, payload, timings))
+        else:
+            on_event((event_type, payload, timings))
+
+    pool = ThreadPoolExecutor(max_workers=max(1, BATCH_IMAGE_CONCURRENCY), thread_name_prefix="batch-image")
+    pending = set()
+    try:
+        for index, (name, data, error) in enumerate(_iter_batch_entries(uploads)):
+            if index >= MAX_BATCH_IMAGES:
+                emit("error", {"index": index, "filename": name, "status_code": 413,
+                               "detail": f"Batch exceeds {MAX_BATCH_IMAGES} images; this and later entries were skipped."})
+                break
+            if error is not None:
+                emit("error", {"index": index, "filename": name, "status_code": 400, "detail": error})
+                continue
+            pending.add(pool.submit(_score_batch_image, index, name, data, detection, image_options))
+            # Bounds how many read (and decoded) images are held at once
+            while len(pending) >= 2 * max(1, BATCH_IMAGE_CONCURRENCY):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    emit(*future.result())
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                emit(*future.result())
+    finally:
+        # Client gone (on_event raised): drop the images not started yet
+        pool.shutdown(wait=True, cancel_futures=True)
+    emit("summary", {"images": counts["result"] + counts["error"], "succeeded": counts["result"], "failed": counts["error"]})
+    return events
+
+def batch_upload_parts(form_data) -> list:
+    """(filename, UploadFile) of every file part of a /predict_images form, raising HTTP 400 when there is none."""
+    parts = []
+    for _, value in form_data.multi_items():
+        if hasattr(value, "filename") and callable(getattr(value, "read", None)):
+            parts.append((value.filename or f"file{len(parts)}", value))
+    if not parts:
+        raise HTTPException(status_code=400, detail="No files in form data; send images or a zip/tar archive as file fields.")
+    return parts
+
+def _format_batch_event(request: Request, event: tuple, image_options: Dict[str, Any]) -> str:
+    event_type, payload, timings = event
+    if timings is not None:
+        timings.report()
+    if event_type == "result" and image_options["mode"] == "artifact":
+        add_image_artifact_fields(request, payload)
+    return _format_stream_event("ndjson", event_type, payload)
+
+batch_lane = ProcessingLane("batch", BATCH_WORKERS, BATCH_QUEUE_LIMIT, BATCH_RETRY_AFTER_SECONDS)
+
+# --- Video Jobs ---
+class JobStore:
+    """SQLite-backed state of background video jobs: status, progress, parameters, result and spooled file.
+
+    Unfinished jobs record the pid of the process running (or about to run) them. Jobs of a process that is
+    gone are release()d, and then claimed by exactly one live process (see claim_released).
+    """
+
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, "
+                "finished REAL, file_path TEXT, params TEXT NOT NULL, frames_processed INTEGER NOT NULL DEFAULT 0, "
+                "result TEXT, error TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            if "owner_pid" not in {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+            self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _execute(self, sql: str, args: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            cursor = self._db.execute(sql, args)
+            self._db.commit()
+            return cursor
+
+    def create(self, job_id: str, file_path: Optional[str], params: Dict[str, Any], result: Optional[Dict[str, Any]] = None) -> None:
+        now = time.time()
+        if result is None:
+            self._execute("INSERT INTO jobs (id, status, created, updated, file_path, params, owner_pid) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                          (job_id, now, now, file_path, json.dumps(params), os.getpid()))
+        else:
+            self._execute("INSERT INTO jobs (id, status, created, updated, finished, params, frames_processed, result) "
+                          "VALUES (?, 'succeeded', ?, ?, ?, ?, ?, ?)",
+                          (job_id, now, now, now, json.dumps(params), result.get("processed_frame_count", 0), json.dumps(result)))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT id, status, created, updated, finished, file_path, params, frames_processed, result, error "
+                                   "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row[0], "status": row[1], "created": row[2], "updated": row[3], "finished": row[4],
+            "file_path": row[5], "params": json.loads(row[6]), "frames_processed": row[7],
+            "result": json.loads(row[8]) if row[8] else None, "error": row[9],
+        }
 
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def mark_running(self, job_id: str) -> None:
+        self._execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), job_id))
+
+    def update_progress(self, job_id: str, frames_processed: int) -> None:
+        self._execute("UPDATE jobs SET frames_processed = ?, updated = ? WHERE id = ?", (frames_processed, time.time(), job_id))
+
+    def finish(self, job_id: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        now = time.time()
+        status = "failed" if error is not None else "succeeded"
+        frames = result.get("processed_frame_count", 0) if result else None
+        self._execute("UPDATE jobs SET status = ?, updated = ?, finished = ?, file_path = NULL, "
+                      "frames_processed = COALESCE(?, frames_processed), result = ?, error = ? WHERE id = ?",
+                      (status, now, now, frames, json.dumps(result) if result is not None else None, error, job_id))
+
+    def release(self, owner_pid: Optional[int] = None) -> int:
+        """Puts the unfinished jobs of a process that is gone (of any process when owner_pid is None) back in the
+        queue without an owner, for claim_released(); returns how many there were."""
+        sql = "UPDATE jobs SET status = 'queued', owner_pid = NULL, updated = ? WHERE status IN ('queued', 'running')"
+        args = (time.time(),)
+        if owner_pid is not None:
+            sql, args = sql + " AND owner_pid = ?", args + (owner_pid,)
+        released = self._execute(sql, args).rowcount
+        if released:
+            logger.info(f"Released {released} unfinished video jobs" + (f" of pid {owner_pid}." if owner_pid is not None else "."))
+        return released
+
+    def claim_released(self) -> list:
+        """(job_id, file_path) of the released jobs this process claimed, oldest first.
+
+        Each job is claimed with a conditional update, so processes sharing the store never both claim one.
+        """
+        claimed = []
+        with self._lock:
+            rows = self._db.execute("SELECT id, file_path FROM jobs WHERE status IN ('queued', 'running') "
+                                    "AND owner_pid IS NULL ORDER BY created").fetchall()
+            for job_id, file_path in rows:
+                if self._db.execute("UPDATE jobs SET owner_pid = ? WHERE id = ? AND owner_pid IS NULL",
+                                    (os.getpid(), job_id)).rowcount:
+                    claimed.append((job_id, file_path))
+                self._db.commit()
+        return claimed
+
+    def expire(self, ttl_seconds: int) -> list:
+        """Deletes jobs that finished more than ttl_seconds ago; returns the spooled files they still referenced."""
+        cutoff = time.time() - ttl_seconds
+        with self._lock:
+            paths = [row[0] for row in self._db.execute(
+                "SELECT file_path FROM jobs WHERE finished IS NOT NULL AND finished < ? AND file_path IS NOT NULL", (cutoff,))]
+            deleted = self._db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (cutoff,)).rowcount
+            self._db.commit()
+        if deleted:
+            logger.info(f"Expired {deleted} finished video jobs.")
+        return paths
+
+    def referenced_files(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT file_path FROM jobs WHERE file_path IS NOT NULL")}
+
+class VideoJobRunner:
+    """Runs spooled videos through process_video on a bounded pool of background workers, recording state in a JobStore."""
+
+    def __init__(self, db_path: str, spool_dir: str, workers: int):
+        self.spool_dir = spool_dir
+        self.workers = max(1, workers)
+        self._db_path = db_path
+        self.store = None
+        self._executor = None
+        self._stop = threading.Event()
+        self._cleanup_thread = None
+        # Jobs left unfinished by a previous process are released on start. serve.py turns this off in its workers
+        # and releases them in the supervisor instead: once at startup, and for each worker that dies.
+        self.release_unfinished = True
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.store = JobStore(self._db_path)
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="video-job")
+        if self.release_unfinished:
+            self.store.release()
+        for job_id, file_path in self.store.claim_released():
+            if file_path and os.path.exists(file_path):
+                logger.info(f"Resuming video job {job_id}.")
+                self._executor.submit(self._run, job_id)
+            else:
+                self.store.finish(job_id, error="Spooled upload was lost before the job could run.")
+        self._cleanup_thread = threading.Thread(target=self._cleanup_loop, name="video-job-cleanup", daemon=True)
+        self._cleanup_thread.start()
+        logger.info(f"Video job workers started ({self.workers} workers, store: {self._db_path}).")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._executor is not None:
+            # Running jobs stay 'running' in the store and are resumed on the next start
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, file_path: str, params: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, file_path, params)
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def add_finished(self, params: Dict[str, Any], result: Dict[str, Any]) -> str:
+        """Records a job whose result is already known (e.g. from the result cache)."""
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, None, params, result=result)
+        return job_id
+
+    def _run(self, job_id: str) -> None:
+        # Jobs resumed at startup can get here while the models are still loading in the background
+        while not models_ready.wait(timeout=1.0):
+            if self._stop.is_set() or model_state["status"] == "failed":
+                return
+        job = self.store.get(job_id)
+        if job is None or job["status"] not in ("queued", "running"):
+            return
+        file_path, params = job["file_path"], job["params"]
+        self.store.mark_running(job_id)
+        last_progress_write = 0.0
+
+        def on_frame(event: Dict[str, Any]) -> None:
+            nonlocal last_progress_write
+            if self._stop.is_set():
+                raise VideoProcessingCancelled()
+            now = time.monotonic()
+            if now - last_progress_write >= JOB_PROGRESS_INTERVAL_SECONDS:
+                last_progress_write = now
+                self.store.update_progress(job_id, event["processed_frame_count"])
+
+        try:
+            video_results = process_video(file_path, params["sampling"], params["detection"], params["images"], on_frame)
+        except VideoProcessingCancelled:
+            logger.info(f"Video job {job_id} interrupted by shutdown; it will resume on restart.")
+            return
+        except Exception as job_error:
+            logger.error(f"Video job {job_id} failed: {job_error}", exc_info=True)
+            self.store.finish(job_id, error=f"Internal server error: {job_error}")
+            _remove_temp_file(file_path)
+            return
+
+        if video_results is None:
+            self.store.finish(job_id, error="Video processing failed or no faces processed.")
+        else:
+            # Determine label based on the overall average prediction score
+            video_results["label"] = "real" if video_results["average_prediction"] > 0.5 else "fake"
+            self.store.finish(job_id, result=video_results)
+            if result_cache is not None and params.get("cache_key"):
+                result_cache.put(params["cache_key"], "video", video_results)
+        _remove_temp_file(file_path)
+
+    def _cleanup_loop(self) -> None:
+        while not self._stop.wait(JOB_CLEANUP_INTERVAL_SECONDS):
+            try:
+                self.cleanup()
+            except Exception as cleanup_error:
+                logger.warning(f"Video job cleanup failed: {cleanup_error}")
+
+    def cleanup(self) -> None:
+        """Drops expired jobs and deletes spooled files no job refers to any more."""
+        for path in self.store.expire(JOB_TTL_SECONDS):
+            _remove_temp_file(path)
+        referenced = self.store.referenced_files()
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            if path not in referenced and os.path.getmtime(path) < cutoff:
+                _remove_temp_file(path)
+
+video_jobs = VideoJobRunner(JOB_DB_PATH, JOB_SPOOL_DIR, JOB_WORKERS)
 
 # --- API Endpoints ---
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving, whether or not the models have finished loading."""
+    return {"status": "ok", "model": model_state["status"]}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once the models are loaded and warmed up, 503 with the loading state until then."""
+    if models_ready.is_set():
+        return {"status": "ready", "model": model_state}
+    return JSONResponse(status_code=503, content={"status": "not_ready", "model": model_state},
+                        headers={"Retry-After": str(MODEL_NOT_READY_RETRY_AFTER_SECONDS)})
+
+@app.get("/inference_stats")
+async def inference_stats():
+    """Inference backend in use plus occupancy and latency of recent batches built by the inference scheduler."""
+    if inference_scheduler is None:
+        return {"enabled": False, "backend": inference_backend}
+    return {"enabled": True, "backend": inference_backend, **inference_scheduler.stats()}
+
+@app.get("/cache")
+async def cache_stats():
+    """Result cache size, hit/miss counts and the model identity used in cache keys."""
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "model_version": model_version(), **(await asyncio.to_thread(result_cache.stats))}
+
+@app.get("/cache/{cache_key}")
+async def cache_inspect(cache_key: str):
+    """Metadata and result fields (without images) of one cached entry, as named by the X-Cache-Key header."""
+    entry = await asyncio.to_thread(result_cache.inspect, cache_key) if result_cache is not None else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Cache entry not found.")
+    return entry
+
+@app.delete("/cache/{cache_key}")
+async def cache_invalidate(cache_key: str):
+    if result_cache is None or not await asyncio.to_thread(result_cache.delete, cache_key):
+        raise HTTPException(status_code=404, detail="Cache entry not found.")
+    return {"deleted": cache_key}
+
+@app.delete("/cache")
+async def cache_clear(include_disk: bool = True):
+    """Drops every cached result; pass include_disk=false to keep the persistent tier."""
+    if result_cache is None:
+        return {"enabled": False, "deleted": 0}
+    return {"enabled": True, "deleted": await asyncio.to_thread(result_cache.clear, include_disk)}
+
+@app.get("/artifacts/{artifact_id}/{variant}")
+async def get_artifact(artifact_id: str, variant: str, max_side: int = 0, quality: int = 0):
+    """Renders a stored result frame as JPEG on demand; variant is "original" or "boxed"."""
+    if variant not in ("original", "boxed"):
+        raise HTTPException(status_code=404, detail="Unknown artifact variant.")
+    artifact = artifact_store.get(artifact_id)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="Artifact not found or expired.")
+    frame, boxes = artifact
+    jpeg_bytes = await asyncio.to_thread(render_image_variant, frame, boxes, variant, max_side or None,
+                                         min(max(quality, 1), 95) if quality else None)
+    return Response(content=jpeg_bytes, media_type="image/jpeg", headers={"Cache-Control": f"private, max-age={ARTIFACT_TTL_SECONDS}"})
+
+@app.get("/processing_stats")
+async def processing_stats():
+    """Running and queued work in the image, video and batch processing lanes."""
+    return {"image": image_lane.stats(), "video": video_lane.stats(), "batch": batch_lane.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Per-stage latency histograms and face/frame/error counters in Prometheus text format.
+
+    Counted per process: behind serve.py with several workers, each scrape covers only the worker that answered.
+    """
+    if metrics is None:
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.post("/predict_image")
 async def predict_image_restored(request: Request):
     # ... (Endpoint logic remains largely the same, uses the updated process_image)
+    require_models_ready()
+    form_data = None
+    timings = StageTimings("image")
     try:
-        form_data = await request.form()
-        if 'file' not in form_data:
-            raise HTTPException(status_code=400, detail="'file' field missing in form data.")
-        file_field = form_data['file']
-        # Basic check if it looks like an UploadFile
-        is_likely_uploadfile = (
-            hasattr(file_field, 'filename') and
-            hasattr(file_field, 'content_type') and
-            hasattr(file_field, 'file') and
-            callable(getattr(file_field, 'read', None))
-        )
-        if not is_likely_uploadfile:
-            actual_value = str(file_field)[:200]
-            logger.error(f"!!! ERROR: 'file' field doesn't act like UploadFile. Type: {type(file_field)}, Value: {actual_value}")
-            raise HTTPException(status_code=400, detail=f"Expected 'file' field to be a file upload, received {type(file_field)}.")
-
-        # Call the updated process_image which now averages predictions
-        processing_result = process_image(file_field.file)
+        with timings.stage("upload"):
+            form_data = await read_upload_form(request, int(MAX_IMAGE_UPLOAD_MB * 1024 * 1024))
+            file_field = get_upload_field(form_data)
+
+        detection = parse_detection_options(form_data)
+        image_options = parse_image_options(form_data)
+        if image_options["mode"] == "artifact" and image_lane.is_process_pool:
+            raise HTTPException(status_code=400, detail="images=artifact is not available with process-based image workers.")
+
+        # Identical uploads with identical parameters are answered from the result cache
+        # (artifact responses point at short-lived artifacts and are never cached)
+        with timings.stage("upload"):
+            image_bytes = await file_field.read()
+        cache_key = None
+        use_cache = result_cache is not None and image_options["mode"] != "artifact"
+        if use_cache:
+            cache_key = result_cache_key("image", hashlib.sha256(image_bytes).hexdigest(), {"detection": detection, "images": image_options})
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            if cached is not None:
+                logger.info(f"predict_image endpoint: cache hit for {cache_key}.")
+                return _timed_response(_cached_response(cached, "HIT", cache_key), timings)
+
+        # Run the updated process_image (which averages predictions) in the image worker pool
+        processing_result, timings = await image_lane.run(process_image_bytes, image_bytes, detection, image_options, timings)
 
         if processing_result is None:
              logger.warning("predict_image endpoint: process_image returned None.")
              raise HTTPException(status_code=400, detail="Image processing failed or no faces processed.")
 
-        # Unpack the result tuple (order matches updated process_image return)
-        # Note: face_box is still the box of the highest confidence face for API consistency
-        avg_prediction_score, avg_face_confidence, highest_conf_face_box, corrected_original_base64, boxed_image_base64 = processing_result
-
-        # Label based on the *average* prediction score
-        label = "real" if avg_prediction_score > 0.5 else "fake"
-
-        return {
-            "prediction": avg_prediction_score, # Return the average score
-            "label": label,
-            "face_confidence": float(avg_face_confidence), # Return average face confidence
-            "face_box": [int(x) for x in highest_conf_face_box], # Return box of highest conf face
-            "corrected_original_base64": corrected_original_base64,
-            "boxed_image_base64": boxed_image_base64 # Image has all boxes drawn
-        }
+        response = image_result_fields(processing_result)
+        if image_options["mode"] == "artifact":
+            add_image_artifact_fields(request, response)
+        if use_cache:
+            await asyncio.to_thread(result_cache.put, cache_key, "image", response)
+            return _timed_response(_cached_response(response, "MISS", cache_key), timings)
+        return _timed_response(response, timings)
 
     except HTTPException as http_exc:
         raise http_exc
@@ -437,91 +3171,292 @@ async def predict_image_restored(request: Request):
     except Exception as e:
         logger.error(f"Unexpected error processing image endpoint: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        timings.report()
+        if form_data is not None:
+            await form_data.close()
+
+@app.post("/predict_images")
+async def predict_images(request: Request):
+    """Scores many images in one request: several file fields, and/or zip/tar archives of images.
+
+    Streams NDJSON: a "result" line (the /predict_image fields plus index and filename) or an "error" line
+    (status_code and detail) per image as soon as it is done, in completion order, then a "summary" line.
+    Detection and 'images' options apply to every image.
+    """
+    require_models_ready()
+    form_data = None
+    try:
+        batch_lane.check_capacity()
+        form_data = await read_upload_form(request, int(MAX_BATCH_UPLOAD_MB * 1024 * 1024), max_files=MAX_BATCH_IMAGES)
+        detection = parse_detection_options(form_data)
+        image_options = parse_image_options(form_data)
+        if image_options["mode"] == "artifact" and batch_lane.is_process_pool:
+            raise HTTPException(status_code=400, detail="images=artifact is not available with process-based workers.")
+        parts = batch_upload_parts(form_data)
+
+        channel = _ProgressChannel(asyncio.get_running_loop())
+        if batch_lane.is_process_pool:
+            # Process-pool workers cannot share the spooled files; their bytes are only read into memory once
+            # the lane has room. Results cannot be streamed back from them and arrive all at once at the end.
+            batch_lane.check_capacity()
+            uploads = [(name, await upload.read()) for name, upload in parts]
+            job = batch_lane.submit(process_image_batch, uploads, detection, image_options, None)
+        else:
+            # The batch reads each image (or archive entry) from Starlette's spooled files as it gets to it,
+            # so the form stays open until the batch is done
+            uploads = [(name, upload.file) for name, upload in parts]
+            job = batch_lane.submit(process_image_batch, uploads, detection, image_options, channel.send)
+            job.add_done_callback(lambda finished, form=form_data: asyncio.ensure_future(form.close()))
+            form_data = None
+    finally:
+        if form_data is not None:
+            await form_data.close()
+    # Marks a cancelled batch's error as retrieved; errors are otherwise reported in the stream
+    job.add_done_callback(lambda finished: finished.cancelled() or finished.exception())
+
+    async def result_stream():
+        try:
+            while True:
+                next_event = asyncio.ensure_future(channel.receive())
+                done, _ = await asyncio.wait({next_event, job}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event in done:
+                    yield _format_batch_event(request, next_event.result(), image_options)
+                    continue
+                next_event.cancel()
+                break
+            for event in channel.drain():
+                yield _format_batch_event(request, event, image_options)
+
+            try:
+                events = job.result()
+            except Exception as processing_error:
+                logger.error(f"Error in predict_images: {processing_error}", exc_info=True)
+                yield _format_stream_event("ndjson", "error", {"detail": f"Internal server error: {processing_error}"})
+                return
+            for event in events:
+                yield _format_batch_event(request, event, image_options)
+        finally:
+            # Client gone or stream finished: stop scoring the rest of the batch
+            channel.close()
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/predict_video")
 async def predict_video_restored(request: Request):
     # ... (Endpoint logic remains largely the same, uses the updated process_video)
+    require_models_ready()
     tmp_path = None
+    form_data = None
+    timings = StageTimings("video")
     try:
-        form_data = await request.form()
-        if 'file' not in form_data:
-            raise HTTPException(status_code=400, detail="'file' field missing in form data.")
-        file_field = form_data['file']
-        # Basic check if it looks like an UploadFile
-        is_likely_uploadfile = (
-            hasattr(file_field, 'filename') and
-            hasattr(file_field, 'content_type') and
-            hasattr(file_field, 'file') and
-            callable(getattr(file_field, 'read', None))
-        )
-        if not is_likely_uploadfile:
-            actual_value = str(file_field)[:200]
-            logger.error(f"!!! ERROR: 'file' field doesn't act like UploadFile. Type: {type(file_field)}, Value: {actual_value}")
-            raise HTTPException(status_code=400, detail=f"Expected 'file' field to be a file upload, received {type(file_field)}.")
-
-        # Save to temp file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp: # Use appropriate suffix if known
-            content = await file_field.read()
-            if not content:
-                 raise HTTPException(status_code=400, detail="Received empty file.")
-            tmp.write(content)
-            tmp_path = tmp.name
+        # A busy server answers 503 before the client has sent (and we have spooled) the whole video
+        video_lane.check_capacity()
+        with timings.stage("upload"):
+            form_data = await read_upload_form(request, int(MAX_VIDEO_UPLOAD_MB * 1024 * 1024))
+            file_field = get_upload_field(form_data)
+        sampling, detection, image_options = parse_video_request_options(form_data)
+
+        # Stream the upload to a temp file in chunks, hashing it on the way
+        with timings.stage("upload"):
+            tmp_path, content_digest, size = await spool_upload(file_field, ".mp4") # Use appropriate suffix if known
+        if size == 0:
+             raise HTTPException(status_code=400, detail="Received empty file.")
         logger.info(f"Video saved to temporary file: {tmp_path}")
 
-        # Call the updated process_video which now averages predictions
-        video_results = process_video(tmp_path)
+        # Identical uploads with identical parameters are answered from the result cache
+        cache_key = None
+        use_cache = result_cache is not None and image_options["mode"] != "artifact"
+        if use_cache:
+            cache_key = result_cache_key("video", content_digest, {"sampling": sampling, "detection": detection, "images": image_options})
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            if cached is not None:
+                logger.info(f"predict_video endpoint: cache hit for {cache_key}.")
+                _remove_temp_file(tmp_path)
+                tmp_path = None
+                return _timed_response(_cached_response(cached, "HIT", cache_key), timings)
+
+        # Run the updated process_video (which averages predictions) in the video worker pool
+        video_results, timings = await video_lane.run(process_video_timed, tmp_path, sampling, detection, image_options, None, timings)
 
         # Clean up temp file immediately after processing
-        if tmp_path and os.path.exists(tmp_path):
-             try:
-                 os.unlink(tmp_path)
-                 logger.info(f"Removed temporary file: {tmp_path}")
-             except OSError as unlink_error:
-                 logger.warning(f"Could not remove temporary file {tmp_path}: {unlink_error}")
-             tmp_path = None # Reset path after deletion
+        _remove_temp_file(tmp_path)
+        tmp_path = None # Reset path after deletion
 
         if video_results is None:
              logger.warning("predict_video endpoint: process_video returned None.")
              raise HTTPException(status_code=400, detail="Video processing failed or no faces processed.")
 
-        # Determine label based on the overall average prediction score
-        label = "real" if video_results["average_prediction"] > 0.5 else "fake"
-        video_results["label"] = label
-
-        # Return the results dictionary from process_video 
+        # Return the results dictionary from process_video, with its label
         # (already contains overall averages and first frame with all boxes drawn)
-        return video_results
+        video_results = finalize_video_results(request, video_results, image_options)
+        if use_cache:
+            await asyncio.to_thread(result_cache.put, cache_key, "video", video_results)
+            return _timed_response(_cached_response(video_results, "MISS", cache_key), timings)
+        return _timed_response(video_results, timings)
 
     except HTTPException as http_exc:
         # Clean up temp file if an HTTP error occurred mid-processing
-        if tmp_path and os.path.exists(tmp_path):
-             try: os.unlink(tmp_path); logger.info(f"Cleaned up temp file on HTTP error: {tmp_path}")
-             except OSError: pass
+        _remove_temp_file(tmp_path)
         raise http_exc
     except RuntimeError as rt_err:
          logger.error(f"Runtime error in predict_video: {rt_err}", exc_info=True)
          # Clean up temp file
-         if tmp_path and os.path.exists(tmp_path):
-              try: os.unlink(tmp_path); logger.info(f"Cleaned up temp file on runtime error: {tmp_path}")
-              except OSError: pass
+         _remove_temp_file(tmp_path)
          raise HTTPException(status_code=500, detail=str(rt_err))
     except Exception as e:
         logger.error(f"Unexpected error processing video endpoint: {e}", exc_info=True)
         # Clean up temp file if it exists due to unexpected error
-        if tmp_path and os.path.exists(tmp_path):
-             try:
-                 os.unlink(tmp_path)
-                 logger.info(f"Cleaned up temp file on unexpected error: {tmp_path}")
-             except OSError as unlink_error:
-                 logger.warning(f"Could not remove temporary file {tmp_path} on error: {unlink_error}")
+        _remove_temp_file(tmp_path)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        timings.report()
+        if form_data is not None:
+            await form_data.close()
+
+@app.post("/predict_video/stream")
+async def predict_video_stream(request: Request):
+    """Streams per-frame scores and a running average while a video is processed, ending with the usual summary.
+
+    Form field 'format' selects Server-Sent Events ("sse", default) or NDJSON ("ndjson"). Events are
+    "frame" (one per scored frame), then "result" (the /predict_video response) or "error".
+    """
+    require_models_ready()
+    tmp_path = None
+    form_data = None
+    timings = StageTimings("video")
+    try:
+        video_lane.check_capacity()
+        with timings.stage("upload"):
+            form_data = await read_upload_form(request, int(MAX_VIDEO_UPLOAD_MB * 1024 * 1024))
+            file_field = get_upload_field(form_data)
+        stream_format = str(form_data.get("format") or "sse").lower()
+        if stream_format not in ("sse", "ndjson"):
+            raise HTTPException(status_code=400, detail="'format' must be 'sse' or 'ndjson'.")
+        sampling, detection, image_options = parse_video_request_options(form_data)
+        with timings.stage("upload"):
+            tmp_path, _, size = await spool_upload(file_field, ".mp4")
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Received empty file.")
+
+        channel = _ProgressChannel(asyncio.get_running_loop())
+        # Progress callbacks cannot cross into process-pool workers; those streams only get the final result
+        progress_callback = None if video_lane.is_process_pool else channel.send
+        job = video_lane.submit(process_video_timed, tmp_path, sampling, detection, image_options, progress_callback, timings)
+    except BaseException:
+        _remove_temp_file(tmp_path)
+        timings.report()
+        raise
+    finally:
+        if form_data is not None:
+            await form_data.close()
+
+    def _job_finished(finished: asyncio.Future) -> None:
+        _remove_temp_file(tmp_path)
+        if finished.cancelled():
+            timings.report()
+        elif finished.exception() is not None: # Also marks it as retrieved; errors are reported in the stream
+            timings.report()
+        else:
+            finished.result()[1].report()
+
+    job.add_done_callback(_job_finished)
+
+    async def event_stream():
+        try:
+            while True:
+                next_event = asyncio.ensure_future(channel.receive())
+                done, _ = await asyncio.wait({next_event, job}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event in done:
+                    yield _format_stream_event(stream_format, "frame", next_event.result())
+                    continue
+                next_event.cancel()
+                break
+            for event in channel.drain():
+                yield _format_stream_event(stream_format, "frame", event)
+
+            try:
+                video_results, _ = job.result()
+            except Exception as processing_error:
+                logger.error(f"Error in predict_video stream: {processing_error}", exc_info=True)
+                yield _format_stream_event(stream_format, "error", {"detail": f"Internal server error: {processing_error}"})
+                return
+            if video_results is None:
+                yield _format_stream_event(stream_format, "error", {"detail": "Video processing failed or no faces processed."})
+                return
+            yield _format_stream_event(stream_format, "result", finalize_video_results(request, video_results, image_options))
+        finally:
+            # Client gone or stream finished: unblock and stop the pipeline if it is still running
+            channel.close()
+
+    media_type = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    return StreamingResponse(event_stream(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/jobs/video", status_code=202)
+async def create_video_job(request: Request):
+    """Spools a video and queues it for background processing; poll GET /jobs/{job_id} for progress and result."""
+    require_models_ready()
+    tmp_path = None
+    form_data = None
+    try:
+        # JobStore calls block on SQLite (and on job threads committing progress), so they run off the event loop.
+        # A full queue is reported before the video is uploaded and spooled.
+        if await asyncio.to_thread(video_jobs.store.count, "queued") >= JOB_QUEUE_LIMIT:
+            raise HTTPException(status_code=503, detail="Server busy: too many queued video jobs. Please retry later.",
+                                headers={"Retry-After": str(VIDEO_RETRY_AFTER_SECONDS)})
+        form_data = await read_upload_form(request, int(MAX_VIDEO_UPLOAD_MB * 1024 * 1024))
+        file_field = get_upload_field(form_data)
+        sampling, detection, image_options = parse_video_request_options(form_data)
+        if image_options["mode"] == "artifact":
+            raise HTTPException(status_code=400, detail="images=artifact is not available for jobs; artifacts expire before results are fetched.")
+
+        tmp_path, content_digest, size = await spool_upload(file_field, ".mp4", directory=video_jobs.spool_dir)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Received empty file.")
+
+        params = {"sampling": sampling, "detection": detection, "images": image_options}
+        if result_cache is not None:
+            params["cache_key"] = result_cache_key("video", content_digest, {"sampling": sampling, "detection": detection, "images": image_options})
+            cached = await asyncio.to_thread(result_cache.get, params["cache_key"])
+            if cached is not None:
+                _remove_temp_file(tmp_path)
+                tmp_path = None
+                job_id = await asyncio.to_thread(video_jobs.add_finished, params, cached)
+                return {"job_id": job_id, "status": "succeeded", "status_url": str(request.url_for("get_video_job", job_id=job_id))}
+
+        job_id = await asyncio.to_thread(video_jobs.submit, tmp_path, params)
+        logger.info(f"Queued video job {job_id} ({size} bytes).")
+        return {"job_id": job_id, "status": "queued", "status_url": str(request.url_for("get_video_job", job_id=job_id))}
+    except BaseException:
+        _remove_temp_file(tmp_path)
+        raise
+    finally:
+        if form_data is not None:
+            await form_data.close()
+
+@app.get("/jobs/{job_id}")
+async def get_video_job(job_id: str):
+    """Status, progress (frames processed so far) and, once finished, the result or error of a video job."""
+    job = await asyncio.to_thread(video_jobs.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    response = {key: job[key] for key in ("job_id", "status", "created", "updated", "finished", "frames_processed")}
+    if job["status"] == "succeeded":
+        response["result"] = job["result"]
+    elif job["status"] == "failed":
+        response["error"] = job["error"]
+    return response
 
 
 # --- Main Execution ---
 if __name__ == '__main__':
     # Check if face detector loaded correctly before starting server
-    if face_net is None:
+    if not face_detector_loaded:
         logger.error("!!! Face detection model failed to load. FastAPI server cannot start.")
+    elif LOAD_CLASSIFIER and not os.path.exists(pkl_model_path):
+        logger.error(f"!!! Classification model not found at {pkl_model_path}. FastAPI server cannot start.")
+        sys.exit(1)
     else:
         logger.info("Starting FastAPI server on 0.0.0.0:8000")
         uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,441 @@
+"""Offline benchmark for the detection/classification pipeline in api_for_mini_project.py.
+
+Generates synthetic images (varied resolutions and face counts) and videos (varied lengths and fps),
+runs them through process_image/process_video directly and through the FastAPI app under concurrent
+load (in-process, via httpx), and writes throughput plus p50/p95/p99 latency per stage and end to end
+as JSON. Needs no network access and, with the default stub classifier, no project512.pkl:
+
+    python benchmark_pipeline.py --output bench.json
+    python benchmark_pipeline.py --output after.json --baseline bench.json --fail-on-regression
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("benchmark_pipeline")
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# --- Synthetic Data ---
+# Faces are drawn as skin-coloured ellipses; backgrounds never reach the skin colour range, so the stub
+# detector can find the faces with a colour threshold
+SKIN_BGR = (142, 178, 224)
+SKIN_TOLERANCE = 40
+BACKGROUND_MAX = 110
+MIN_STUB_FACE_AREA = 200 # Pixels; smaller skin blobs (JPEG noise) are ignored by the stub detector
+
+# (width, height, faces)
+IMAGE_PRESETS = {
+    "default": [(w, h, faces) for (w, h) in ((640, 480), (1280, 720), (1920, 1080), (3840, 2160)) for faces in (1, 4, 12)],
+    "quick": [(640, 480, 1), (1920, 1080, 4)],
+}
+# (width, height, fps, seconds, faces)
+VIDEO_PRESETS = {
+    "default": [(640, 360, 24, 4, 1), (1280, 720, 30, 4, 2), (1280, 720, 60, 3, 1), (1920, 1080, 25, 6, 3)],
+    "quick": [(640, 360, 24, 2, 1)],
+}
+
+def _background(width: int, height: int, rng: np.random.Generator) -> np.ndarray:
+    gradient = np.linspace(0, BACKGROUND_MAX // 2, width, dtype=np.float32)[None, :, None]
+    noise = rng.integers(0, BACKGROUND_MAX // 2, size=(height, width, 3), dtype=np.uint8)
+    return (noise + gradient).astype(np.uint8)
+
+def _face_layout(width: int, height: int, faces: int, rng: np.random.Generator) -> List[Tuple[int, int, int]]:
+    """(center_x, center_y, size) for `faces` non-overlapping faces on a grid."""
+    columns = int(np.ceil(np.sqrt(faces)))
+    rows = int(np.ceil(faces / columns))
+    cell_w, cell_h = width // columns, height // rows
+    size = int(min(cell_w, cell_h) * 0.55)
+    layout = []
+    for i in range(faces):
+        row, column = divmod(i, columns)
+        jitter = rng.integers(-size // 10, size // 10 + 1, size=2)
+        layout.append((column * cell_w + cell_w // 2 + int(jitter[0]), row * cell_h + cell_h // 2 + int(jitter[1]), size))
+    return layout
+
+def _draw_face(frame: np.ndarray, center_x: int, center_y: int, size: int) -> None:
+    axes = (max(2, size // 3), max(3, size // 2 - 2))
+    cv2.ellipse(frame, (center_x, center_y), axes, 0, 0, 360, SKIN_BGR, -1)
+    eye_dx, eye_y, eye_r = axes[0] // 2, center_y - axes[1] // 4, max(1, size // 16)
+    cv2.circle(frame, (center_x - eye_dx, eye_y), eye_r, (40, 40, 40), -1)
+    cv2.circle(frame, (center_x + eye_dx, eye_y), eye_r, (40, 40, 40), -1)
+    cv2.ellipse(frame, (center_x, center_y + axes[1] // 2), (axes[0] // 2, max(1, axes[1] // 8)), 0, 0, 180, (60, 60, 150), max(1, size // 40))
+
+def make_image(width: int, height: int, faces: int, rng: np.random.Generator) -> bytes:
+    frame = _background(width, height, rng)
+    for center_x, center_y, size in _face_layout(width, height, faces, rng):
+        _draw_face(frame, center_x, center_y, size)
+    ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("Could not encode synthetic image.")
+    return jpeg.tobytes()
+
+def write_video(path: str, width: int, height: int, fps: int, seconds: float, faces: int, rng: np.random.Generator) -> str:
+    """Writes a clip with slowly drifting faces; returns the path actually written (MJPG .avi if mp4v is unavailable)."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        path = os.path.splitext(path)[0] + ".avi"
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError("No usable video codec (mp4v or MJPG) in this OpenCV build.")
+    background = _background(width, height, rng)
+    layout = _face_layout(width, height, faces, rng)
+    phases = rng.uniform(0, 2 * np.pi, size=len(layout))
+    try:
+        for i in range(int(fps * seconds)):
+            frame = background.copy()
+            for (center_x, center_y, size), phase in zip(layout, phases):
+                dx = int(size * 0.15 * np.sin(i / fps * 2.0 + phase))
+                dy = int(size * 0.08 * np.cos(i / fps * 1.3 + phase))
+                _draw_face(frame, center_x + dx, center_y + dy, size)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+def build_dataset(preset: str, workdir: str, seed: int) -> Tuple[List[Tuple[str, bytes]], List[Tuple[str, str]]]:
+    """([(name, jpeg_bytes)], [(name, video_path)]) for the preset, generated deterministically from `seed`."""
+    rng = np.random.default_rng(seed)
+    images = [(f"{w}x{h}_{faces}f", make_image(w, h, faces, rng)) for (w, h, faces) in IMAGE_PRESETS[preset]]
+    videos = []
+    for (w, h, fps, seconds, faces) in VIDEO_PRESETS[preset]:
+        name = f"{w}x{h}_{fps}fps_{seconds}s_{faces}f"
+        videos.append((name, write_video(os.path.join(workdir, f"{name}.mp4"), w, h, fps, seconds, faces, rng)))
+    return images, videos
+
+# --- Stubs ---
+class StubClassifier:
+    """Stands in for project512.pkl: scores each crop by its mean intensity after a simulated model latency."""
+
+    def __init__(self, batch_ms: float, row_ms: float):
+        self.batch_ms = batch_ms
+        self.row_ms = row_ms
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        delay = (self.batch_ms + self.row_ms * len(X)) / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+        return X.mean(axis=(1, 2, 3)).reshape(-1, 1).astype(np.float32)
+
+def make_stub_detector(api):
+    """detect_faces replacement that finds the synthetic faces by colour instead of running YuNet.
+
+    Like detect_faces it honours max_side: the search runs on a downscaled copy and boxes are scaled back, so
+    --detect-max-side changes the detection cost (pyramid levels are not simulated).
+    """
+    low = np.array([max(0, c - SKIN_TOLERANCE) for c in SKIN_BGR], dtype=np.uint8)
+    high = np.array([min(255, c + SKIN_TOLERANCE) for c in SKIN_BGR], dtype=np.uint8)
+
+    def stub_detect_faces(frame: np.ndarray, detection: Optional[Dict[str, Any]] = None) -> list:
+        max_side = api.DETECTION_MAX_SIDE if detection is None else detection["max_side"]
+        (h, w) = frame.shape[:2]
+        scale = max_side / max(h, w) if max_side and max(h, w) > max_side else 1.0
+        search_frame = frame
+        if scale < 1.0:
+            search_frame = cv2.resize(frame, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+        mask = cv2.inRange(search_frame, low, high)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        min_area = MIN_STUB_FACE_AREA * scale * scale
+        faces = [[x / scale, y / scale, bw / scale, bh / scale] + [0.0] * 10 + [1.0]
+                 for (x, y, bw, bh, area) in stats[1:] if area >= min_area]
+        return api._extract_faces(frame, np.array(faces, dtype=np.float32) if faces else None)
+
+    return stub_detect_faces
+
+# --- Measurement ---
+def summarize(values_s: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    if not values_s:
+        return {"count": 0}
+    ms = np.array(values_s, dtype=np.float64) * 1000.0
+    return {
+        "count": int(len(ms)),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+class LatencyRecorder:
+    def __init__(self):
+        self.end_to_end = []
+        self.stages = {} # stage -> [seconds]
+        self.counts = {}
+
+    def add(self, seconds: float, stage_durations: Dict[str, float], counts: Optional[Dict[str, int]] = None) -> None:
+        self.end_to_end.append(seconds)
+        for stage, stage_seconds in stage_durations.items():
+            self.stages.setdefault(stage, []).append(stage_seconds)
+        for name, count in (counts or {}).items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def summary(self, wall_seconds: float) -> Dict[str, Any]:
+        result = {
+            "requests": len(self.end_to_end),
+            "wall_seconds": wall_seconds,
+            "throughput_per_s": len(self.end_to_end) / wall_seconds if wall_seconds > 0 else 0.0,
+            "end_to_end": summarize(self.end_to_end),
+            "stages": {stage: summarize(values) for stage, values in self.stages.items()},
+        }
+        if self.counts:
+            result["counts"] = dict(self.counts)
+            for name in ("frames_decoded", "frames_sampled", "faces"):
+                if name in self.counts and wall_seconds > 0:
+                    result[f"{name}_per_s"] = self.counts[name] / wall_seconds
+        return result
+
+def _parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """{"stage": seconds} from a Server-Timing header value."""
+    durations = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.startswith("dur="):
+            durations[name] = float(params[4:]) / 1000.0
+    return durations
+
+# --- Direct Calls ---
+def bench_direct_images(api, images: List[Tuple[str, bytes]], repeat: int, detection: Dict[str, Any],
+                        image_options: Dict[str, Any]) -> Dict[str, Any]:
+    overall = LatencyRecorder()
+    per_asset = {name: LatencyRecorder() for name, _ in images}
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for name, jpeg in images:
+            timings = api.StageTimings("image")
+            call_started = time.perf_counter()
+            api.process_image(io.BytesIO(jpeg), detection, image_options, timings)
+            elapsed = time.perf_counter() - call_started
+            overall.add(elapsed, timings.durations, timings.counts)
+            per_asset[name].add(elapsed, timings.durations, timings.counts)
+    wall = time.perf_counter() - started
+    return {"all": overall.summary(wall),
+            "assets": {name: recorder.summary(sum(recorder.end_to_end)) for name, recorder in per_asset.items()}}
+
+def bench_direct_videos(api, videos: List[Tuple[str, str]], repeat: int, sampling: Dict[str, Any],
+                        detection: Dict[str, Any], image_options: Dict[str, Any]) -> Dict[str, Any]:
+    overall = LatencyRecorder()
+    per_asset = {name: LatencyRecorder() for name, _ in videos}
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for name, path in videos:
+            timings = api.StageTimings("video")
+            call_started = time.perf_counter()
+            api.process_video(path, sampling, detection, image_options, None, timings)
+            elapsed = time.perf_counter() - call_started
+            overall.add(elapsed, timings.durations, timings.counts)
+            per_asset[name].add(elapsed, timings.durations, timings.counts)
+    wall = time.perf_counter() - started
+    return {"all": overall.summary(wall),
+            "assets": {name: recorder.summary(sum(recorder.end_to_end)) for name, recorder in per_asset.items()}}
+
+# --- Through the App ---
+async def _bench_endpoint(api, path: str, uploads: List[Tuple[str, bytes, str]], requests: int, concurrency: int,
+                          form: Dict[str, str]) -> Dict[str, Any]:
+    import httpx # Only needed for the app benchmark
+
+    recorder = LatencyRecorder()
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        async def one(i: int) -> None:
+            filename, payload, content_type = uploads[i % len(uploads)]
+            async with semaphore:
+                call_started = time.perf_counter()
+                response = await client.post(path, files={"file": (filename, payload, content_type)}, data=form)
+                elapsed = time.perf_counter() - call_started
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            if response.status_code == 200:
+                recorder.add(elapsed, _parse_server_timing(response.headers.get("server-timing")))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        wall = time.perf_counter() - started
+    result = recorder.summary(wall)
+    result.update(concurrency=concurrency, statuses=statuses)
+    return result
+
+def bench_app(api, images: List[Tuple[str, bytes]], videos: List[Tuple[str, str]], image_requests: int,
+              video_requests: int, concurrency: int, form: Dict[str, str]) -> Dict[str, Any]:
+    image_uploads = [(f"{name}.jpg", jpeg, "image/jpeg") for name, jpeg in images]
+    video_uploads = []
+    for name, path in videos:
+        with open(path, "rb") as f:
+            video_uploads.append((os.path.basename(path), f.read(), "video/mp4"))
+    results = {}
+    if image_requests:
+        results["predict_image"] = asyncio.run(_bench_endpoint(api, "/predict_image", image_uploads, image_requests, concurrency, form))
+    if video_requests:
+        results["predict_video"] = asyncio.run(_bench_endpoint(api, "/predict_video", video_uploads, video_requests, concurrency, form))
+    return results
+
+# --- Baseline Comparison ---
+def _flatten(tree: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in tree.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = float(value)
+    return flat
+
+def compare_to_baseline(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> Dict[str, Any]:
+    """Relative change of every latency percentile and throughput figure present in both runs.
+
+    Latencies regress when they grow by more than `tolerance` (a fraction), throughputs when they shrink by more.
+    """
+    current_flat = _flatten(current["results"])
+    baseline_flat = _flatten(baseline.get("results", {}))
+    metrics, regressions = {}, []
+    for path, value in current_flat.items():
+        leaf = path.rsplit(".", 1)[-1]
+        lower_is_better = leaf in ("p50_ms", "p95_ms", "p99_ms")
+        if not (lower_is_better or leaf.endswith("_per_s")) or path not in baseline_flat or baseline_flat[path] <= 0:
+            continue
+        change = value / baseline_flat[path] - 1.0
+        metrics[path] = {"baseline": baseline_flat[path], "current": value, "change": change}
+        if (change > tolerance) if lower_is_better else (change < -tolerance):
+            regressions.append(path)
+    return {"tolerance": tolerance, "regressions": regressions, "metrics": metrics}
+
+# --- Main ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--preset", choices=sorted(IMAGE_PRESETS), default="default", help="Synthetic dataset size.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--workdir", help="Where synthetic videos are written (default: a temporary directory).")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the dataset for the direct benchmark.")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed direct calls per media type before measuring.")
+    parser.add_argument("--detector", choices=("stub", "yunet"), default="stub",
+                        help="'stub' finds the synthetic faces by colour; 'yunet' runs the real detector (which may not fire on them).")
+    parser.add_argument("--classifier", choices=("stub", "model"), default="stub", help="'model' loads project512.pkl.")
+    parser.add_argument("--stub-batch-ms", type=float, default=15.0, help="Simulated fixed cost of one classifier call.")
+    parser.add_argument("--stub-row-ms", type=float, default=1.0, help="Simulated cost per face in a classifier call.")
+    parser.add_argument("--images", default="full", help="Response image mode ('full', 'thumbnail', 'none').")
+    parser.add_argument("--frame-skip", type=int, default=None, help="Video sampling frame skip (default: the API default).")
+    parser.add_argument("--track-interval", type=int, default=0, help="Face tracking interval for videos (0 = off).")
+    parser.add_argument("--dedup-distance", type=int, default=-1, help="Near-duplicate frame/crop reuse distance in dHash bits (-1 = off).")
+    parser.add_argument("--detect-max-side", type=int, default=None, help="Detection resolution cap (default: the API default).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests in the app benchmark.")
+    parser.add_argument("--image-requests", type=int, default=64, help="/predict_image requests in the app benchmark.")
+    parser.add_argument("--video-requests", type=int, default=8, help="/predict_video requests in the app benchmark.")
+    parser.add_argument("--skip-direct", action="store_true")
+    parser.add_argument("--skip-app", action="store_true")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier --output file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative change treated as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when a regression is found.")
+    return parser.parse_args(argv)
+
+def load_api(args: argparse.Namespace):
+    """Imports api_for_mini_project configured for benchmarking (no result cache, Server-Timing on)."""
+    os.environ["RESULT_CACHE_ENABLED"] = "0"
+    os.environ["SERVER_TIMING_ENABLED"] = "1"
+    if args.classifier == "stub":
+        os.environ["LOAD_CLASSIFIER"] = "0"
+    sys.path.insert(0, script_dir)
+    import api_for_mini_project as api
+
+    api.load_models() # Warms up the real classifier so its first batch is not timed; only marks ready with the stub
+    if args.classifier == "stub":
+        api.loaded_model = StubClassifier(args.stub_batch_ms, args.stub_row_ms)
+    if args.detector == "stub":
+        api.detect_faces = make_stub_detector(api)
+    return api
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    api = load_api(args)
+    logging.getLogger(api.__name__).setLevel(logging.WARNING) # Per-request logging would dominate the timings
+
+    detection = api.parse_detection_options({})
+    if args.detect_max_side is not None:
+        detection["max_side"] = args.detect_max_side
+    detection["track_interval"] = args.track_interval
+    detection["dedup_distance"] = args.dedup_distance
+    image_options = api.parse_image_options({"images": args.images})
+    sampling = dict(api.VIDEO_DEFAULT_SAMPLING)
+    if args.frame_skip is not None:
+        sampling["frame_skip"] = args.frame_skip
+    form = {"images": args.images, "track_interval": str(args.track_interval), "dedup_distance": str(args.dedup_distance)}
+    if args.frame_skip is not None:
+        form["frame_skip"] = str(args.frame_skip)
+    if args.detect_max_side is not None:
+        form["detect_max_side"] = str(args.detect_max_side)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_pipeline_") as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        os.makedirs(workdir, exist_ok=True)
+        logger.info(f"Generating '{args.preset}' dataset in {workdir} (seed {args.seed})...")
+        images, videos = build_dataset(args.preset, workdir, args.seed)
+
+        results = {}
+        if not args.skip_direct:
+            for _ in range(args.warmup):
+                api.process_image(io.BytesIO(images[0][1]), detection, image_options)
+                api.process_video(videos[0][1], sampling, detection, image_options)
+            logger.info("Benchmarking direct process_image calls...")
+            results["direct_image"] = bench_direct_images(api, images, args.repeat, detection, image_options)
+            logger.info("Benchmarking direct process_video calls...")
+            results["direct_video"] = bench_direct_videos(api, videos, args.repeat, sampling, detection, image_options)
+        if not args.skip_app:
+            logger.info(f"Benchmarking the app with {args.concurrency} concurrent requests...")
+            results["app"] = bench_app(api, images, videos, args.image_requests, args.video_requests, args.concurrency, form)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "args": vars(args),
+            "api_config": {name: getattr(api, name) for name in (
+                "VIDEO_INFERENCE_BATCH_SIZE", "INFERENCE_BATCHING_ENABLED", "INFERENCE_MAX_BATCH_SIZE", "INFERENCE_MAX_WAIT_MS",
+                "VIDEO_DETECTOR_WORKERS", "VIDEO_PIPELINE_QUEUE_SIZE", "PROCESSING_POOL_KIND", "IMAGE_WORKERS", "VIDEO_WORKERS",
+                "DETECTION_MAX_SIDE", "DETECTION_PYRAMID_LEVELS", "DEDUP_CACHE_SIZE")},
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_to_baseline(report, json.load(f), args.tolerance)
+        regressions = report["comparison"]["regressions"]
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+    for section, section_results in results.items():
+        summaries = {"all": section_results["all"]} if "all" in section_results else section_results
+        for name, summary in summaries.items():
+            e2e = summary["end_to_end"]
+            if e2e.get("count"):
+                print(f"{section}/{name}: {summary['throughput_per_s']:.2f} req/s, "
+                      f"p50 {e2e['p50_ms']:.1f} ms, p95 {e2e['p95_ms']:.1f} ms, p99 {e2e['p99_ms']:.1f} ms")
+    if args.baseline:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%} against {args.baseline}")
+        for path in regressions:
+            metric = report["comparison"]["metrics"][path]
+            print(f"  {path}: {metric['baseline']:.2f} -> {metric['current']:.2f} ({metric['change']:+.1%})")
+    return 1 if regressions and args.fail_on_regression else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
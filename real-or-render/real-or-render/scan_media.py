@@ -0,0 +1,345 @@
+"""Offline bulk scanner: runs every image and video under one or more directories through the pipeline.
+
+Files are spread over a pool of worker processes that each load the models once and call process_image /
+process_video directly (no HTTP). Results are appended to a manifest as they finish, either JSONL (one
+row per line) or Parquet (a directory of part files, needs pyarrow). Re-running with the same manifest
+skips files already in it, matched by path, size and mtime (--key stat) or by content hash (--key hash):
+
+    python scan_media.py /data/archive --output scan.jsonl
+    python scan_media.py /data/archive --output scan.parquet --types video --option frame_skip=10
+
+--option passes the same fields the HTTP endpoints take (detect_max_side, sample_mode, track_interval,
+images, ...); images default to "none" so the manifest holds no base64 JPEGs.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from serve import configure_threads, partition_cores
+
+logger = logging.getLogger("scan_media")
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v", ".mpg", ".mpeg", ".wmv")
+HASH_CHUNK_SIZE = 1024 * 1024
+PARQUET_COLUMNS = ("path", "kind", "size", "mtime_ns", "sha256", "status", "error", "seconds", "scanned_at", "result")
+
+# --- Files ---
+def iter_media_files(roots: List[str], extensions: Dict[str, str]) -> Iterator[Tuple[str, str]]:
+    """(absolute path, "image" or "video") for every matching file under `roots`, in a stable order."""
+    for root in roots:
+        if os.path.isfile(root):
+            kind = extensions.get(os.path.splitext(root)[1].lower())
+            if kind:
+                yield os.path.abspath(root), kind
+            continue
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories[:] = sorted(name for name in subdirectories if not name.startswith("."))
+            for name in sorted(files):
+                kind = extensions.get(os.path.splitext(name)[1].lower())
+                if kind and not name.startswith("."):
+                    yield os.path.abspath(os.path.join(directory, name)), kind
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# --- Manifests ---
+class JsonlManifest:
+    """One JSON object per line, flushed after every row so an interrupted scan keeps what it finished."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def rows(self) -> Iterator[Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Last line cut short by an interrupted run
+
+    def append(self, row: Dict[str, Any]) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+class ParquetManifest:
+    """A directory of Parquet part files; rows are buffered and written out as a new part every `flush_rows`.
+
+    Parquet files cannot be appended to, so each flush writes a complete file (via a temporary name), and an
+    interrupted scan loses at most the rows still buffered. The result column holds the result as JSON text.
+    """
+
+    def __init__(self, path: str, flush_rows: int):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet manifests need pyarrow (pip install pyarrow); use a .jsonl output otherwise.")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.flush_rows = max(1, flush_rows)
+        self._buffer = []
+        self._schema = pyarrow.schema([
+            ("path", pyarrow.string()), ("kind", pyarrow.string()), ("size", pyarrow.int64()),
+            ("mtime_ns", pyarrow.int64()), ("sha256", pyarrow.string()), ("status", pyarrow.string()),
+            ("error", pyarrow.string()), ("seconds", pyarrow.float64()), ("scanned_at", pyarrow.string()),
+            ("result", pyarrow.string()),
+        ])
+
+    def rows(self) -> Iterator[Dict[str, Any]]:
+        if not os.path.isdir(self.path):
+            return
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".parquet"):
+                yield from self._pq.read_table(os.path.join(self.path, name), columns=["path", "size", "mtime_ns", "sha256", "status"]).to_pylist()
+
+    def append(self, row: Dict[str, Any]) -> None:
+        self._buffer.append({column: row.get(column) for column in PARQUET_COLUMNS})
+        self._buffer[-1]["result"] = None if row.get("result") is None else json.dumps(row["result"])
+        if len(self._buffer) >= self.flush_rows:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        part_path = os.path.join(self.path, f"part-{time.time_ns()}-{os.getpid()}.parquet")
+        table = self._pa.Table.from_pylist(self._buffer, schema=self._schema)
+        self._pq.write_table(table, part_path + ".tmp")
+        os.replace(part_path + ".tmp", part_path)
+        self._buffer = []
+
+    def close(self) -> None:
+        self._flush()
+
+def open_manifest(path: str, manifest_format: str, flush_rows: int):
+    if manifest_format == "auto":
+        manifest_format = "parquet" if path.endswith(".parquet") else "jsonl"
+    return ParquetManifest(path, flush_rows) if manifest_format == "parquet" else JsonlManifest(path)
+
+def completed_keys(manifest, key_mode: str, retry_failed: bool) -> Set[tuple]:
+    """Resume keys of the files the manifest already covers: (path, size, mtime_ns) or (sha256,)."""
+    done = set()
+    for row in manifest.rows():
+        if row.get("status") == "failed" and retry_failed:
+            continue
+        if key_mode == "hash":
+            if row.get("sha256"):
+                done.add((row["sha256"],))
+        else:
+            done.add((row["path"], row["size"], row["mtime_ns"]))
+    return done
+
+# --- Workers ---
+_worker = {} # Per worker process: the API module and the parsed request options
+
+def _init_worker(options: Dict[str, Any], done_hashes: Set[tuple]) -> None:
+    sys.path.insert(0, script_dir)
+    import api_for_mini_project as api
+    logging.getLogger(api.__name__).setLevel(logging.WARNING) # Per-file pipeline logging would drown the progress lines
+    api.load_models()
+    _worker.update(api=api, done_hashes=done_hashes, **options)
+
+def scan_file(path: str, kind: str, key_mode: str) -> Dict[str, Any]:
+    """The manifest row for one file ("ok", "failed", or "skipped" when its hash is already in the manifest)."""
+    api = _worker["api"]
+    started = time.perf_counter()
+    row = {"path": path, "kind": kind, "size": None, "mtime_ns": None, "sha256": None, "status": "failed", "error": None}
+    try:
+        stat = os.stat(path)
+        row.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        if key_mode == "hash":
+            row["sha256"] = file_sha256(path)
+            if (row["sha256"],) in _worker["done_hashes"]:
+                row["status"] = "skipped"
+                return row
+        if kind == "image":
+            with open(path, "rb") as f:
+                processing_result = api.process_image(f, _worker["detection"], _worker["image_options"])
+            result = None if processing_result is None else api.image_result_fields(processing_result)
+        else:
+            result = api.process_video(path, _worker["sampling"], _worker["video_detection"], _worker["image_options"])
+        if result is None:
+            row["error"] = "Processing failed or no faces processed."
+        else:
+            row.update(status="ok", result=result)
+    except Exception as scan_error:
+        row["error"] = f"{type(scan_error).__name__}: {scan_error}"
+    finally:
+        row["seconds"] = time.perf_counter() - started
+        row["scanned_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    return row
+
+def parse_request_options(raw_options: List[str]) -> Dict[str, Any]:
+    """Detection, sampling and image options from KEY=VALUE pairs, validated by the API's own form parsers."""
+    form = {"images": "none"}
+    for option in raw_options:
+        key, separator, value = option.partition("=")
+        if not separator:
+            raise SystemExit(f"--option expects KEY=VALUE, got '{option}'.")
+        form[key.strip()] = value.strip()
+
+    sys.path.insert(0, script_dir)
+    import api_for_mini_project as api
+    try:
+        options = {
+            "detection": api.parse_detection_options(form),
+            "image_options": api.parse_image_options(form),
+            "sampling": api.parse_video_sampling(form),
+        }
+        options["video_detection"] = {**options["detection"], **api.parse_tracking_options(form)}
+    except api.HTTPException as option_error:
+        raise SystemExit(f"Invalid --option: {option_error.detail}")
+    if options["image_options"]["mode"] == "artifact":
+        raise SystemExit("images=artifact needs the server; use none, thumbnail or full.")
+    return options
+
+# --- Progress ---
+class ScanProgress:
+    """Counts finished files and logs throughput (files/s, MB/s) and an ETA every `interval` seconds."""
+
+    def __init__(self, total: int, interval: float):
+        self.total = total
+        self.interval = interval
+        self.counts = {"ok": 0, "failed": 0, "skipped": 0}
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+
+    def add(self, row: Dict[str, Any]) -> None:
+        self.counts[row["status"]] += 1
+        if row["status"] != "skipped":
+            self.bytes += row.get("size") or 0
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def report(self) -> None:
+        done = sum(self.counts.values())
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        processed = self.counts["ok"] + self.counts["failed"]
+        rate = processed / elapsed
+        eta = "0s" if done >= self.total else f"{(self.total - done) / rate:.0f}s" if rate > 0 else "?"
+        logger.info(f"{done}/{self.total} files ({self.counts['ok']} ok, {self.counts['failed']} failed, "
+                    f"{self.counts['skipped']} skipped) | {rate:.2f} files/s, {self.bytes / elapsed / 1e6:.1f} MB/s | ETA {eta}")
+
+# --- Main ---
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("roots", nargs="+", help="Directories (walked recursively) or files to scan.")
+    parser.add_argument("--output", required=True, help="Manifest: a .jsonl file, or a .parquet directory.")
+    parser.add_argument("--format", choices=("auto", "jsonl", "parquet"), default="auto", help="Manifest format (default: from --output).")
+    parser.add_argument("--types", default="image,video", help="Comma-separated media types to scan: image, video.")
+    parser.add_argument("--extensions", help="Comma-separated file extensions to scan instead of the defaults for --types.")
+    parser.add_argument("--key", choices=("stat", "hash"), default="stat",
+                        help="Resume key: path + size + mtime ('stat'), or SHA-256 of the content ('hash', survives moves).")
+    parser.add_argument("--retry-failed", action="store_true", help="Scan files again whose previous result was 'failed'.")
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="Request option as accepted by the HTTP endpoints (repeatable).")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes (default: usable cores // --threads).")
+    parser.add_argument("--threads", type=int, default=0, help="Inference/OpenCV threads per worker.")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="Seconds between progress lines.")
+    parser.add_argument("--parquet-flush-rows", type=int, default=500, help="Rows per Parquet part file.")
+    return parser.parse_args(argv)
+
+def _extension_kinds(args: argparse.Namespace) -> Dict[str, str]:
+    types = {name.strip() for name in args.types.split(",") if name.strip()}
+    if not types or not types <= {"image", "video"}:
+        raise SystemExit("--types takes image, video or both.")
+    known = {**dict.fromkeys(IMAGE_EXTENSIONS, "image"), **dict.fromkeys(VIDEO_EXTENSIONS, "video")}
+    if args.extensions:
+        # Extensions the scanner does not know are treated as images, or as videos with --types video
+        default_kind = "video" if types == {"video"} else "image"
+        wanted = {"." + extension.strip().lower().lstrip(".") for extension in args.extensions.split(",") if extension.strip()}
+        known = {extension: known.get(extension, default_kind) for extension in wanted}
+    return {extension: kind for extension, kind in known.items() if kind in types}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    cores = sorted(os.sched_getaffinity(0))
+    workers, threads = partition_cores(cores, args.workers, args.threads)
+    configure_threads(threads)
+    # Each worker scores one file at a time, so there is nothing for the micro-batcher to merge, and the
+    # manifest already remembers results
+    os.environ.setdefault("INFERENCE_BATCHING_ENABLED", "0")
+    os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+
+    extension_kinds = _extension_kinds(args)
+    options = parse_request_options(args.option)
+    manifest = open_manifest(args.output, args.format, args.parquet_flush_rows)
+    done = completed_keys(manifest, args.key, args.retry_failed)
+
+    files, skipped = [], 0
+    for path, kind in iter_media_files(args.roots, extension_kinds):
+        if args.key == "stat":
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (path, stat.st_size, stat.st_mtime_ns) in done:
+                skipped += 1
+                continue
+        files.append((path, kind))
+    known = f"{skipped} already in" if args.key == "stat" else f"skipping content whose hash is among {len(done)} in"
+    logger.info(f"{len(files)} files to scan ({known} {args.output}) with {workers} workers x {threads} threads.")
+    if not files:
+        return 0
+
+    progress = ScanProgress(len(files), args.progress_interval)
+    # spawn: each worker imports the API fresh and loads its own models (TensorFlow is not fork-safe)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(options, done if args.key == "hash" else set()))
+    pending = set()
+    try:
+        for path, kind in files:
+            pending.add(pool.submit(scan_file, path, kind, args.key))
+            # Bounds queued work, so a huge tree does not become millions of pending futures
+            while len(pending) >= 4 * workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _record(finished, manifest, progress)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            _record(finished, manifest, progress)
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; finished files are in the manifest and will be skipped next time.")
+        return 130
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        manifest.close()
+        progress.report()
+    return 0
+
+def _record(finished: set, manifest, progress: ScanProgress) -> None:
+    for future in finished:
+        row = future.result()
+        if row["status"] != "skipped":
+            manifest.append(row)
+        progress.add(row)
+
+if __name__ == "__main__":
+    sys.exit(main())
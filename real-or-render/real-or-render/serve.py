@@ -0,0 +1,190 @@
+"""Multi-worker production launcher for api_for_mini_project.py.
+
+Loads the models once in a parent process, then forks N uvicorn workers that accept connections on one
+shared socket. TF intra-op, OpenCV and BLAS thread pools are sized so that workers x threads matches the
+usable cores, and --pin gives each worker its own cores:
+
+    python serve.py --threads 2            # cores // 2 workers with 2 threads each
+    python serve.py --workers 8 --threads 1 --pin
+
+The weights are only shared copy-on-write with a TFLite INFERENCE_BACKEND: the converted model is read in
+the parent and each worker builds its interpreter on those bytes. TensorFlow itself is not fork-safe once
+initialised, so with keras/function backends every worker loads its own copy after the fork (from the
+cached .keras artifact). Unfinished background video jobs are handed back to the workers when the server
+starts and when the worker running them dies; whichever worker claims one first resumes it.
+
+Any request may land on any worker, so state that lives in one process is not shared: with more than one
+worker, images=artifact is rejected, the result cache only uses its SQLite tier (and is off without
+RESULT_CACHE_DB_PATH), and /metrics, /processing_stats and /inference_stats describe only the worker that answered.
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("serve")
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+RESPAWN_BACKOFF_SECONDS = 1.0 # Delay before replacing a worker that died within this long of starting
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes (default: usable cores // --threads).")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="Inference/OpenCV threads per worker (default: usable cores // --workers, or 1 if neither is set).")
+    parser.add_argument("--pin", action="store_true", help="Pin each worker to its own --threads cores.")
+    parser.add_argument("--backlog", type=int, default=2048, help="Listen backlog of the shared socket.")
+    parser.add_argument("--log-level", default="info")
+    return parser.parse_args(argv)
+
+def partition_cores(cores: List[int], workers: int, threads: int) -> Tuple[int, int]:
+    """(workers, threads) filled in from the usable cores when either is 0."""
+    if workers <= 0 and threads <= 0:
+        threads = 1
+    if workers <= 0:
+        workers = max(1, len(cores) // threads)
+    if threads <= 0:
+        threads = max(1, len(cores) // workers)
+    if workers * threads > len(cores):
+        logger.warning(f"{workers} workers x {threads} threads oversubscribes the {len(cores)} usable cores.")
+    return workers, threads
+
+def configure_threads(threads: int) -> None:
+    """Sizes the per-worker thread pools; must run before the API (and numpy) is imported."""
+    os.environ["INFERENCE_THREADS"] = str(threads)
+    os.environ["INFERENCE_INTEROP_THREADS"] = "1" # One model graph per worker; parallelism comes from the workers
+    os.environ["OPENCV_THREADS"] = str(threads)
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+
+def preload_models(api) -> None:
+    """Loads the classifier into the parent, where that can be shared with forked workers."""
+    backend = api.INFERENCE_BACKEND
+    if not api.LOAD_CLASSIFIER:
+        return
+    if not (api.MODEL_ARTIFACT_CACHE and backend.startswith("tflite")):
+        logger.warning(f"INFERENCE_BACKEND={backend}: TensorFlow cannot be initialised before forking, so each worker "
+                       f"loads its own copy of the model. Use a tflite backend to share it between workers.")
+        return
+    if api.cached_tflite_model(backend) is None:
+        # In a separate process, so TensorFlow is initialised there and never in the parent that forks
+        logger.info(f"No converted {backend} model cached yet; converting it in a separate process.")
+        subprocess.run([sys.executable, "-c", "import api_for_mini_project as api; api.load_models(warm_up=False)"],
+                       cwd=script_dir, check=False)
+    if api.cached_tflite_model(backend) is None:
+        logger.warning(f"No usable {backend} model (conversion or parity check failed); each worker loads its own model.")
+        return
+    api.load_models(warm_up=False)
+    logger.info(f"Loaded the {backend} model once for all workers ({os.path.getsize(api.cached_tflite_model(backend)[0])} bytes).")
+
+class WorkerSupervisor:
+    """Forks the uvicorn workers, replaces any that die and stops them all on SIGINT/SIGTERM."""
+
+    def __init__(self, api, config, workers: int, cores: List[List[int]]):
+        self.api = api
+        self.config = config
+        self.workers = workers
+        self.cores = cores # Per-worker CPU sets; empty lists leave affinity alone
+        self.socket = config.bind_socket()
+        self._pids: Dict[int, int] = {} # pid -> worker index
+        self._started: Dict[int, float] = {}
+        self._stopping = False
+
+    def _release_jobs(self, owner_pid: Optional[int] = None) -> None:
+        """Requeues the unfinished video jobs of a dead worker (of a previous server run when owner_pid is None)."""
+        store = self.api.JobStore(self.api.JOB_DB_PATH)
+        try:
+            store.release(owner_pid)
+        finally:
+            # The parent must not hand its connection down to forked workers
+            store.close()
+
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = index
+            self._started[index] = time.monotonic()
+            return
+        exit_code = 1
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL) # uvicorn installs its own for graceful shutdown
+            if self.cores[index]:
+                os.sched_setaffinity(0, self.cores[index])
+            if self.api.result_cache is not None:
+                self.api.result_cache.reopen()
+            # Only jobs released by the supervisor are claimed; the others belong to live workers
+            self.api.video_jobs.release_unfinished = False
+            logger.info(f"Worker {index} started (pid {os.getpid()}, cores {self.cores[index] or 'any'}).")
+            import uvicorn
+            uvicorn.Server(self.config).run(sockets=[self.socket])
+            exit_code = 0
+        except BaseException:
+            logger.exception(f"Worker {index} crashed.")
+        finally:
+            os._exit(exit_code)
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        self._release_jobs()
+        for index in range(self.workers):
+            self._spawn(index)
+        while self._pids:
+            pid, status = os.wait()
+            index = self._pids.pop(pid, None)
+            if index is None or self._stopping:
+                continue
+            logger.error(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}; restarting it.")
+            self._release_jobs(pid) # The replacement (or any worker starting later) claims them
+            if time.monotonic() - self._started[index] < RESPAWN_BACKOFF_SECONDS:
+                time.sleep(RESPAWN_BACKOFF_SECONDS)
+            self._spawn(index)
+        logger.info("All workers stopped.")
+        return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+    cores = sorted(os.sched_getaffinity(0))
+    workers, threads = partition_cores(cores, args.workers, args.threads)
+    configure_threads(threads)
+    os.environ["SERVER_WORKERS"] = str(workers)
+    logger.info(f"Starting {workers} workers x {threads} threads on {len(cores)} usable cores.")
+
+    sys.path.insert(0, script_dir)
+    import api_for_mini_project as api
+    import uvicorn
+
+    if not api.face_detector_loaded:
+        logger.error("!!! Face detection model failed to load. FastAPI server cannot start.")
+        return 1
+    if api.LOAD_CLASSIFIER and not os.path.exists(api.pkl_model_path):
+        logger.error(f"!!! Classification model not found at {api.pkl_model_path}. FastAPI server cannot start.")
+        return 1
+    if api.PROCESSING_POOL_KIND == "process":
+        logger.warning("PROCESSING_POOL_KIND=process starts more processes inside every worker; use thread with serve.py.")
+    preload_models(api)
+
+    worker_cores = [[cores[(index * threads + offset) % len(cores)] for offset in range(threads)] if args.pin else []
+                    for index in range(workers)]
+    config = uvicorn.Config(api.app, host=args.host, port=args.port, backlog=args.backlog, log_level=args.log_level)
+    return WorkerSupervisor(api, config, workers, worker_cores).run()
+
+if __name__ == "__main__":
+    sys.exit(main())